@@ -1,29 +1,86 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
 from datetime import datetime, timedelta
 import threading
 import locale
 import re
+import hashlib
+import bisect
+import sqlite3
+import time
+import asyncio
+import functools
+from collections import OrderedDict, deque
+from array import array
+import mmap
+import zlib
+import shutil
+import secrets
+import sys
+import subprocess
+import signal
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackContext, CallbackQueryHandler, MessageHandler, filters
+from telegram.error import BadRequest
+from telegram.ext import (Application, BaseUpdateProcessor, CommandHandler, CallbackContext,
+                          CallbackQueryHandler, MessageHandler, SimpleUpdateProcessor, filters)
 from dotenv import load_dotenv
 import os
+from concurrent.futures import ThreadPoolExecutor, Future
 
+# Standart kütüphanedeki zoneinfo önce denenir; pytz sadece tz verisi yoksa yüklenir
 try:
-    import pytz
-    TZ_ISTANBUL = pytz.timezone('Europe/Istanbul')
-except ImportError:
+    import zoneinfo
+    TZ_ISTANBUL = zoneinfo.ZoneInfo('Europe/Istanbul')
+except Exception:
     try:
-        import zoneinfo
-        TZ_ISTANBUL = zoneinfo.ZoneInfo('Europe/Istanbul')
-    except (ImportError, Exception):
+        import pytz
+        TZ_ISTANBUL = pytz.timezone('Europe/Istanbul')
+    except ImportError:
         from datetime import timezone
         TZ_ISTANBUL = timezone(timedelta(hours=3))
 
+@functools.lru_cache(maxsize=None)
+def load_numpy():
+    """numpy isteğe bağlıdır ve açılışı yavaşlatmasın diye ilk /stats sorgusunda yüklenir."""
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+ISTANBUL_UTC_OFFSET_SECONDS = 3 * 3600  # Türkiye 2016'dan beri sabit UTC+3
+
 def get_now():
     return datetime.now(TZ_ISTANBUL)
 
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+def istanbul_day_start(target_date: datetime) -> int:
+    """Verilen günün İstanbul saatiyle 00:00'ının epoch saniyesi."""
+    day = target_date.date() if isinstance(target_date, datetime) else target_date
+    return (day.toordinal() - EPOCH_ORDINAL) * 86400 - ISTANBUL_UTC_OFFSET_SECONDS
+
+# 7 Eylül 2016'dan önce Türkiye yaz saati uyguluyordu; öncesi tz veritabanından çevrilir
+FIXED_OFFSET_SINCE = istanbul_day_start(datetime(2016, 9, 7))
+CLOCK_STRINGS = tuple(f"{minute // 60:02d}:{minute % 60:02d}" for minute in range(24 * 60))
+
+@functools.lru_cache(maxsize=4096)
+def _istanbul_clock_slow(epoch_minute: int) -> str:
+    return datetime.fromtimestamp(epoch_minute * 60, TZ_ISTANBUL).strftime("%H:%M")
+
+def istanbul_clock(epoch_ms: int) -> str:
+    """
+    API'nin epoch milisaniye zamanını İstanbul duvar saatine ('HH:MM') çevirir.
+    Sunucunun yerel saat diliminden bağımsızdır; sabit +03:00 döneminde
+    yalnızca tamsayı aritmetiği ve önceden hazırlanmış tablo kullanılır.
+    """
+    seconds = epoch_ms // 1000
+    if seconds >= FIXED_OFFSET_SINCE:
+        return CLOCK_STRINGS[(seconds + ISTANBUL_UTC_OFFSET_SECONDS) // 60 % 1440]
+    return _istanbul_clock_slow(seconds // 60)
+
 try:
     locale.setlocale(locale.LC_TIME, 'tr_TR.UTF-8')
 except locale.Error:
@@ -37,25 +94,327 @@ load_dotenv()
 TELEGRAM_API_TOKEN = os.getenv("TELEGRAM_API_TOKEN")
 
 monitor_jobs = {}  # {chat_id: {job_id: {"thread": thread, "stop_event": event, "info": {...}}}}
+monitor_jobs_lock = threading.RLock()  # Handler'lar, izleme thread'leri ve watchdog birlikte değiştirir
 job_id_counter = 0
-user_states = {}
 STATIONS_DATA = []
 STATIONS_BY_ID = {}
+STATION_GROUPS = {}  # {şehir anahtarı: {"name": ..., "station_ids": [...]}}
+STATION_GROUPS_FILE = os.getenv("STATION_GROUPS_FILE", "station_groups.json")
+PAIRS_GRAPH = {}  # build_pairs_graph() ile doldurulur
+job_broker = None  # frontend modunda JobBroker örneği
+notification_sink = None  # worker modunda bildirimler broker üzerinden ön yüze akar
+board_sink = None  # worker modunda canlı pano güncellemeleri de broker üzerinden akar
+live_boards = {}  # {job_id: message_id} - tek süreç modunda canlı pano mesajları
+
+# Kapanış: SIGTERM'de işler durdurulur, süren sorgu/bildirimler en fazla bu kadar beklenir
+SHUTDOWN_GRACE_SECONDS = int(os.getenv("SHUTDOWN_GRACE_SECONDS", "20"))
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", "monitor_checkpoint.json")  # tek süreç modunda iş durumu
+shutdown_event = threading.Event()  # Süreç kapanırken set edilir (kullanıcı durdurmasından ayırt etmek için)
+
+# Watchdog ve sağlık uç noktaları (/healthz, /readyz)
+WATCHDOG_INTERVAL_SECONDS = int(os.getenv("WATCHDOG_INTERVAL_SECONDS", "30"))
+WATCHDOG_STALE_FACTOR = int(os.getenv("WATCHDOG_STALE_FACTOR", "3"))  # N x aralık boyunca nabız yoksa iş takılmıştır
+WATCHDOG_MAX_FAILURES = int(os.getenv("WATCHDOG_MAX_FAILURES", "5"))  # Art arda bu kadar başarısız turda uyarı
+WATCHDOG_MAX_RESTARTS = int(os.getenv("WATCHDOG_MAX_RESTARTS", "3"))  # Başarılı tur olmadan en fazla yeniden başlatma
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "0"))  # 0 = kapalı
+# Aynı makinedeki worker süreçleri için ayrı port (verilmezse HEALTH_PORT; 0 = kapalı)
+WORKER_HEALTH_PORT = int(os.getenv("WORKER_HEALTH_PORT", str(HEALTH_PORT)))
+READY_MAX_LAG_SECONDS = int(os.getenv("READY_MAX_LAG_SECONDS", "120"))  # İzleme gecikmesi bu kadarı aşarsa hazır değil
+
+# Sohbet başına kotalar; CHAT_QUOTAS ile sohbete özel değer verilebilir:
+# {"123456": {"max_jobs": 20, "min_interval": 60}}
+MAX_JOBS_PER_CHAT = int(os.getenv("MAX_JOBS_PER_CHAT", "5"))
+MIN_INTERVAL_SECONDS = int(os.getenv("MIN_INTERVAL_SECONDS", "60"))
+CHAT_QUOTAS = json.loads(os.getenv("CHAT_QUOTAS", "{}"))
+INTERVAL_OPTIONS = (60, 120, 300, 600)
+
+# İzleme sorgularının paylaşılan TCDD bütçesi (dakikada istek, 0 = sınırsız)
+UPSTREAM_POLLS_PER_MINUTE = int(os.getenv("UPSTREAM_POLLS_PER_MINUTE", "120"))
+
+# Satış penceresi: biletler kalkıştan SALES_HORIZON_DAYS gün önce satışa açılır.
+# Daha ileri tarihler tüm sohbetler için ortak ve seyrek yoklanır; beklenen açılış
+# anına yaklaşınca yoklama sıklaşır, açılınca bekleyen işler kısa süre hızlı kontrol eder.
+SALES_HORIZON_DAYS = int(os.getenv("SALES_HORIZON_DAYS", "13"))
+SALES_MAX_LEAD_DAYS = int(os.getenv("SALES_MAX_LEAD_DAYS", "90"))  # En fazla bu kadar ilerisi beklenebilir
+SALES_PROBE_SECONDS = int(os.getenv("SALES_PROBE_SECONDS", "1800"))
+SALES_FAST_PROBE_SECONDS = int(os.getenv("SALES_FAST_PROBE_SECONDS", "20"))
+SALES_FAST_PROBE_LEAD_SECONDS = 600  # Beklenen açılıştan bu kadar önce sık yoklamaya geç
+SALES_FAST_PROBE_TAIL_SECONDS = 7200  # Açılış gecikirse bu kadar süre daha sık yokla
+SALES_FAST_POLL_SECONDS = int(os.getenv("SALES_FAST_POLL_SECONDS", "15"))
+SALES_FAST_POLL_WINDOW_SECONDS = int(os.getenv("SALES_FAST_POLL_WINDOW_SECONDS", "900"))
+
+# Çalışma modu: all (tek süreç), frontend (bot + broker), worker (sadece izleme)
+RUN_MODE = os.getenv("RUN_MODE", "all")
+BROKER_PATH = os.getenv("BROKER_PATH", "ebilet_broker.sqlite3")
+WORKER_ID = os.getenv("WORKER_ID", f"worker-{os.getpid()}")
+WORKER_TTL_SECONDS = 30
+WORKER_POLL_SECONDS = 5
+
+# Webhook modu: WEBHOOK_URL tanımlıysa long polling yerine webhook kullanılır
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Örn: https://bot.example.com
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # X-Telegram-Bot-Api-Secret-Token kontrolü
+WEBHOOK_CERT = os.getenv("WEBHOOK_CERT")  # TLS yerel sonlandırma için sertifika (PEM)
+WEBHOOK_KEY = os.getenv("WEBHOOK_KEY")  # TLS özel anahtarı (PEM)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Güncelleme işleme: farklı sohbetler eşzamanlı, aynı sohbetin güncellemeleri sırayla işlenir
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))  # Aynı anda çalışan handler
+UPDATE_QUEUE_LIMIT = int(os.getenv("UPDATE_QUEUE_LIMIT", "256"))  # Çalışan + sohbet sırasında bekleyen güncelleme
 
 params = {
     'environment': 'dev',
     'userId': '1',
 }
 
+class ExpiringDict:
+    """
+    Boyutu sınırlı, süresi dolan kayıtları atan sözlük (LRU + TTL).
+    Her erişim kaydın süresini yeniler.
+    """
+
+    def __init__(self, maxsize: int, ttl_seconds: float, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.on_evict = on_evict  # Süresi dolan/taşan kayıtlar için on_evict(key, value)
+        self._data = OrderedDict()  # {key: (son_erisim, value)}
+        self._lock = threading.Lock()
+        self.evicted_count = 0
+
+    def _evict(self, key, value):
+        self.evicted_count += 1
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def _expired(self, stamp: float, now: float) -> bool:
+        return now - stamp > self.ttl_seconds
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            now = time.monotonic()
+            if self._expired(item[0], now):
+                del self._data[key]
+                self._evict(key, item[1])
+                return default
+            self._data[key] = (now, item[1])
+            self._data.move_to_end(key)
+            return item[1]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                old_key, (_, old_value) = self._data.popitem(last=False)
+                self._evict(old_key, old_value)
+
+    def expire(self) -> int:
+        """Süresi dolmuş kayıtları temizler, silinen kayıt sayısını döndürür."""
+        now = time.monotonic()
+        removed = 0
+        with self._lock:
+            # OrderedDict erişim sırasında tutulur, en eski kayıtlar baştadır
+            while self._data:
+                key, (stamp, value) = next(iter(self._data.items()))
+                if not self._expired(stamp, now):
+                    break
+                del self._data[key]
+                self._evict(key, value)
+                removed += 1
+        return removed
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+_MISSING = object()
+
+# Yarım bırakılan sihirbazlar: süresi dolunca mesajları arka planda silinir
+USER_STATE_TTL_SECONDS = int(os.getenv("USER_STATE_TTL_SECONDS", "1800"))
+USER_STATE_MAX_ENTRIES = int(os.getenv("USER_STATE_MAX_ENTRIES", "5000"))
+USER_STATE_SWEEP_SECONDS = int(os.getenv("USER_STATE_SWEEP_SECONDS", "60"))  # 0 = kapalı
+MEMORY_GAUGE_LOG_SECONDS = 600
+stale_wizard_messages = deque(maxlen=10000)  # [(chat_id, [message_id, ...]), ...]
+
+def _queue_stale_wizard(chat_id, state):
+    cleanup_ids = state.get("cleanup_ids") if isinstance(state, dict) else None
+    if cleanup_ids:
+        stale_wizard_messages.append((chat_id, list(cleanup_ids)))
+
+user_states = ExpiringDict(USER_STATE_MAX_ENTRIES, USER_STATE_TTL_SECONDS, on_evict=_queue_stale_wizard)
+
+# Callback verisi: "op" veya "op|arg1|arg2". Telegram 64 byte sınırını aşan
+# argümanlar sunucu tarafında saklanır ve butona sadece kısa bir token yazılır.
+CALLBACK_SEP = "|"
+CALLBACK_DATA_LIMIT = 64
+callback_payloads = ExpiringDict(maxsize=5000, ttl_seconds=6 * 3600)
+
+def encode_callback(op: str, *args) -> str:
+    data = CALLBACK_SEP.join((op,) + tuple(str(arg) for arg in args))
+    if len(data.encode()) <= CALLBACK_DATA_LIMIT:
+        return data
+    # Rastgele token: yeniden başlatmadan önceki eski butonlar yeni bir veriye denk gelmez,
+    # bilinmeyen token "oturum süresi doldu" yoluna düşer
+    token = "~" + secrets.token_urlsafe(6)
+    while token in callback_payloads:
+        token = "~" + secrets.token_urlsafe(6)
+    callback_payloads[token] = tuple(str(arg) for arg in args)
+    return f"{op}{CALLBACK_SEP}{token}"
+
+def decode_callback(data: str) -> tuple:
+    """
+    Callback verisini (op, args) olarak çözer.
+    Token'ın süresi dolmuşsa args None döner.
+    """
+    op, _, rest = data.partition(CALLBACK_SEP)
+    if not rest:
+        return op, ()
+    if rest[0] == "~":
+        return op, callback_payloads.get(rest)
+    return op, tuple(rest.split(CALLBACK_SEP))
+
+DELETE_BATCH_SIZE = 100  # deleteMessages tek istekte en fazla 100 mesaj kabul eder
+DELETE_CONCURRENCY = 5
+
 async def delete_messages(context: CallbackContext, chat_id: str, message_ids: list):
-    for msg_id in message_ids:
+    """
+    Mesajları Telegram'ın toplu deleteMessages çağrısıyla siler.
+    Toplu silme başarısız olursa sınırlı eşzamanlılıkla tek tek dener.
+    """
+    message_ids = [msg_id for msg_id in dict.fromkeys(message_ids) if msg_id]
+    if not message_ids:
+        return
+    
+    try:
+        for i in range(0, len(message_ids), DELETE_BATCH_SIZE):
+            await context.bot.delete_messages(chat_id=chat_id, message_ids=message_ids[i:i + DELETE_BATCH_SIZE])
+        return
+    except Exception as e:
+        print(f"Toplu mesaj silme hatası, tek tek deneniyor: {e}")
+    
+    semaphore = asyncio.Semaphore(DELETE_CONCURRENCY)
+    
+    async def delete_one(msg_id):
+        async with semaphore:
+            try:
+                await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
+            except Exception as e:
+                # Mesaj zaten silinmiş veya süresi dolmuş olabilir (48 saat)
+                print(f"Mesaj silme hatası (ID: {msg_id}): {e}")
+    
+    await asyncio.gather(*(delete_one(msg_id) for msg_id in message_ids))
+
+async def show_wizard_message(update: Update, context: CallbackContext, user_state: dict,
+                              text: str, reply_markup: InlineKeyboardMarkup = None):
+    """
+    Sihirbazın tek çapa mesajını yerinde düzenler.
+    Çapa yoksa veya düzenlenemiyorsa yeni mesaj gönderip çapa yapar.
+    """
+    chat_id = str(update.message.chat_id)
+    anchor_id = user_state.get("anchor_id")
+    
+    if anchor_id:
         try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-        except Exception as e:
-            # Mesaj zaten silinmiş veya süresi dolmuş olabilir (48 saat)
-            print(f"Mesaj silme hatası (ID: {msg_id}): {e}")
+            await context.bot.edit_message_text(
+                chat_id=chat_id, message_id=anchor_id, text=text,
+                reply_markup=reply_markup, parse_mode='Markdown'
+            )
+            return
+        except BadRequest as e:
+            if "not modified" in str(e):
+                return
+            print(f"Çapa mesajı düzenlenemedi, yenisi gönderiliyor: {e}")
+    
+    msg = await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+    user_state["anchor_id"] = msg.message_id
+    user_state["cleanup_ids"].append(msg.message_id)
+
+MAX_MESSAGE_LENGTH = 4096  # Telegram mesaj sınırı (UTF-16 birimi)
+
+def message_length(text: str) -> int:
+    """Telegram'ın saydığı uzunluk: emojiler 2 birim sayılır"""
+    return len(text.encode("utf-16-le")) // 2
+
+def _pack_pieces(pieces: list, separator: str, limit: int) -> list:
+    """Parçaları ayraçla birleştirerek sınırı aşmayan gruplara toplar."""
+    groups = []
+    current = []
+    current_length = 0
+    separator_length = message_length(separator)
+    for piece in pieces:
+        piece_length = message_length(piece) + separator_length
+        if current and current_length + piece_length > limit:
+            groups.append(separator.join(current))
+            current = []
+            current_length = 0
+        current.append(piece)
+        current_length += piece_length
+    if current:
+        groups.append(separator.join(current))
+    return groups
+
+def split_message(message: str, limit: int = MAX_MESSAGE_LENGTH) -> list:
+    """
+    Uzun mesajı önce boş satırlardan (tren blokları), sığmazsa satır sınırlarından
+    parçalara böler. HTML etiketleri satır içinde kapandığı için parçalar geçerli kalır.
+    """
+    if message_length(message) <= limit:
+        return [message]
+    
+    pieces = []
+    for block in message.split("\n\n"):
+        if message_length(block) + 2 <= limit:
+            pieces.append(block)
+            continue
+        # Tek blok sığmıyorsa satırlarına ayrılır; tek satır da sığmıyorsa kaba kesilir
+        lines = [line[:limit // 2] if message_length(line) >= limit else line for line in block.split("\n")]
+        pieces.extend(_pack_pieces(lines, "\n", limit))
+    return [chunk for chunk in _pack_pieces(pieces, "\n\n", limit) if chunk.strip()]
+
+def truncate_message(message: str, limit: int = MAX_MESSAGE_LENGTH) -> str:
+    """Tek mesaja sığmayan metni satır sınırından kısaltır (düzenlenen mesajlar bölünemez)."""
+    if message_length(message) <= limit:
+        return message
+    note = "\n\n✂️ <i>Mesaj sınırı nedeniyle kısaltıldı.</i>"
+    return split_message(message, limit - message_length(note))[0] + note
 
 def send_telegram_message(message: str, chat_id: str):
+    """
+    Mesajı gönderir; 4096 karakteri aşan mesajlar satır sınırlarından bölünür.
+    Returns: son gönderilen mesajın ID'si (broker modunda veya hatada None)
+    """
+    chunks = split_message(message)
+    if len(chunks) > 1:
+        message_id = None
+        for chunk in chunks:
+            message_id = send_telegram_message(chunk, chat_id)
+        return message_id
+    
+    if notification_sink is not None:
+        notification_sink(chat_id, message)
+        return None
     url = f'https://api.telegram.org/bot{TELEGRAM_API_TOKEN}/sendMessage'
     payload = {'chat_id': chat_id, 'text': message, 'parse_mode': 'HTML'}
     try:
@@ -63,17 +422,52 @@ def send_telegram_message(message: str, chat_id: str):
         if response.status_code == 400:
             print(f"HTML formatı hatası, düz metin olarak tekrar deneniyor...")
             payload.pop('parse_mode')
-            retry_response = requests.post(url, data=payload, timeout=10)
-            if retry_response.status_code == 200:
+            response = requests.post(url, data=payload, timeout=10)
+            if response.status_code == 200:
                 print(f"Telegram mesajı (Düz Metin) {chat_id} için gönderildi.")
             else:
-                print(f"Mesaj kurtarılamadı: {retry_response.text}")
+                print(f"Mesaj kurtarılamadı: {response.text}")
         elif response.status_code == 200:
             print(f"Telegram mesajı {chat_id} için gönderildi.")
         else:
             print(f"Telegram mesajı gönderilemedi: {response.text}")
+        if response.status_code == 200:
+            return response.json()["result"]["message_id"]
     except Exception as e:
         print(f"Telegram mesajı gönderme hatası: {e}")
+    return None
+
+def edit_telegram_message(message: str, chat_id: str, message_id: int) -> bool:
+    """
+    Mesajı yerinde düzenler.
+    Returns: False ise mesaj düzenlenemedi (silinmiş vb.), yenisi gönderilmeli
+    """
+    url = f'https://api.telegram.org/bot{TELEGRAM_API_TOKEN}/editMessageText'
+    payload = {'chat_id': chat_id, 'message_id': message_id, 'text': message, 'parse_mode': 'HTML'}
+    try:
+        response = requests.post(url, data=payload, timeout=10)
+        if response.status_code == 400 and "can't parse entities" in response.text:
+            payload.pop('parse_mode')
+            response = requests.post(url, data=payload, timeout=10)
+        if response.status_code == 200 or "not modified" in response.text:
+            return True
+        print(f"Mesaj düzenlenemedi: {response.text}")
+    except Exception as e:
+        print(f"Telegram mesajı düzenleme hatası: {e}")
+    return False
+
+def update_live_board(chat_id: str, job_id: int, message: str):
+    """İşin canlı pano mesajını düzenler; henüz yoksa veya düzenlenemiyorsa yenisini gönderir."""
+    message = truncate_message(message)
+    if board_sink is not None:
+        board_sink(chat_id, job_id, message)
+        return
+    message_id = live_boards.get(job_id)
+    if message_id is not None and edit_telegram_message(message, chat_id, message_id):
+        return
+    message_id = send_telegram_message(message, chat_id)
+    if message_id is not None:
+        live_boards[job_id] = message_id
 
 def get_dynamic_token():
     base_url = "https://ebilet.tcddtasimacilik.gov.tr"
@@ -127,187 +521,102 @@ def get_dynamic_token():
         print(f"HATA: Token alma hatası: {e}")
         return None
 
-def load_stations():
-    global STATIONS_DATA, STATIONS_BY_ID
-    
-    headers = {
-        'Accept': 'application/json, text/plain, */*',
-        'Accept-Language': 'tr',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-        'Referer': 'https://ebilet.tcddtasimacilik.gov.tr/',
-        'unit-id': '3895',
-    }
-    
-    url = 'https://cdn-api-prod-ytp.tcddtasimacilik.gov.tr/datas/station-pairs-INTERNET.json'
-    
-    try:
-        print("🚂 İstasyonlar yükleniyor...")
-        response = requests.get(url, params=params, headers=headers, timeout=15)
-        
-        if response.status_code != 200:
-            print(f"❌ İstasyon listesi alınamadı. Durum: {response.status_code}")
-            return False
-        
-        STATIONS_DATA = response.json()
-        
-        for station in STATIONS_DATA:
-            STATIONS_BY_ID[station['id']] = station
-        
-        print(f"✅ {len(STATIONS_DATA)} istasyon başarıyla yüklendi!")
-        return True
-        
-    except Exception as e:
-        print(f"❌ İstasyon yükleme hatası: {e}")
-        return False
-
-def get_station_by_id(station_id: int):
-    return STATIONS_BY_ID.get(station_id)
+# Sağlık kontrolü için son TCDD API sonuçları
+upstream_status = {"last_ok": None, "last_error": None, "error": None, "consecutive_errors": 0,
+                   "token_ok": None}
 
-def get_available_destinations(from_station_id: int):
-    from_station = get_station_by_id(from_station_id)
-    if not from_station or not from_station.get('pairs'):
-        return []
-    
-    destinations = []
-    for dest_id in from_station['pairs']:
-        dest_station = get_station_by_id(dest_id)
-        if dest_station:  # Hedef istasyonu varsa ekle
-            destinations.append(dest_station)
-    
-    # İsme göre sırala
-    destinations.sort(key=lambda x: x['name'])
-    return destinations
+def record_upstream_result(error: str = None):
+    if error is None:
+        upstream_status["last_ok"] = time.time()
+        upstream_status["consecutive_errors"] = 0
+    else:
+        upstream_status["last_error"] = time.time()
+        upstream_status["error"] = error
+        upstream_status["consecutive_errors"] += 1
 
-def get_active_stations():
-    """Varış yeri olan tüm istasyonları döndürür (pairs listesi dolu olanlar)"""
-    active_stations = [
-        station for station in STATIONS_DATA 
-        if station.get('pairs')  # Sadece hedef istasyonları olan istasyonları dahil et
-    ]
-    # İsme göre sırala
-    active_stations.sort(key=lambda x: x['name'])
-    return active_stations
+# Token her istekte yeniden kazınmaz; süresi dolana veya 401 alınana kadar paylaşılır
+TOKEN_TTL_SECONDS = int(os.getenv("TOKEN_TTL_SECONDS", "1800"))
+_token_cache = {"token": None, "fetched_at": 0.0}
+_token_lock = threading.Lock()
 
-def normalize_turkish(text: str) -> str:
+def get_cached_token(force_refresh: bool = False, rejected_token: str = None):
     """
-    Türkçe karakterleri ASCII karşılıklarına dönüştürür.
-    Bu sayede 'Eskisehir' yazarak 'Eskişehir' bulunabilir.
+    Paylaşılan token'ı döner. rejected_token: 401 alan token; önbellekte hâlâ o varsa
+    yenilenir, başka bir thread zaten yenilediyse yeni token kazınmadan kullanılır.
     """
-    if not text:
-        return ""
-    
-    # Trim and handle Turkish-specific casing before lowercasing
-    # to avoid 'i' + combining dot issue (U+0307)
-    text = text.strip().replace('İ', 'i').replace('I', 'ı')
-    result = text.lower()
-    
-    turkish_map = {
-        'ş': 's',
-        'ı': 'i',
-        'ğ': 'g',
-        'ü': 'u',
-        'ö': 'o',
-        'ç': 'c',
-        '\u0307': ''  # Remove combining dot if it survived anywhere
-    }
-    
-    for turkish_char, ascii_char in turkish_map.items():
-        result = result.replace(turkish_char, ascii_char)
-    
-    return result
+    with _token_lock:
+        age = time.monotonic() - _token_cache["fetched_at"]
+        stale = rejected_token is not None and _token_cache["token"] == rejected_token
+        if force_refresh or stale or not _token_cache["token"] or age > TOKEN_TTL_SECONDS:
+            token = get_dynamic_token()
+            upstream_status["token_ok"] = bool(token)
+            if not token:
+                return None
+            _token_cache["token"] = token
+            _token_cache["fetched_at"] = time.monotonic()
+        return _token_cache["token"]
 
-def get_train_type_display(raw_type: str) -> str:
+# Eşzamanlı istekler için bağlantı havuzu
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "8"))
+AVAILABILITY_URL = 'https://web-api-prod-ytp.tcddtasimacilik.gov.tr/tms/train/train-availability'
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=FETCH_CONCURRENCY * 2))
+fetch_executor = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="fetch")
+# İzleme sorguları sorgu bütçesinde beklerken thread tutar; kullanıcıya dönük sorguları bekletmesin diye ayrı havuz
+monitor_fetch_executor = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="monitor-fetch")
+
+# API yolcu tipi ID'leri (e-bilet web istemcisindeki yolcu seçimiyle aynı)
+PASSENGER_TYPES = {
+    0: "👤 Yetişkin",
+    1: "🧒 Çocuk",
+    2: "👴 65 Yaş Üstü",
+}
+DEFAULT_PASSENGERS = ((0, 1),)
+MAX_PASSENGERS = 6
+
+def normalize_passengers(passengers) -> tuple:
     """
-    API'den gelen tren tipi kodunu kullanıcı dostu isme çevirir.
-    Örn: 'YHT' -> 'YHT', 'AH' -> 'Kara Tren'
+    Yolcu dağılımını sıralı ((tip, adet), ...) biçimine getirir.
+    Sözlük veya JSON'dan gelen liste kabul edilir; boşsa tek yetişkin sayılır.
     """
-    type_map = {
-        'AH': 'Kara Tren',
-        'AHT': 'Kara Tren',
-    }
-    return type_map.get(raw_type, raw_type)
+    if not passengers:
+        return DEFAULT_PASSENGERS
+    items = passengers.items() if isinstance(passengers, dict) else passengers
+    counts = {}
+    for type_id, count in items:
+        if int(count) > 0:
+            counts[int(type_id)] = counts.get(int(type_id), 0) + int(count)
+    return tuple(sorted(counts.items())) or DEFAULT_PASSENGERS
 
-def search_stations(query: str, from_station_id: int = None) -> list:
+def passengers_key(passengers) -> str:
     """
-    İstasyonları arar. 
-    from_station_id verilirse sadece o istasyondan gidilebilecek hedefleri arar.
-    Türkçe karakter duyarsız arama yapar.
+    Paylaşılan sorgu anahtarı eki. Tek yetişkin varsayılan istekle aynı yanıtı
+    aldığından boş döner; böylece yolcu belirtmeyen işlerle aynı sorguyu paylaşır.
     """
-    query_normalized = normalize_turkish(query.strip())
-    
-    if from_station_id:
-        # Varış istasyonlarında ara
-        stations = get_available_destinations(from_station_id)
-    else:
-        # Kalkış istasyonlarında ara
-        stations = get_active_stations()
-    
-    # Arama yap - normalize edilmiş karşılaştırma
-    results = []
-    for station in stations:
-        station_name_normalized = normalize_turkish(station['name'])
-        if query_normalized in station_name_normalized:
-            results.append(station)
-    
-    # En fazla 10 sonuç döndür (Telegram buton limiti için)
-    return results[:10]
+    mix = normalize_passengers(passengers)
+    if mix == DEFAULT_PASSENGERS:
+        return ""
+    return ":" + ",".join(f"{type_id}x{count}" for type_id, count in mix)
 
-def create_search_result_keyboard(stations: list, action: str, from_station_id: int = None) -> InlineKeyboardMarkup:
-    keyboard = []
-    row = []
-    
-    if from_station_id:
-        prefix = f"to_{action}_{from_station_id}"
-    else:
-        prefix = f"from_{action}"
-    
-    for station in stations:
-        station_name = station['name'][:25]  # Uzun isimleri kısalt
-        callback_data = f"{prefix}_{station['id']}"
-        
-        row.append(InlineKeyboardButton(station_name, callback_data=callback_data))
-        
-        if len(row) == 2:
-            keyboard.append(row)
-            row = []
-    
-    if row:
-        keyboard.append(row)
-    
-    # İptal butonu ekle
-    keyboard.append([InlineKeyboardButton("❌ İptal", callback_data="cancel_search")])
-    
-    return InlineKeyboardMarkup(keyboard)
+def describe_passengers(passengers) -> str:
+    return ", ".join(f"{count} {PASSENGER_TYPES.get(type_id, str(type_id)).split(' ', 1)[-1]}"
+                     for type_id, count in normalize_passengers(passengers))
 
-def get_available_train_times(from_id: int, to_id: int, target_date: datetime) -> list:
+def fetch_train_availability(from_id: int, to_id: int, target_date: datetime, passengers=None):
     """
-    Seçilen güzergah ve tarihteki tren kalkış saatlerini döndürür.
-    Returns: [{"time": "08:00", "train_name": "YHT 1234"}, ...]
+    Sefer müsaitlik API'sini çağırır.
+    passengers: Yolcu dağılımı (None = tek yetişkin); müsaitlik ve fiyatı sunucu hesaplar.
+    Returns: (sefer grupları listesi, None) veya (None, hata mesajı)
     """
-    dynamic_token = get_dynamic_token()
-    if not dynamic_token:
-        return []
-    
-    headers = {
-        'Accept': 'application/json, text/plain, */*',
-        'Accept-Language': 'tr',
-        'Authorization': dynamic_token,
-        'Connection': 'keep-alive',
-        'Content-Type': 'application/json',
-        'Origin': 'https://ebilet.tcddtasimacilik.gov.tr',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-        'unit-id': '3895',
-    }
-    
     from_station = get_station_by_id(from_id)
     to_station = get_station_by_id(to_id)
     
     if not from_station or not to_station:
-        return []
-    
+        return (None, "❌ HATA: İstasyon bilgisi bulunamadı.")
+
     api_search_date = target_date - timedelta(days=1)
     date_str = api_search_date.strftime("%d-%m-%Y") + " 21:00:00"
-    
+
     json_data = {
         'searchRoutes': [
             {
@@ -318,274 +627,1714 @@ def get_available_train_times(from_id: int, to_id: int, target_date: datetime) -
                 'departureDate': date_str,
             },
         ],
-        'passengerTypeCounts': [{'id': 0, 'count': 1}],
+        'passengerTypeCounts': [{'id': type_id, 'count': count}
+                                for type_id, count in normalize_passengers(passengers)],
         'searchReservation': False,
         'searchType': 'DOMESTIC',
         'blTrainTypes': ['TURISTIK_TREN'],
     }
-    
+
     try:
-        response = requests.post(
-            'https://web-api-prod-ytp.tcddtasimacilik.gov.tr/tms/train/train-availability',
-            params=params,
-            headers=headers,
-            json=json_data,
-            timeout=15
-        )
-        
-        if response.status_code != 200:
-            return []
-        
+        dynamic_token = None
+        for attempt in range(2):
+            # Yeniden denemede sadece reddedilen token bildirilir; eşzamanlı 401'ler tek kazıma yapar
+            dynamic_token = get_cached_token(rejected_token=dynamic_token)
+            if not dynamic_token:
+                record_upstream_result("token alınamadı")
+                return (None, "❌ HATA: Dinamik Authorization Token'ı alınamadı.")
+            
+            headers = {
+                'Accept': 'application/json, text/plain, */*',
+                'Accept-Language': 'tr',
+                'Authorization': dynamic_token,
+                'Connection': 'keep-alive',
+                'Content-Type': 'application/json',
+                'Origin': 'https://ebilet.tcddtasimacilik.gov.tr',
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+                'unit-id': '3895',
+            }
+            
+            response = HTTP_SESSION.post(
+                AVAILABILITY_URL,
+                params=params,
+                headers=headers,
+                json=json_data,
+                timeout=15
+            )
+            
+            # Token süresi dolmuş olabilir: bir kez yenileyip tekrar dene
+            if response.status_code != 401:
+                break
+
+        if response.status_code == 401:
+            record_upstream_result("token geçersiz (401)")
+            return (None, "❌ HATA: API Token'ı geçersiz.")
+        elif response.status_code != 200:
+            record_upstream_result(f"HTTP {response.status_code}")
+            return (None, f"❌ HATA: API yanıtı beklenmedik. Durum: {response.status_code}")
+
         data = response.json()
-        sefer_gruplari = data.get("trainLegs", [{}])[0].get("trainAvailabilities", [])
+        sefer_gruplari = data["trainLegs"][0]["trainAvailabilities"]
+        record_upstream_result()
+        negative_routes.observe(route_key(from_id, to_id, target_date),
+                                any(sefer_grubu.get("trains") for sefer_grubu in sefer_gruplari))
         
-        train_times = []
-        for sefer_grubu in sefer_gruplari:
-            trenler = sefer_grubu.get("trains", [])
-            for tren in trenler:
-                try:
-                    timestamp_ms = tren["segments"][0]["departureTime"]
-                    timestamp_sn = timestamp_ms / 1000
-                    kalkis_saati = datetime.fromtimestamp(timestamp_sn).strftime("%H:%M")
-                    tren_adi = tren.get("trainName", "Tren")
-                    tren_tipi = tren.get("type", "")
-                    tren_tipi_gosterim = get_train_type_display(tren_tipi) if tren_tipi else ""
-                    train_times.append({
-                        "time": kalkis_saati,
-                        "train_name": tren_adi,
-                        "type": tren_tipi_gosterim
-                    })
-                except (KeyError, IndexError):
-                    continue
+        # Geçmiş tek yetişkin fiyatlarıyla tutarlı kalsın
+        if HISTORY_ENABLED and not passengers_key(passengers):
+            try:
+                record_poll_history(from_id, to_id, sefer_gruplari)
+            except Exception as e:
+                print(f"Geçmiş kaydı hatası: {e}")
         
-        train_times.sort(key=lambda x: x["time"])
-        return train_times
+        return (sefer_gruplari, None)
+
+    except Exception as e:
+        record_upstream_result(str(e))
+        return (None, f"❌ HATA: {e}")
+
+def fetch_routes_concurrently(routes: list, target_date: datetime, max_age: float = None,
+                              passengers=None, scheduled: bool = True) -> list:
+    """
+    Birden fazla güzergahı havuzdaki thread'lerle eşzamanlı sorgular.
+    max_age verilirse sonuçlar diğer işlerle paylaşılan önbellekten gelebilir;
+    scheduled ise (izleme sorguları) bütçe sırası ayrı havuzda beklenir.
+    Returns: routes ile aynı sırada [(sefer grupları, hata mesajı), ...]
+    """
+    if max_age is None:
+        futures = [fetch_executor.submit(fetch_train_availability, from_id, to_id, target_date, passengers)
+                   for from_id, to_id in routes]
+    else:
+        executor = monitor_fetch_executor if scheduled else fetch_executor
+        futures = [executor.submit(fetch_train_availability_cached, from_id, to_id, target_date,
+                                   max_age, passengers, scheduled)
+                   for from_id, to_id in routes]
+    return [future.result() for future in futures]
+
+# Sefer geçmişi: her API yanıtındaki tren/vagon koltuk sayıları ve fiyatları
+# kolon bazlı, sadece eklenen segment dosyalarında tutulur.
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "1") == "1"
+HISTORY_DIR = os.getenv("HISTORY_DIR", "poll_history")
+HISTORY_SEGMENT_ROWS = 1 << 16
+HISTORY_COLUMNS = (
+    ("ts", "q"),         # Ölçüm zamanı (epoch sn)
+    ("departure", "q"),  # Kalkış zamanı (epoch sn)
+    ("train", "q"),      # Tren adı özeti (crc32)
+    ("cabin", "i"),      # API vagon sınıfı ID'si
+    ("seats", "i"),      # Boş koltuk sayısı
+    ("price", "f"),      # Minimum fiyat (TRY)
+)
+HISTORY_LEAD_HOURS = (1, 3, 6, 12, 24, 48, 72)
+# Saklama: son ölçümü bu kadar günden eski segmentler ve güzergah başına en yeni
+# HISTORY_MAX_SEGMENTS dışındakiler silinir (0 = sınırsız)
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "60"))
+HISTORY_MAX_SEGMENTS = int(os.getenv("HISTORY_MAX_SEGMENTS", "16"))
+HISTORY_PRUNE_SECONDS = 3600
+
+class PollHistoryStore:
+    """
+    Güzergah başına kolon bazlı geçmiş deposu.
+    Her güzergah klasöründe sabit boyutlu segmentler, her segmentte kolon
+    başına bir dosya bulunur. Sorgular segmentleri tek tek mmap ile açar;
+    tüm geçmiş belleğe yüklenmez. numpy varsa toplama işlemleri vektörel yapılır.
+    """
+
+    def __init__(self, base_dir: str, segment_rows: int = HISTORY_SEGMENT_ROWS,
+                 retention_days: int = HISTORY_RETENTION_DAYS, max_segments: int = HISTORY_MAX_SEGMENTS):
+        self.base_dir = base_dir
+        self.segment_rows = segment_rows
+        self.retention_days = retention_days
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self._pruned_at = 0.0
+
+    def _route_dir(self, from_id: int, to_id: int) -> str:
+        return os.path.join(self.base_dir, f"{from_id}_{to_id}")
+
+    def segments(self, from_id: int, to_id: int) -> list:
+        route_dir = self._route_dir(from_id, to_id)
+        try:
+            names = sorted(name for name in os.listdir(route_dir) if name.startswith("seg_"))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(route_dir, name) for name in names]
+
+    def _segment_rows(self, segment_dir: str) -> int:
+        # Yarım kalan yazımlarda kolonlar arasında en kısa olan geçerlidir
+        rows = None
+        for name, typecode in HISTORY_COLUMNS:
+            try:
+                size = os.path.getsize(os.path.join(segment_dir, f"{name}.{typecode}"))
+            except OSError:
+                return 0
+            count = size // array(typecode).itemsize
+            rows = count if rows is None else min(rows, count)
+        return rows or 0
+
+    def _segment_last_ts(self, segment_dir: str):
+        """Segmentteki son ölçüm zamanı (satırlar zaman sırasıyla eklenir)"""
+        rows = self._segment_rows(segment_dir)
+        if not rows:
+            return None
+        itemsize = array("q").itemsize
+        with open(os.path.join(segment_dir, "ts.q"), "rb") as f:
+            f.seek((rows - 1) * itemsize)
+            return array("q", f.read(itemsize))[0]
+
+    def prune(self) -> int:
+        """
+        Saklama süresini aşan ve güzergah başına segment sınırının dışında kalan
+        segmentleri siler; boşalan güzergah klasörlerini de kaldırır.
+        Returns: silinen segment sayısı
+        """
+        cutoff = time.time() - self.retention_days * 86400 if self.retention_days > 0 else None
+        removed = 0
+        try:
+            route_names = os.listdir(self.base_dir)
+        except FileNotFoundError:
+            return 0
+        for route_name in route_names:
+            route_dir = os.path.join(self.base_dir, route_name)
+            if not os.path.isdir(route_dir):
+                continue
+            segments = sorted(name for name in os.listdir(route_dir) if name.startswith("seg_"))
+            expired = segments[:-self.max_segments] if self.max_segments > 0 else []
+            for name in segments[len(expired):]:
+                last_ts = self._segment_last_ts(os.path.join(route_dir, name))
+                if cutoff is None or (last_ts is not None and last_ts >= cutoff):
+                    break  # Sonraki segmentler daha yeni
+                expired.append(name)
+            for name in expired:
+                shutil.rmtree(os.path.join(route_dir, name), ignore_errors=True)
+                removed += 1
+            if len(expired) == len(segments):
+                shutil.rmtree(route_dir, ignore_errors=True)
+        if removed:
+            print(f"Geçmiş temizlendi: {removed} eski segment silindi.")
+        return removed
+
+    def append(self, from_id: int, to_id: int, rows: list):
+        """rows: [(ts, departure, train, cabin, seats, price), ...]"""
+        with self._lock:
+            if time.monotonic() - self._pruned_at >= HISTORY_PRUNE_SECONDS:
+                self._pruned_at = time.monotonic()
+                self.prune()
+            segments = self.segments(from_id, to_id)
+            segment_dir = segments[-1] if segments else None
+            if segment_dir is None or self._segment_rows(segment_dir) + len(rows) > self.segment_rows:
+                # Eski segmentler silinmiş olabilir; numara sayıdan değil son segmentten devam eder
+                next_index = int(os.path.basename(segment_dir)[4:]) + 1 if segment_dir else 0
+                segment_dir = os.path.join(self._route_dir(from_id, to_id), f"seg_{next_index:06d}")
+                os.makedirs(segment_dir, exist_ok=True)
+            
+            for index, (name, typecode) in enumerate(HISTORY_COLUMNS):
+                column = array(typecode, (row[index] for row in rows))
+                with open(os.path.join(segment_dir, f"{name}.{typecode}"), "ab") as f:
+                    f.write(column.tobytes())
+
+    def _iter_segment_columns(self, from_id: int, to_id: int):
+        """Her segment için {kolon: numpy dizisi veya memoryview} döndürür."""
+        np = load_numpy()
+        for segment_dir in self.segments(from_id, to_id):
+            rows = self._segment_rows(segment_dir)
+            if not rows:
+                continue
+            columns = {}
+            handles = []
+            try:
+                for name, typecode in HISTORY_COLUMNS:
+                    path = os.path.join(segment_dir, f"{name}.{typecode}")
+                    if np is not None:
+                        columns[name] = np.memmap(path, dtype=np.dtype(typecode), mode="r", shape=(rows,))
+                    else:
+                        f = open(path, "rb")
+                        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                        raw = memoryview(mapped)[:rows * array(typecode).itemsize]
+                        columns[name] = raw.cast(typecode)
+                        handles.append((f, mapped, raw))
+                yield rows, columns
+            finally:
+                for view in columns.values():
+                    if isinstance(view, memoryview):
+                        view.release()
+                for f, mapped, raw in handles:
+                    raw.release()
+                    mapped.close()
+                    f.close()
+
+    def row_count(self, from_id: int, to_id: int) -> int:
+        return sum(self._segment_rows(segment_dir) for segment_dir in self.segments(from_id, to_id))
+
+    def release_hour_histogram(self, from_id: int, to_id: int) -> list:
+        """
+        Koltuk sayısının arttığı (yer açıldığı) ölçümleri İstanbul saatine göre sayar.
+        Segmentler zaman sırasıyla gezilir; her serinin önceki segmentteki son ölçümü
+        taşınır, böylece segment değişimine denk gelen yer açılmaları da sayılır.
+        Returns: 24 elemanlı liste
+        """
+        histogram = [0] * 24
+        last_seats = {}  # {(kalkış, tren, vagon): son koltuk sayısı}
+        np = load_numpy()
+        for rows, c in self._iter_segment_columns(from_id, to_id):
+            if np is not None:
+                order = np.lexsort((c["ts"], c["cabin"], c["train"], c["departure"]))
+                ts = c["ts"][order]
+                seats = c["seats"][order].astype(np.int64)
+                departure, train, cabin = c["departure"][order], c["train"][order], c["cabin"][order]
+                same_series = ((departure[1:] == departure[:-1]) &
+                               (train[1:] == train[:-1]) &
+                               (cabin[1:] == cabin[:-1]))
+                released = same_series & (np.diff(seats) > 0)
+                hours = ((ts[1:][released] + ISTANBUL_UTC_OFFSET_SECONDS) // 3600) % 24
+                histogram = [a + int(b) for a, b in zip(histogram, np.bincount(hours, minlength=24))]
+                
+                # Serinin bu segmentteki ilk ölçümü önceki segmentin son ölçümüyle karşılaştırılır
+                starts = np.ones(rows, dtype=bool)
+                starts[1:] = ~same_series
+                for i in np.flatnonzero(starts):
+                    previous = last_seats.get((int(departure[i]), int(train[i]), int(cabin[i])))
+                    if previous is not None and seats[i] > previous:
+                        histogram[((int(ts[i]) + ISTANBUL_UTC_OFFSET_SECONDS) // 3600) % 24] += 1
+                ends = np.ones(rows, dtype=bool)
+                ends[:-1] = ~same_series
+                for i in np.flatnonzero(ends):
+                    last_seats[(int(departure[i]), int(train[i]), int(cabin[i]))] = int(seats[i])
+            else:
+                order = sorted(range(rows), key=lambda i: c["ts"][i])
+                for i in order:
+                    key = (c["departure"][i], c["train"][i], c["cabin"][i])
+                    previous = last_seats.get(key)
+                    if previous is not None and c["seats"][i] > previous:
+                        histogram[((c["ts"][i] + ISTANBUL_UTC_OFFSET_SECONDS) // 3600) % 24] += 1
+                    last_seats[key] = c["seats"][i]
+        return histogram
+
+    def seat_probability_by_lead(self, from_id: int, to_id: int, lead_hours: tuple = HISTORY_LEAD_HOURS) -> dict:
+        """
+        Kalkıştan N saat önce (±30 dk) yapılan ölçümlerde boş yer bulunma oranı.
+        Returns: {N: (oran, örnek sayısı)}
+        """
+        totals = {hours: [0, 0] for hours in lead_hours}  # {N: [boş yer olan, toplam]}
+        np = load_numpy()
+        for rows, c in self._iter_segment_columns(from_id, to_id):
+            if np is not None:
+                lead = (c["departure"] - c["ts"]) / 3600.0
+                available = c["seats"] > 0
+                for hours in lead_hours:
+                    window = np.abs(lead - hours) <= 0.5
+                    totals[hours][0] += int(np.count_nonzero(available & window))
+                    totals[hours][1] += int(np.count_nonzero(window))
+            else:
+                for i in range(rows):
+                    lead = (c["departure"][i] - c["ts"][i]) / 3600.0
+                    for hours in lead_hours:
+                        if abs(lead - hours) <= 0.5:
+                            totals[hours][0] += c["seats"][i] > 0
+                            totals[hours][1] += 1
+        return {hours: ((hit / total) if total else None, total) for hours, (hit, total) in totals.items()}
+
+poll_history = PollHistoryStore(HISTORY_DIR)
+
+def record_poll_history(from_id: int, to_id: int, sefer_gruplari: list):
+    """API yanıtındaki tüm tren/vagon koltuk ve fiyat bilgilerini geçmişe ekler."""
+    ts = int(time.time())
+    rows = []
+    for sefer_grubu in sefer_gruplari:
+        for tren in sefer_grubu.get("trains") or []:
+            try:
+                departure = tren["segments"][0]["departureTime"] // 1000
+                train_key = zlib.crc32(tren.get("trainName", "").encode())
+                for vagon in tren["availableFareInfo"][0]["cabinClasses"]:
+                    rows.append((ts, departure, train_key, vagon["cabinClass"].get("id", 0),
+                                 vagon["availabilityCount"], float(vagon.get("minPrice") or 0)))
+            except (KeyError, IndexError, TypeError):
+                continue
+    if rows:
+        poll_history.append(from_id, to_id, rows)
+
+# Aynı (güzergah, tarih) için kısa süreli sonuç önbelleği
+ROUTE_CACHE_TTL_SECONDS = int(os.getenv("ROUTE_CACHE_TTL_SECONDS", "120"))
+route_cache = ExpiringDict(maxsize=1000, ttl_seconds=ROUTE_CACHE_TTL_SECONDS)  # {key: (zaman, sonuç)}
+
+_inflight_fetches = {}  # {route_key: Future} - sürmekte olan sorgular
+_inflight_lock = threading.Lock()
+
+# Seferi olmayan (güzergah, tarih) için üstel geri çekilme
+NEGATIVE_BACKOFF_BASE_SECONDS = int(os.getenv("NEGATIVE_BACKOFF_BASE_SECONDS", "300"))
+NEGATIVE_BACKOFF_CAP_SECONDS = int(os.getenv("NEGATIVE_BACKOFF_CAP_SECONDS", "3600"))
+
+class NegativeRouteCache:
+    """
+    Sefer listesi boş dönen (güzergah, tarih) anahtarlarını hatırlar.
+    Boş yanıt art arda geldikçe bekleme süresi ikiye katlanır (tavana kadar);
+    aynı anahtarı izleyen tüm işler bu süreyi paylaşır. Herhangi bir sorguda
+    sefer görülmesi veya katalogda güzergahın yeni belirmesi kaydı siler.
+    """
+
+    def __init__(self, base_seconds: int, cap_seconds: int):
+        self.base_seconds = base_seconds
+        self.cap_seconds = cap_seconds
+        self._entries = {}  # {route_key: (sonraki sorgu zamanı (monotonic), bekleme sn)}
+        self._lock = threading.Lock()
+        self.skipped = 0
+
+    def blocked(self, key: str) -> bool:
+        """Anahtar bekleme süresindeyse True (sorgu atlanmalı)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() < entry[0]:
+                self.skipped += 1
+                return True
+            return False
+
+    def observe(self, key: str, has_trains: bool):
+        with self._lock:
+            if has_trains:
+                self._entries.pop(key, None)
+                return
+            previous = self._entries.get(key)
+            backoff = min(self.cap_seconds, previous[1] * 2) if previous else self.base_seconds
+            self._entries[key] = (time.monotonic() + backoff, backoff)
+        print(f"Sefer yok: {key}, sonraki sorgu {backoff} sn sonra.")
+
+    def invalidate_new_pairs(self, previous_pairs: dict):
+        """Katalog yenilenince önceden listede olmayıp yeni beliren güzergahların kayıtlarını siler."""
+        with self._lock:
+            for key in list(self._entries):
+                from_id, to_id, _ = key.split(":", 2)
+                station = STATIONS_BY_ID.get(int(from_id)) or {}
+                if (int(to_id) in (station.get('pairs') or [])
+                        and int(to_id) not in previous_pairs.get(int(from_id), ())):
+                    del self._entries[key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+negative_routes = NegativeRouteCache(NEGATIVE_BACKOFF_BASE_SECONDS, NEGATIVE_BACKOFF_CAP_SECONDS)
+
+class FairPollScheduler:
+    """
+    İzleme sorgularını paylaşılan dakikalık bütçeye göre sıraya koyar.
+    Her güzergah anahtarı bir akıştır; bekleyen akışlar deficit round-robin ile
+    hizmet alır. Akışın her turdaki payı abone iş sayısı ve kalkışa yakınlıkla
+    ağırlıklanır, böylece çok iş açan bir sohbet diğer güzergahları aç bırakamaz.
+    """
+
+    def __init__(self, polls_per_minute: int):
+        self.polls_per_minute = polls_per_minute
+        self._cond = threading.Condition()
+        self._flows = OrderedDict()  # {anahtar: {"waiters": deque, "deficit": float, "weight": float}}
+        self._job_keys = {}  # {job_id: anahtarlar} - abone sayısı bundan hesaplanır
+        self._subscribers = {}  # {anahtar: abone iş sayısı}
+        self._next_grant = 0.0
+        self._dispatcher = None
+        self.granted = 0
+
+    def subscribe(self, job_id: int, keys: list):
+        with self._cond:
+            self._unsubscribe_locked(job_id)
+            self._job_keys[job_id] = keys
+            for key in keys:
+                self._subscribers[key] = self._subscribers.get(key, 0) + 1
+
+    def unsubscribe(self, job_id: int):
+        with self._cond:
+            self._unsubscribe_locked(job_id)
+
+    def _unsubscribe_locked(self, job_id: int):
+        for key in self._job_keys.pop(job_id, ()):
+            self._subscribers[key] -= 1
+            if not self._subscribers[key]:
+                del self._subscribers[key]
+
+    def weight(self, key: str, target_date: datetime) -> float:
+        """Abone sayısı x yakınlık: 24 saat içindeki kalkışlar 3, 3 gün içindekiler 2 kat pay alır."""
+        hours_left = (istanbul_day_start(target_date) + 86400 - time.time()) / 3600
+        proximity = 3 if hours_left <= 24 else 2 if hours_left <= 72 else 1
+        return max(1, self._subscribers.get(key, 0)) * proximity
+
+    def queue_length(self) -> int:
+        with self._cond:
+            return sum(len(flow["waiters"]) for flow in self._flows.values())
+
+    def acquire(self, key: str, target_date: datetime):
+        """Bu akış için sorgu izni verilene kadar bekler (bütçe kapalıysa hemen döner)."""
+        if self.polls_per_minute <= 0:
+            return
+        ticket = threading.Event()
+        with self._cond:
+            flow = self._flows.get(key)
+            if flow is None:
+                flow = self._flows[key] = {"waiters": deque(), "deficit": 0.0}
+            flow["weight"] = self.weight(key, target_date)
+            flow["waiters"].append(ticket)
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name="poll-scheduler", daemon=True)
+                self._dispatcher.start()
+            self._cond.notify()
+        ticket.wait()
+
+    def _dispatch(self):
+        while True:
+            # Dakikalık bütçe: izinler eşit aralıklarla verilir
+            delay = self._next_grant - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            
+            with self._cond:
+                while not self._flows:
+                    self._cond.wait()
+                
+                # Deficit round-robin: sıradaki akış ağırlığı oranında pay biriktirir,
+                # 1 birikince izin alır. En ağır akış her ziyarette tam pay alır.
+                top_weight = max(flow["weight"] for flow in self._flows.values())
+                while True:
+                    key, flow = next(iter(self._flows.items()))
+                    flow["deficit"] += flow["weight"] / top_weight
+                    if flow["deficit"] >= 1:
+                        break
+                    self._flows.move_to_end(key)
+                flow["deficit"] -= 1
+                ticket = flow["waiters"].popleft()
+                if flow["waiters"]:
+                    self._flows.move_to_end(key)
+                else:
+                    # Boşalan akış payını biriktiremez
+                    del self._flows[key]
+            
+            self._next_grant = max(self._next_grant, time.monotonic()) + 60.0 / self.polls_per_minute
+            self.granted += 1
+            ticket.set()
+
+poll_scheduler = FairPollScheduler(UPSTREAM_POLLS_PER_MINUTE)
+
+def fetch_train_availability_cached(from_id: int, to_id: int, target_date: datetime,
+                                    max_age: float = ROUTE_CACHE_TTL_SECONDS, passengers=None,
+                                    scheduled: bool = True):
+    """
+    fetch_train_availability ile aynı; başarılı sonuçları max_age saniye boyunca tekrar kullanır.
+    Aynı (güzergah, tarih, yolcu dağılımı) için süren bir sorgu varsa yenisi açılmaz, onun sonucu beklenir.
+    scheduled=False: kullanıcının anlık beklediği sorgular izleme bütçesinde sıraya girmez.
+    """
+    key = route_key(from_id, to_id, target_date) + passengers_key(passengers)
+    cached = route_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] <= max_age:
+        return cached[1]
+    
+    # Seferi olmadığı bilinen güzergah: bekleme bitene kadar boş sonuç (yolcu dağılımından bağımsız)
+    if negative_routes.blocked(route_key(from_id, to_id, target_date)):
+        result = ([], None)
+        route_cache[key] = (time.monotonic(), result)
+        return result
+    
+    with _inflight_lock:
+        future = _inflight_fetches.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = Future()
+            _inflight_fetches[key] = future
+    
+    if not is_owner:
+        return future.result()
+    
+    result = (None, "❌ HATA: Sorgu tamamlanamadı.")
+    try:
+        if scheduled:
+            poll_scheduler.acquire(key, target_date)
+        result = fetch_train_availability(from_id, to_id, target_date, passengers)
+        if result[1] is None:
+            route_cache[key] = (time.monotonic(), result)
+    finally:
+        with _inflight_lock:
+            _inflight_fetches.pop(key, None)
+        future.set_result(result)
+    return result
+
+def projected_sales_opening(target_date: datetime) -> int:
+    """Tarihin satışa açılması beklenen an (epoch sn): ufka girdiği günün İstanbul 00:00'ı"""
+    return istanbul_day_start(target_date) - (SALES_HORIZON_DAYS - 1) * 86400
+
+def prewarm_upstream():
+    """
+    Beklenen açılıştan önce token'ı yeniler; açılış anındaki sorgular token almak için beklemez.
+    Bağlantı havuzundaki keep-alive bağlantı sık yoklamalarla zaten sıcak tutulur.
+    """
+    if get_cached_token(force_refresh=True):
+        print("Satış açılışı için token yenilendi.")
+
+class SalesWindowWatcher:
+    """
+    Satışa henüz açılmamış (güzergah, tarih) anahtarlarını bekleyen işler adına yoklar.
+    Aynı anahtarı bekleyen tüm işler tek yoklamayı paylaşır. Yoklama normalde
+    SALES_PROBE_SECONDS'ta bir yapılır, beklenen açılış çevresinde sıklaşır.
+    Sefer görülünce sonuç önbelleğe konur ve bekleyen işlerin olayları tetiklenir.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._watches = {}  # {route_key: {"route", "target_date", "jobs": {job_id: Event}, "next_probe", "prewarmed"}}
+        self._thread = None
+        self.probes = 0
+
+    def watch(self, job_id: int, routes: list, target_date: datetime) -> threading.Event:
+        """İşi güzergahların satış açılışına abone eder; herhangi biri açılınca olay tetiklenir."""
+        opened = threading.Event()
+        with self._cond:
+            for from_id, to_id in routes:
+                key = route_key(from_id, to_id, target_date)
+                watch = self._watches.get(key)
+                if watch is None:
+                    # Yeni anahtar hemen bir kez yoklanır (tarih zaten açılmış olabilir)
+                    watch = self._watches[key] = {"route": (from_id, to_id), "target_date": target_date,
+                                                  "jobs": {}, "next_probe": time.time(), "prewarmed": False}
+                watch["jobs"][job_id] = opened
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sales-watcher", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return opened
+
+    def unwatch(self, job_id: int, opened: threading.Event):
+        """Aboneliği kaldırır; watchdog işi yeniden başlattıysa yeni thread'in kaydına dokunmaz."""
+        with self._cond:
+            for key in list(self._watches):
+                jobs = self._watches[key]["jobs"]
+                if jobs.get(job_id) is opened:
+                    del jobs[job_id]
+                if not jobs:
+                    del self._watches[key]
+
+    def waiting(self, job_id: int) -> bool:
+        with self._cond:
+            return any(job_id in watch["jobs"] for watch in self._watches.values())
+
+    def __len__(self) -> int:
+        return len(self._watches)
+
+    @staticmethod
+    def probe_delay(target_date: datetime) -> float:
+        opening = projected_sales_opening(target_date)
+        now = time.time()
+        fast_from = opening - SALES_FAST_PROBE_LEAD_SECONDS
+        if fast_from <= now <= opening + SALES_FAST_PROBE_TAIL_SECONDS:
+            return SALES_FAST_PROBE_SECONDS
+        if now < fast_from:
+            # Seyrek yoklama sık pencerenin başını kaçırmasın
+            return max(SALES_FAST_PROBE_SECONDS, min(SALES_PROBE_SECONDS, fast_from - now))
+        return SALES_PROBE_SECONDS
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._watches:
+                    self._cond.wait()
+                key, watch = min(self._watches.items(), key=lambda item: item[1]["next_probe"])
+                delay = watch["next_probe"] - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                watch["next_probe"] = time.time() + self.probe_delay(watch["target_date"])
+                prewarm = (not watch["prewarmed"]
+                           and time.time() >= projected_sales_opening(watch["target_date"]) - SALES_FAST_PROBE_LEAD_SECONDS)
+                watch["prewarmed"] = watch["prewarmed"] or prewarm
+            try:
+                if prewarm:
+                    prewarm_upstream()
+                self._probe(key, watch)
+            except Exception as e:
+                print(f"Satış penceresi yoklama hatası ({key}): {e}")
+
+    def _probe(self, key: str, watch: dict):
+        from_id, to_id = watch["route"]
+        poll_scheduler.acquire(key, watch["target_date"])
+        result = fetch_train_availability(from_id, to_id, watch["target_date"])
+        self.probes += 1
+        if result[1] is not None or not any(group.get("trains") for group in result[0]):
+            return
+        
+        # İlk kontrol tek yetişkin sorgusunu yeniden atmadan bu sonucu kullanır
+        route_cache[key] = (time.monotonic(), result)
+        with self._cond:
+            watch = self._watches.pop(key, None)
+        if watch is None:
+            return
+        print(f"Satış açıldı: {key}, bekleyen iş: {len(watch['jobs'])}")
+        for opened in watch["jobs"].values():
+            opened.set()
+
+sales_watcher = SalesWindowWatcher()
+
+def load_stations():
+    global STATIONS_DATA, STATIONS_BY_ID
+    
+    headers = {
+        'Accept': 'application/json, text/plain, */*',
+        'Accept-Language': 'tr',
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+        'Referer': 'https://ebilet.tcddtasimacilik.gov.tr/',
+        'unit-id': '3895',
+    }
+    
+    url = 'https://cdn-api-prod-ytp.tcddtasimacilik.gov.tr/datas/station-pairs-INTERNET.json'
+    
+    try:
+        print("🚂 İstasyonlar yükleniyor...")
+        response = requests.get(url, params=params, headers=headers, timeout=15)
         
+        if response.status_code != 200:
+            print(f"❌ İstasyon listesi alınamadı. Durum: {response.status_code}")
+            return False
+        
+        STATIONS_DATA = response.json()
+        
+        previous_pairs = {station_id: set(station.get('pairs') or []) for station_id, station in STATIONS_BY_ID.items()}
+        for station in STATIONS_DATA:
+            STATIONS_BY_ID[station['id']] = station
+        
+        build_station_groups()
+        build_pairs_graph()
+        negative_routes.invalidate_new_pairs(previous_pairs)
+        
+        print(f"✅ {len(STATIONS_DATA)} istasyon başarıyla yüklendi! ({len(STATION_GROUPS)} şehir grubu)")
+        return True
+        
+    except Exception as e:
+        print(f"❌ İstasyon yükleme hatası: {e}")
+        return False
+
+def station_group_key(name: str) -> str:
+    """
+    İstasyon adından şehir anahtarı çıkarır.
+    Örn: 'İSTANBUL(PENDİK)' -> 'istanbul', 'ANKARA GAR' -> 'ankara'
+    """
+    normalized = normalize_turkish(name)
+    return re.split(r'[\s(/-]+', normalized, maxsplit=1)[0]
+
+def load_station_group_overrides() -> dict:
+    """
+    Yerel grup tanımlarını okur: {"Grup Adı": [istasyon id veya adı, ...]}
+    Boş liste verilen grup otomatik gruplardan çıkarılır.
+    """
+    try:
+        with open(STATION_GROUPS_FILE, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
     except Exception as e:
-        print(f"Tren saatleri alınırken hata: {e}")
+        print(f"⚠️ İstasyon grup dosyası okunamadı ({STATION_GROUPS_FILE}): {e}")
+        return {}
+
+def build_station_groups():
+    """
+    Katalogdaki istasyonları normalize edilmiş ada göre şehir gruplarına ayırır.
+    Sadece birden fazla istasyonu olan gruplar tutulur; yerel dosya otomatik grupları ezer.
+    """
+    groups = {}
+    for station in STATIONS_DATA:
+        key = station_group_key(station['name'])
+        if key:
+            # Görünen ad katalogdaki yazımla aynı kalsın (örn: 'İSTANBUL')
+            display_name = re.split(r'[\s(/-]+', station['name'].strip(), maxsplit=1)[0]
+            groups.setdefault(key, {"name": display_name, "station_ids": []})["station_ids"].append(station['id'])
+    
+    groups = {key: group for key, group in groups.items() if len(group["station_ids"]) > 1}
+    
+    ids_by_name = {normalize_turkish(station['name']): station['id'] for station in STATIONS_DATA}
+    for group_name, members in load_station_group_overrides().items():
+        key = normalize_turkish(group_name)
+        station_ids = []
+        for member in members:
+            station_id = member if isinstance(member, int) else ids_by_name.get(normalize_turkish(str(member)))
+            if station_id in STATIONS_BY_ID:
+                station_ids.append(station_id)
+        if station_ids:
+            groups[key] = {"name": group_name, "station_ids": station_ids}
+        else:
+            groups.pop(key, None)
+    
+    STATION_GROUPS.clear()
+    STATION_GROUPS.update(groups)
+    for station in STATIONS_DATA:
+        station.pop('group', None)
+    for key, group in groups.items():
+        for station_id in group["station_ids"]:
+            STATIONS_BY_ID[station_id]['group'] = key
+
+def search_station_groups(query: str, candidate_ids: list) -> list:
+    """
+    Sorguya uyan şehir gruplarını, sadece aday istasyonlarla sınırlayarak döndürür.
+    Returns: [{"name": "İstanbul", "station_ids": [...]}, ...]
+    """
+    query_normalized = normalize_turkish(query.strip())
+    candidates = set(candidate_ids)
+    results = []
+    for key, group in STATION_GROUPS.items():
+        if query_normalized not in key and query_normalized not in normalize_turkish(group["name"]):
+            continue
+        station_ids = [station_id for station_id in group["station_ids"] if station_id in candidates]
+        if len(station_ids) > 1:
+            results.append({"name": group["name"], "station_ids": station_ids})
+    return results
+
+def build_pairs_graph():
+    """
+    'pairs' listelerinden CSR biçiminde kompakt bir komşuluk yapısı kurar.
+    PAIRS_GRAPH["offsets"][i]:PAIRS_GRAPH["offsets"][i+1] aralığı, i. istasyonun
+    sıralı hedef indekslerini PAIRS_GRAPH["targets"] içinde gösterir.
+    """
+    station_ids = array('i', sorted(STATIONS_BY_ID))
+    index_by_id = {station_id: i for i, station_id in enumerate(station_ids)}
+    offsets = array('i', [0])
+    targets = array('i')
+    for station_id in station_ids:
+        row = sorted({index_by_id[dest_id] for dest_id in STATIONS_BY_ID[station_id].get('pairs') or []
+                      if dest_id in index_by_id})
+        targets.extend(row)
+        offsets.append(len(targets))
+    
+    PAIRS_GRAPH.update({
+        "station_ids": station_ids,
+        "index_by_id": index_by_id,
+        "offsets": offsets,
+        "targets": targets,
+    })
+
+def _graph_neighbors(index: int):
+    offsets = PAIRS_GRAPH["offsets"]
+    return PAIRS_GRAPH["targets"][offsets[index]:offsets[index + 1]]
+
+def _graph_has_edge(src: int, dst: int) -> bool:
+    offsets = PAIRS_GRAPH["offsets"]
+    targets = PAIRS_GRAPH["targets"]
+    lo, hi = offsets[src], offsets[src + 1]
+    pos = bisect.bisect_left(targets, dst, lo, hi)
+    return pos < hi and targets[pos] == dst
+
+def find_transfer_stations(from_id: int, to_id: int) -> list:
+    """A'dan gidilebilen ve B'ye doğrudan seferi olan aktarma istasyonlarını döndürür."""
+    index_by_id = PAIRS_GRAPH.get("index_by_id") or {}
+    if from_id not in index_by_id or to_id not in index_by_id:
+        return []
+    src, dst = index_by_id[from_id], index_by_id[to_id]
+    station_ids = PAIRS_GRAPH["station_ids"]
+    return [station_ids[mid] for mid in _graph_neighbors(src)
+            if mid != dst and _graph_has_edge(mid, dst)]
+
+def get_two_hop_destinations(from_station_id: int) -> list:
+    """Doğrudan veya tek aktarmayla gidilebilecek istasyonlar."""
+    index_by_id = PAIRS_GRAPH.get("index_by_id") or {}
+    if from_station_id not in index_by_id:
+        return []
+    src = index_by_id[from_station_id]
+    reachable = set()
+    for mid in _graph_neighbors(src):
+        reachable.add(mid)
+        reachable.update(_graph_neighbors(mid))
+    reachable.discard(src)
+    station_ids = PAIRS_GRAPH["station_ids"]
+    return sorted((STATIONS_BY_ID[station_ids[i]] for i in reachable), key=lambda x: x['name'])
+
+def get_station_by_id(station_id: int):
+    return STATIONS_BY_ID.get(station_id)
+
+def station_names(station_ids: list) -> str:
+    return ", ".join(get_station_by_id(station_id)['name'] for station_id in station_ids)
+
+def get_available_destinations(from_station_id: int):
+    from_station = get_station_by_id(from_station_id)
+    if not from_station or not from_station.get('pairs'):
         return []
+    
+    destinations = []
+    for dest_id in from_station['pairs']:
+        dest_station = get_station_by_id(dest_id)
+        if dest_station:  # Hedef istasyonu varsa ekle
+            destinations.append(dest_station)
+    
+    # İsme göre sırala
+    destinations.sort(key=lambda x: x['name'])
+    return destinations
 
-def create_time_selection_keyboard(available_times: list, selected_times: list, callback_prefix: str) -> InlineKeyboardMarkup:
+def get_active_stations():
+    """Varış yeri olan tüm istasyonları döndürür (pairs listesi dolu olanlar)"""
+    active_stations = [
+        station for station in STATIONS_DATA 
+        if station.get('pairs')  # Sadece hedef istasyonları olan istasyonları dahil et
+    ]
+    # İsme göre sırala
+    active_stations.sort(key=lambda x: x['name'])
+    return active_stations
+
+def normalize_turkish(text: str) -> str:
     """
-    Saat seçim klavyesi oluşturur.
-    Seçilen saatler ✅ ile işaretlenir.
+    Türkçe karakterleri ASCII karşılıklarına dönüştürür.
+    Bu sayede 'Eskisehir' yazarak 'Eskişehir' bulunabilir.
+    """
+    if not text:
+        return ""
+    
+    # Trim and handle Turkish-specific casing before lowercasing
+    # to avoid 'i' + combining dot issue (U+0307)
+    text = text.strip().replace('İ', 'i').replace('I', 'ı')
+    result = text.lower()
+    
+    turkish_map = {
+        'ş': 's',
+        'ı': 'i',
+        'ğ': 'g',
+        'ü': 'u',
+        'ö': 'o',
+        'ç': 'c',
+        '\u0307': ''  # Remove combining dot if it survived anywhere
+    }
+    
+    for turkish_char, ascii_char in turkish_map.items():
+        result = result.replace(turkish_char, ascii_char)
+    
+    return result
+
+def get_train_type_display(raw_type: str) -> str:
+    """
+    API'den gelen tren tipi kodunu kullanıcı dostu isme çevirir.
+    Örn: 'YHT' -> 'YHT', 'AH' -> 'Kara Tren'
+    """
+    type_map = {
+        'AH': 'Kara Tren',
+        'AHT': 'Kara Tren',
+    }
+    return type_map.get(raw_type, raw_type)
+
+def get_available_destinations_for(from_station_ids: list):
+    """Birden fazla kalkış istasyonundan gidilebilecek hedeflerin birleşimi."""
+    destinations = {}
+    for from_station_id in from_station_ids:
+        for station in get_available_destinations(from_station_id):
+            destinations[station['id']] = station
+    return sorted(destinations.values(), key=lambda x: x['name'])
+
+def search_stations(query: str, from_station_id: int = None, from_station_ids: list = None,
+                    stations: list = None) -> list:
+    """
+    İstasyonları arar. 
+    from_station_id verilirse sadece o istasyondan gidilebilecek hedefleri arar.
+    from_station_ids verilirse bu istasyonların herhangi birinden gidilebilecek hedefleri arar.
+    stations verilirse sadece bu listede arar.
+    Türkçe karakter duyarsız arama yapar.
     """
+    query_normalized = normalize_turkish(query.strip())
+    
+    if stations is None:
+        if from_station_ids:
+            stations = get_available_destinations_for(from_station_ids)
+        elif from_station_id:
+            # Varış istasyonlarında ara
+            stations = get_available_destinations(from_station_id)
+        else:
+            # Kalkış istasyonlarında ara
+            stations = get_active_stations()
+    
+    # Arama yap - normalize edilmiş karşılaştırma
+    results = []
+    for station in stations:
+        station_name_normalized = normalize_turkish(station['name'])
+        if query_normalized in station_name_normalized:
+            results.append(station)
+    
+    # En fazla 10 sonuç döndür (Telegram buton limiti için)
+    return results[:10]
+
+def create_search_result_keyboard(stations: list, is_destination: bool = False,
+                                  allow_multi: bool = False, groups: list = None) -> InlineKeyboardMarkup:
     keyboard = []
     row = []
     
-    for train_info in available_times:
-        time_str = train_info["time"]
-        is_selected = time_str in selected_times
-        
-        # Buton metni: seçiliyse ✅, değilse normal
-        button_text = f"✅ {time_str}" if is_selected else time_str
-        callback_data = f"{callback_prefix}_toggle_{time_str}"
+    # Aksiyon ve kalkış istasyonu sunucu tarafında (user_states) tutulur
+    op = "t" if is_destination else "f"
+    all_op = "ta" if is_destination else "fa"
+    
+    # Şehir grupları: gruptaki tüm istasyonlar birlikte seçilir
+    for group in groups or []:
+        keyboard.append([InlineKeyboardButton(
+            f"🏙 {group['name']} ({len(group['station_ids'])} istasyon)",
+            callback_data=encode_callback(all_op, *group['station_ids'])
+        )])
+    
+    for station in stations:
+        station_name = station['name'][:25]  # Uzun isimleri kısalt
+        callback_data = encode_callback(op, station['id'])
         
-        row.append(InlineKeyboardButton(button_text, callback_data=callback_data))
+        row.append(InlineKeyboardButton(station_name, callback_data=callback_data))
         
-        if len(row) == 3:
+        if len(row) == 2:
             keyboard.append(row)
             row = []
     
     if row:
         keyboard.append(row)
     
-    # Alt butonlar: Tümünü Seç / Seçimi Temizle ve Devam
-    select_all_text = "📋 Tümünü Seç" if len(selected_times) < len(available_times) else "🔄 Seçimi Temizle"
-    keyboard.append([
-        InlineKeyboardButton(select_all_text, callback_data=f"{callback_prefix}_all"),
-        InlineKeyboardButton("➡️ Devam", callback_data=f"{callback_prefix}_done")
-    ])
+    # Çoklu güzergah: tüm sonuçları alternatif olarak seç
+    if allow_multi and len(stations) > 1:
+        keyboard.append([InlineKeyboardButton(
+            f"🔀 Hepsini seç ({len(stations)})",
+            callback_data=encode_callback(all_op, *[station['id'] for station in stations])
+        )])
     
-    keyboard.append([InlineKeyboardButton("❌ İptal", callback_data="cancel_search")])
+    # İptal butonu ekle
+    keyboard.append([InlineKeyboardButton("❌ İptal", callback_data=encode_callback("x"))])
     
     return InlineKeyboardMarkup(keyboard)
 
-def create_business_keyboard(callback_prefix: str) -> InlineKeyboardMarkup:
-    keyboard = [
-        [
-            InlineKeyboardButton("🪑 Sadece Ekonomi", callback_data=f"{callback_prefix}_no"),
-            InlineKeyboardButton("💼 Business Dahil", callback_data=f"{callback_prefix}_yes")
-        ],
-        [InlineKeyboardButton("❌ İptal", callback_data="cancel_search")]
+def get_available_train_times(from_id: int, to_id: int, target_date: datetime) -> list:
+    """
+    Seçilen güzergah ve tarihteki tren kalkış saatlerini döndürür.
+    Returns: [{"time": "08:00", "train_name": "YHT 1234"}, ...]
+    """
+    sefer_gruplari, error = fetch_train_availability_cached(from_id, to_id, target_date, scheduled=False)
+    if error:
+        print(f"Tren saatleri alınırken hata: {error}")
+        return []
+    
+    train_times = []
+    for sefer_grubu in sefer_gruplari:
+        trenler = sefer_grubu.get("trains", [])
+        for tren in trenler:
+            try:
+                kalkis_saati = istanbul_clock(tren["segments"][0]["departureTime"])
+                tren_adi = tren.get("trainName", "Tren")
+                tren_tipi = tren.get("type", "")
+                tren_tipi_gosterim = get_train_type_display(tren_tipi) if tren_tipi else ""
+                train_times.append({
+                    "time": kalkis_saati,
+                    "train_name": tren_adi,
+                    "type": tren_tipi_gosterim
+                })
+            except (KeyError, IndexError):
+                continue
+    
+    train_times.sort(key=lambda x: x["time"])
+    return train_times
+
+def get_available_train_times_for_routes(routes: list, target_date: datetime) -> list:
+    """Birden fazla güzergahın sefer saatlerini eşzamanlı alır, saate göre birleştirir."""
+    if len(routes) == 1:
+        return get_available_train_times(routes[0][0], routes[0][1], target_date)
+    
+    futures = [fetch_executor.submit(get_available_train_times, from_id, to_id, target_date)
+               for from_id, to_id in routes]
+    merged = {}
+    for future in futures:
+        for train_info in future.result():
+            merged.setdefault(train_info["time"], train_info)
+    return sorted(merged.values(), key=lambda x: x["time"])
+
+TIME_BUTTONS_PER_ROW = 3
+
+def _time_button(index: int, time_str: str, is_selected: bool) -> InlineKeyboardButton:
+    # Buton metni: seçiliyse ✅, değilse normal
+    button_text = f"✅ {time_str}" if is_selected else time_str
+    return InlineKeyboardButton(button_text, callback_data=encode_callback("mt", index))
+
+def _time_footer_row(selected_count: int, total_count: int) -> list:
+    # Alt butonlar: Tümünü Seç / Seçimi Temizle ve Devam
+    select_all_text = "📋 Tümünü Seç" if selected_count < total_count else "🔄 Seçimi Temizle"
+    return [
+        InlineKeyboardButton(select_all_text, callback_data=encode_callback("ma")),
+        InlineKeyboardButton("➡️ Devam", callback_data=encode_callback("md"))
     ]
+
+def create_time_selection_keyboard(available_times: list, selected_times: list,
+                                   rows: list = None, changed_index: int = None) -> InlineKeyboardMarkup:
+    """
+    Saat seçim klavyesi oluşturur.
+    Seçilen saatler ✅ ile işaretlenir.
+    
+    rows verilirse butonlar bu listede tutulur; changed_index ile tekrar
+    çağrıldığında ızgara baştan kurulmaz, yalnız değişen buton ve alt satır yenilenir.
+    """
+    if rows is not None and changed_index is not None and rows:
+        time_str = available_times[changed_index]["time"]
+        row = rows[changed_index // TIME_BUTTONS_PER_ROW]
+        row[changed_index % TIME_BUTTONS_PER_ROW] = _time_button(changed_index, time_str, time_str in selected_times)
+        rows[-2] = _time_footer_row(len(selected_times), len(available_times))
+        return InlineKeyboardMarkup(rows)
+    
+    selected = set(selected_times)
+    keyboard = []
+    row = []
+    
+    for index, train_info in enumerate(available_times):
+        time_str = train_info["time"]
+        row.append(_time_button(index, time_str, time_str in selected))
+        
+        if len(row) == TIME_BUTTONS_PER_ROW:
+            keyboard.append(row)
+            row = []
+    
+    if row:
+        keyboard.append(row)
+    
+    keyboard.append(_time_footer_row(len(selected_times), len(available_times)))
+    keyboard.append([InlineKeyboardButton("❌ İptal", callback_data=encode_callback("x"))])
+    
+    if rows is not None:
+        rows[:] = keyboard
     return InlineKeyboardMarkup(keyboard)
 
-def create_passenger_count_keyboard(callback_prefix: str) -> InlineKeyboardMarkup:
+# Kullanıcının seçebildiği vagon türleri: kod -> görünen ad
+CABIN_KINDS = {
+    "e": "🪑 Ekonomi",
+    "b": "💼 Business",
+    "s": "🛏 Yataklı",
+    "l": "🚪 Loca",
+    "w": "♿ Tekerlekli Sandalye",
+}
+DEFAULT_CABIN_KINDS = ("e",)
+
+# API vagon sınıfı ID'si -> tür kodu. Her yeni ID adından bir kez sınıflandırılır.
+CABIN_CLASS_KINDS = {}
+
+def classify_cabin_class(class_id, class_name: str) -> str:
+    kind = CABIN_CLASS_KINDS.get(class_id)
+    if kind is None:
+        sinif_adi = class_name.upper()
+        if sinif_adi == "TEKERLEKLİ SANDALYE":
+            kind = "w"
+        elif sinif_adi == "YATAKLI":
+            kind = "s"
+        elif sinif_adi == "LOCA":
+            kind = "l"
+        elif "BUS" in sinif_adi:
+            kind = "b"
+        else:
+            kind = "e"
+        CABIN_CLASS_KINDS[class_id] = kind
+    return kind
+
+class CabinFilter:
+    """
+    İşin vagon türü seçimi, bilinen sınıf ID'lerinin frozenset'ine derlenir.
+    Her poll'da vagon başına küme araması yapılır. Filtrenin bilmediği bir ID
+    çıkarsa (ör. açılışta harita henüz boşken) ID sınıflandırılır ve küme, tüm
+    işlerin öğrendiği ortak haritadan yeniden derlenir; sonraki turlar ID ile eşleşir.
+    """
+
+    def __init__(self, kinds):
+        self.kinds = frozenset(kinds)
+        self._compile()
+
+    def _compile(self):
+        # Diğer thread'ler haritaya eklerken gezilmemesi için anlık kopyadan derlenir
+        known = dict(CABIN_CLASS_KINDS)
+        self.known_ids = frozenset(known)
+        self.class_ids = frozenset(class_id for class_id, kind in known.items() if kind in self.kinds)
+
+    @classmethod
+    def from_business_flag(cls, include_business: bool):
+        # Eski işler (include_business) için ekonomi + isteğe bağlı business
+        return cls(DEFAULT_CABIN_KINDS + (("b",) if include_business else ()))
+
+    def allows(self, class_id, class_name: str) -> bool:
+        if class_id not in self.known_ids:
+            classify_cabin_class(class_id, class_name)
+            self._compile()
+        return class_id in self.class_ids
+
+    def describe(self) -> str:
+        return ", ".join(CABIN_KINDS[kind].split(" ", 1)[1] for kind in CABIN_KINDS if kind in self.kinds)
+
+# Sabit ve az sayıda farklı hali olan klavyeler bir kez kurulup paylaşılır.
+# (InlineKeyboardMarkup değiştirilemez; callback verileri kısa olduğundan
+# süresi dolan callback_payloads token'ı içermezler.)
+
+def create_cabin_class_keyboard(selected_kinds: list) -> InlineKeyboardMarkup:
+    return _cabin_class_keyboard(frozenset(selected_kinds))
+
+@functools.lru_cache(maxsize=None)
+def _cabin_class_keyboard(selected_kinds: frozenset) -> InlineKeyboardMarkup:
     keyboard = [
-        [
-            InlineKeyboardButton("1 Kişi", callback_data=f"{callback_prefix}_1"),
-            InlineKeyboardButton("2 Kişi", callback_data=f"{callback_prefix}_2"),
-            InlineKeyboardButton("3 Kişi", callback_data=f"{callback_prefix}_3")
-        ],
-        [
-            InlineKeyboardButton("4 Kişi", callback_data=f"{callback_prefix}_4"),
-            InlineKeyboardButton("5 Kişi", callback_data=f"{callback_prefix}_5"),
-            InlineKeyboardButton("6 Kişi", callback_data=f"{callback_prefix}_6")
-        ],
-        [InlineKeyboardButton("❌ İptal", callback_data="cancel_search")]
+        [InlineKeyboardButton(f"{'✅' if kind in selected_kinds else '⬜'} {label}",
+                              callback_data=encode_callback("mb", kind))]
+        for kind, label in CABIN_KINDS.items()
     ]
+    keyboard.append([InlineKeyboardButton("➡️ Devam", callback_data=encode_callback("mbd"))])
+    keyboard.append([InlineKeyboardButton("❌ İptal", callback_data=encode_callback("x"))])
     return InlineKeyboardMarkup(keyboard)
 
-def create_interval_selection_keyboard(callback_prefix: str) -> InlineKeyboardMarkup:
+def create_passenger_keyboard(passengers: dict) -> InlineKeyboardMarkup:
+    return _passenger_keyboard(tuple(passengers.get(type_id, 0) for type_id in PASSENGER_TYPES))
+
+@functools.lru_cache(maxsize=256)
+def _passenger_keyboard(counts: tuple) -> InlineKeyboardMarkup:
     keyboard = [
         [
-            InlineKeyboardButton("1 dk", callback_data=f"{callback_prefix}_60"),
-            InlineKeyboardButton("2 dk", callback_data=f"{callback_prefix}_120"),
-        ],
-        [
-            InlineKeyboardButton("5 dk", callback_data=f"{callback_prefix}_300"),
-            InlineKeyboardButton("10 dk", callback_data=f"{callback_prefix}_600"),
-        ],
-        [InlineKeyboardButton("❌ İptal", callback_data="cancel_search")]
+            InlineKeyboardButton(f"{label}: {count}", callback_data=encode_callback("pa", type_id)),
+            InlineKeyboardButton("➖", callback_data=encode_callback("pr", type_id)),
+            InlineKeyboardButton("➕", callback_data=encode_callback("pa", type_id))
+        ]
+        for (type_id, label), count in zip(PASSENGER_TYPES.items(), counts)
     ]
+    keyboard.append([InlineKeyboardButton("➡️ Devam", callback_data=encode_callback("mc"))])
+    keyboard.append([InlineKeyboardButton("❌ İptal", callback_data=encode_callback("x"))])
     return InlineKeyboardMarkup(keyboard)
 
+def format_price_threshold(price_threshold: float) -> str:
+    return f"≤ {price_threshold:g} TRY" if price_threshold else "Her düşüşte"
+
+def create_price_threshold_keyboard(callback_prefix: str, current_price: float = None) -> InlineKeyboardMarkup:
+    keyboard = [[InlineKeyboardButton("📉 Her düşüşte bildir", callback_data=encode_callback(callback_prefix, 0))]]
+    if current_price:
+        # Güncel en düşük fiyatın %10/%20/%30 altı, 10 TRY'ye yuvarlanmış
+        targets = sorted({int(current_price * ratio) // 10 * 10 for ratio in (0.9, 0.8, 0.7)}, reverse=True)
+        keyboard.append([
+            InlineKeyboardButton(f"≤ {target} TRY", callback_data=encode_callback(callback_prefix, target))
+            for target in targets if target > 0
+        ])
+    keyboard.append([InlineKeyboardButton("❌ İptal", callback_data=encode_callback("x"))])
+    return InlineKeyboardMarkup(keyboard)
+
+@functools.lru_cache(maxsize=None)
+def create_interval_selection_keyboard(callback_prefix: str, live_board: bool = None,
+                                       min_interval: int = MIN_INTERVAL_SECONDS) -> InlineKeyboardMarkup:
+    """
+    live_board None değilse canlı durum mesajı seçeneği de gösterilir.
+    Sohbetin kotasındaki en kısa aralıktan sık seçenekler gösterilmez.
+    """
+    options = [seconds for seconds in INTERVAL_OPTIONS if seconds >= min_interval] or [min_interval]
+    buttons = [InlineKeyboardButton(f"{seconds // 60} dk" if seconds % 60 == 0 else f"{seconds} sn",
+                                    callback_data=encode_callback(callback_prefix, seconds))
+               for seconds in options]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    if live_board is not None:
+        keyboard.append([InlineKeyboardButton(
+            f"📌 Canlı durum mesajı: {'Açık ✅' if live_board else 'Kapalı'}",
+            callback_data=encode_callback("lb")
+        )])
+    keyboard.append([InlineKeyboardButton("❌ İptal", callback_data=encode_callback("x"))])
+    return InlineKeyboardMarkup(keyboard)
+
+def clock_minutes(time_str: str) -> int:
+    """'HH:MM' -> gün içindeki dakika"""
+    hours, minutes = time_str.strip().split(":")
+    return int(hours) * 60 + int(minutes)
+
+# Dakika yazılmazsa :00 sayılır ("18.30-21" -> 18:30-21:00)
+TIME_RANGE_PATTERN = re.compile(r"(\d{1,2})(?:[:.](\d{2}))?\s*[-–]\s*(\d{1,2})(?:[:.](\d{2}))?")
+
+def parse_time_ranges(text: str) -> list:
+    """
+    '07:00-10:00, 18.30-21' gibi metinden 'HH:MM-HH:MM' aralıklarını çıkarır.
+    Aralıklar virgül, noktalı virgül veya satırla ayrılır.
+    Anlaşılamayan parça sessizce atlanmaz: ValueError(parça) fırlatılır.
+    """
+    ranges = []
+    for segment in re.split(r"[,;\n]+", text):
+        segment = segment.strip()
+        if not segment:
+            continue
+        match = TIME_RANGE_PATTERN.fullmatch(segment)
+        if match is None:
+            raise ValueError(segment)
+        start_h, start_m, end_h, end_m = (int(part or 0) for part in match.groups())
+        if start_h > 23 or end_h > 23 or start_m > 59 or end_m > 59:
+            raise ValueError(segment)
+        ranges.append(f"{start_h:02d}:{start_m:02d}-{end_h:02d}:{end_m:02d}")
+    return ranges
+
+def describe_times(selected_times: list = None, time_ranges: list = None) -> str:
+    items = sorted((time_ranges or []) + (selected_times or []))
+    return ", ".join(items) if items else "Tümü"
+
+class TimeWindows:
+    """
+    İşin kalkış saati filtresi. Seçilen saatler ve aralıklar iş başında
+    epoch saniye aralıklarına derlenir, birleştirilip başlangıca göre sıralı
+    iki diziye yazılır. Her trende kontrol tek bisect'tir; bitiş zamanı
+    (izlemenin kendiliğinden sona ereceği an) da önceden hesaplanır.
+    """
+
+    def __init__(self, windows: list):
+        merged = []
+        for start, end in sorted(windows):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.starts = array('q', (window[0] for window in merged))
+        self.ends = array('q', (window[1] for window in merged))
+        self.expires_at = self.ends[-1] if merged else None
+
+    @classmethod
+    def compile(cls, target_date: datetime, selected_times: list = None, time_ranges: list = None):
+        """Filtre yoksa None döner (tüm seferler)."""
+        if not selected_times and not time_ranges:
+            return None
+        day_start = istanbul_day_start(target_date)
+        windows = []
+        for time_str in selected_times or []:
+            moment = day_start + clock_minutes(time_str) * 60
+            windows.append((moment, moment + 59))  # Dakika içindeki saniyeler
+        for time_range in time_ranges or []:
+            start_str, end_str = time_range.split("-")
+            start, end = clock_minutes(start_str), clock_minutes(end_str)
+            if end < start:  # Gece yarısını geçen aralık
+                end += 24 * 60
+            windows.append((day_start + start * 60, day_start + end * 60 + 59))
+        return cls(windows)
+
+    def contains(self, departure_seconds: int) -> bool:
+        index = bisect.bisect_right(self.starts, departure_seconds) - 1
+        return index >= 0 and departure_seconds <= self.ends[index]
+
+def collect_matching_trains(sefer_gruplari_listesi: list, time_windows: TimeWindows = None,
+                            cabin_filter: CabinFilter = None, min_seats: int = 1) -> list:
+    """
+    Filtrelere uyan trenleri ve vagonlarını yapılandırılmış olarak döndürür.
+    cabin_filter verilmezse ekonomi ve business vagonları dahil edilir.
+    Returns: [{"name", "type", "time", "departure_ms", "cabins": [{"name", "class_id", "seats", "price"}]}, ...]
+    """
+    if cabin_filter is None:
+        cabin_filter = CabinFilter.from_business_flag(True)
+    
+    matching_trains = []
+    toplam_tren_sayaci = 0
+    
+    for sefer_grubu in sefer_gruplari_listesi:
+        trenler_listesi = sefer_grubu.get("trains")
+        if not trenler_listesi:
+            continue
+            
+        for tren in trenler_listesi:
+            toplam_tren_sayaci += 1
+            
+            try:
+                timestamp_ms = tren["segments"][0]["departureTime"]
+                
+                # Saat filtresi: derlenmiş aralıkların dışındaki seferleri atla
+                if time_windows is not None and not time_windows.contains(timestamp_ms // 1000):
+                    continue
+                
+                kalkis_saati_str = istanbul_clock(timestamp_ms)
+                tren_adi = tren.get("trainName", f"Tren {toplam_tren_sayaci}")
+                tren_tipi = tren.get("type", "")
+                
+                vagon_bilgisi_sozlugu = tren["availableFareInfo"][0]
+                vagon_siniflari_listesi = vagon_bilgisi_sozlugu["cabinClasses"]
+                
+                if not vagon_siniflari_listesi:
+                    continue
+
+                uygun_vagonlar = []
+                for vagon in vagon_siniflari_listesi:
+                    sinif_adi = vagon["cabinClass"]["name"]
+                    sinif_id = vagon["cabinClass"].get("id", sinif_adi)
+                    uygun_koltuk = vagon["availabilityCount"]
+                    
+                    # Vagon sınıfı filtresi (işe özel, önceden derlenmiş)
+                    if not cabin_filter.allows(sinif_id, sinif_adi):
+                        continue
+                    
+                    # Minimum koltuk filtresi
+                    if uygun_koltuk >= min_seats:
+                        uygun_vagonlar.append({
+                            "name": sinif_adi,
+                            "class_id": sinif_id,
+                            "seats": uygun_koltuk,
+                            "price": vagon["minPrice"]
+                        })
+
+                if uygun_vagonlar:
+                    matching_trains.append({
+                        "name": tren_adi,
+                        "type": tren_tipi,
+                        "time": kalkis_saati_str,
+                        "departure_ms": timestamp_ms,
+                        "arrival_ms": tren["segments"][-1].get("arrivalTime"),
+                        "cabins": uygun_vagonlar
+                    })
+                     
+            except (KeyError, IndexError, TypeError) as e:
+                print(f"Parsing error: {e}")
+    
+    return matching_trains
+
+def render_train(train: dict, route_label: str = None) -> str:
+    """
+    Trenin mesaj parçası. Parçalar trenin yapısal durumuyla önbelleklenir;
+    her turda sadece koltuk/fiyatı değişen trenler yeniden oluşturulur.
+    """
+    cabins = tuple((vagon["name"], vagon["seats"], vagon["price"]) for vagon in train["cabins"])
+    return _render_train_fragment(train["name"], train["time"], train["type"], route_label, cabins)
+
+@functools.lru_cache(maxsize=4096)
+def _render_train_fragment(name: str, time_str: str, train_type, route_label, cabins: tuple) -> str:
+    # Tren tipi varsa parantez içinde göster (örn: "Kalkış: 08:00 - YHT")
+    tren_tipi_gosterim = get_train_type_display(train_type) if train_type else ""
+    tip_bilgisi = f" - {tren_tipi_gosterim}" if tren_tipi_gosterim else ""
+    parts = [f"\n<b>{name} (Kalkış: {time_str}{tip_bilgisi})</b>:\n"]
+    if route_label:
+        parts.append(f"   🚉 {route_label}\n")
+    for vagon_adi, koltuk, fiyat in cabins:
+        parts.append(f"   ✅ <b>{vagon_adi}: {koltuk} adet</b> (min {fiyat} TRY)\n")
+    return "".join(parts)
+
 def check_api_and_parse(from_id: int, to_id: int, target_date: datetime, 
-                         selected_times: list = None, include_business: bool = True, min_seats: int = 1):
+                         time_windows: TimeWindows = None, cabin_filter: CabinFilter = None, min_seats: int = 1,
+                         max_age: float = None, passengers=None):
     """
     API'yi kontrol eder ve bilet durumunu parse eder.
     
     Args:
-        selected_times: Sadece bu saatlerdeki trenleri kontrol et (None = hepsi)
-        include_business: Business sınıfını dahil et
+        time_windows: Sadece bu kalkış aralıklarındaki trenleri kontrol et (None = hepsi)
+        cabin_filter: İzlenecek vagon sınıfları (None = ekonomi ve business)
         min_seats: Minimum koltuk sayısı filtresi
+        max_age: Verilirse en fazla bu kadar saniyelik paylaşılan sonuç kullanılır
+        passengers: Sorguda gönderilecek yolcu dağılımı (None = tek yetişkin)
+    Returns: (bulundu mu, mesaj, [(tren, None), ...])
+    """
+    if max_age is None:
+        sefer_gruplari_listesi, error = fetch_train_availability(from_id, to_id, target_date, passengers)
+    else:
+        sefer_gruplari_listesi, error = fetch_train_availability_cached(from_id, to_id, target_date,
+                                                                        max_age, passengers)
+    if error:
+        return (False, error, [])
+
+    from_station = get_station_by_id(from_id)
+    to_station = get_station_by_id(to_id)
+    
+    date_tr_str = target_date.strftime("%d %B %Y")
+    route_str = f"<b>{from_station['name']} ➡ {to_station['name']}</b> | <b>{date_tr_str}</b>"
+
+    if not sefer_gruplari_listesi:
+        return (False, f"ℹ️ {route_str} yönüne uygun sefer bulunamadı.", [])
+
+    matching_trains = collect_matching_trains(sefer_gruplari_listesi, time_windows, cabin_filter, min_seats)
+
+    if not matching_trains:
+        return (False, f"ℹ️ {route_str} yönüne sefer bulundu, ancak <b>kriterlere uygun yer bulunamadı</b>.", [])
+
+    parts = [f"✅ <b>{route_str}</b>\n\nBulunan seferler:\n"]
+    parts.extend(render_train(train) for train in matching_trains)
+    return (True, "".join(parts), [(train, None) for train in matching_trains])
+
+def collect_route_trains(routes: list, target_date: datetime, time_windows: TimeWindows = None,
+                         cabin_filter: CabinFilter = None, min_seats: int = 1, max_age: float = None,
+                         passengers=None, scheduled: bool = True):
+    """
+    Güzergahları eşzamanlı sorgular, filtrelere uyan trenleri güzergah etiketiyle birleştirir.
+    Returns: ([(tren, güzergah etiketi), ...], hata satırları, herhangi bir sefer var mı)
     """
-    dynamic_token = get_dynamic_token()
+    results = fetch_routes_concurrently(routes, target_date, max_age, passengers, scheduled)
+    
+    merged = []
+    errors = []
+    any_train = False
+    for (from_id, to_id), (sefer_gruplari, error) in zip(routes, results):
+        route_label = f"{get_station_by_id(from_id)['name']} ➡ {get_station_by_id(to_id)['name']}"
+        if error:
+            errors.append(f"• {route_label}: {error}")
+            continue
+        if sefer_gruplari:
+            any_train = True
+        for train in collect_matching_trains(sefer_gruplari, time_windows, cabin_filter, min_seats):
+            merged.append((train, route_label))
+    
+    # Önce kalkış saati, aynı saatte daha çok boş koltuk olan öne
+    merged.sort(key=lambda item: (item[0]["departure_ms"], -sum(c["seats"] for c in item[0]["cabins"])))
+    return merged, errors, any_train
+
+def check_multiple_routes(routes: list, target_date: datetime,
+                          cabin_filter: CabinFilter = None, min_seats: int = 1, time_windows: TimeWindows = None,
+                          max_age: float = None, passengers=None):
+    """
+    Birden fazla (kalkış, varış) çiftini eşzamanlı sorgular ve sonuçları
+    kalkış saatine göre sıralı tek bir cevapta birleştirir.
+    Returns: (bulundu mu, mesaj, [(tren, güzergah etiketi), ...])
+    """
+    merged, errors, any_train = collect_route_trains(routes, target_date, time_windows,
+                                                     cabin_filter, min_seats, max_age, passengers)
+    date_tr_str = target_date.strftime("%d %B %Y")
+    
+    header = f"<b>{len(routes)} güzergah</b> | <b>{date_tr_str}</b>"
+    error_text = ("\n\n⚠️ Sorgulanamayan güzergahlar:\n" + "\n".join(errors)) if errors else ""
+    
+    if not merged:
+        if any_train:
+            return (False, f"ℹ️ {header} için sefer bulundu, ancak <b>kriterlere uygun yer bulunamadı</b>.{error_text}", [])
+        return (False, f"ℹ️ {header} için uygun sefer bulunamadı.{error_text}", [])
+    
+    parts = [f"✅ {header}\n\nBulunan seferler:\n"]
+    parts.extend(render_train(train, route_label) for train, route_label in merged)
+    parts.append(error_text)
+    return (True, "".join(parts), merged)
+
+def seat_state(trains: list) -> dict:
+    """
+    Değişiklik takibi için {tren: toplam uygun koltuk}. Aynı tren farklı
+    güzergahlarda "Ad [güzergah]" anahtarıyla ayrı izlenir.
+    """
+    state = {}
+    for train, route_label in trains:
+        key = f"{train['name']} [{route_label}]" if route_label else train["name"]
+        state[key] = state.get(key, 0) + sum(cabin["seats"] for cabin in train["cabins"])
+    return state
+
+def cheapest_price(routes: list, target_date: datetime, time_windows: TimeWindows = None,
+                   cabin_filter: CabinFilter = None, min_seats: int = 1, passengers=None):
+    """Filtrelere uyan vagonlardaki en düşük fiyat (yoksa None)."""
+    merged, _, _ = collect_route_trains(routes, target_date, time_windows, cabin_filter,
+                                        min_seats, ROUTE_CACHE_TTL_SECONDS, passengers, scheduled=False)
+    prices = [cabin["price"] for train, _ in merged for cabin in train["cabins"] if cabin["price"]]
+    return min(prices) if prices else None
+
+def check_price_changes(chat_id: str, routes: list, target_date: datetime, time_windows: TimeWindows,
+                        cabin_filter: CabinFilter, min_seats: int, price_threshold: float,
+                        last_prices: dict, first_check: bool, max_age: float, passengers=None):
+    """
+    Fiyat takibi turu. Tren/vagon başına son görülen fiyatlar last_prices içinde
+    {(kalkış sn, vagon sınıfı, güzergah): kuruş} olarak tutulur ve yerinde güncellenir.
+    price_threshold None ise her düşüşte, değilse fiyat eşiğin altına indiğinde bildirir.
+    """
+    merged, errors, _ = collect_route_trains(routes, target_date, time_windows,
+                                             cabin_filter, min_seats, max_age, passengers)
+    if errors and not merged:
+        print(f"Fiyat kontrolü yapılamadı ({chat_id}): {errors[0]}")
+        return
+    
+    threshold_kurus = round(price_threshold * 100) if price_threshold else None
+    show_route = len(routes) > 1
+    alerts = []
+    for train, route_label in merged:
+        for cabin in train["cabins"]:
+            if not cabin["price"]:
+                continue
+            key = (train["departure_ms"] // 1000, cabin["class_id"] or cabin["name"], route_label if show_route else None)
+            price_kurus = round(cabin["price"] * 100)
+            previous_kurus = last_prices.get(key)
+            last_prices[key] = price_kurus
+            
+            if threshold_kurus is None:
+                is_alert = previous_kurus is not None and price_kurus < previous_kurus
+            else:
+                is_alert = price_kurus <= threshold_kurus and (previous_kurus is None or price_kurus < previous_kurus
+                                                               or previous_kurus > threshold_kurus)
+            if not is_alert or first_check:
+                continue
+            
+            route_info = f" [{route_label}]" if show_route else ""
+            change = f"{previous_kurus / 100:g} → {cabin['price']:g} TRY" if previous_kurus else f"{cabin['price']:g} TRY"
+            alerts.append(f"📉 <b>{train['name']} ({train['time']})</b>{route_info} {cabin['name']}: {change}\n")
+    
+    if first_check:
+        prices = [cabin["price"] for train, _ in merged for cabin in train["cabins"] if cabin["price"]]
+        if prices:
+            send_telegram_message(f"💸 İlk kontrol tamamlandı. Şu anki en düşük fiyat: <b>{min(prices):g} TRY</b>", chat_id)
+        else:
+            send_telegram_message("ℹ️ İlk kontrol tamamlandı. Şu anda kriterlere uygun yer bulunmuyor. "
+                                  "Fiyatlar yer açıldıkça takip edilecek.", chat_id)
+        return
+    
+    if alerts:
+        print(f"FİYAT DÜŞÜŞÜ TESPİT EDİLDİ! ({chat_id})")
+        send_telegram_message("💸 FİYAT DÜŞTÜ! 💸\n\n" + "".join(alerts), chat_id)
+    else:
+        print(f"Fiyat değişikliği yok, mesaj atılmadı ({chat_id})")
+
+MIN_TRANSFER_MINUTES = 15
+MAX_TRANSFER_MINUTES = 240
+MAX_TRANSFER_CANDIDATES = 8
+MAX_CONNECTION_RESULTS = 10
 
-    if not dynamic_token:
-        return (False, "❌ HATA: Dinamik Authorization Token'ı alınamadı.")
+def find_connections(from_id: int, to_id: int, target_date: datetime,
+                     include_business: bool = True, min_seats: int = 1):
+    """
+    A→X→B aktarmalı seferleri bulur. Aday X istasyonları pairs grafiğinden
+    seçilir, tüm bacaklar eşzamanlı (ve önbellekli) sorgulanır, ardından
+    varış ile kalkış arasındaki aktarma süresine göre eşleştirilir.
+    Returns: (bağlantı listesi, hata mesajı)
+    """
+    cabin_filter = CabinFilter.from_business_flag(include_business)
+    transfer_ids = find_transfer_stations(from_id, to_id)[:MAX_TRANSFER_CANDIDATES]
+    if not transfer_ids:
+        return ([], None)
+    
+    legs = [(from_id, transfer_id) for transfer_id in transfer_ids] + \
+           [(transfer_id, to_id) for transfer_id in transfer_ids]
+    futures = [fetch_executor.submit(fetch_train_availability_cached, leg_from, leg_to, target_date,
+                                     ROUTE_CACHE_TTL_SECONDS, None, False)
+               for leg_from, leg_to in legs]
+    results = [future.result() for future in futures]
+    
+    min_wait_ms = MIN_TRANSFER_MINUTES * 60_000
+    max_wait_ms = MAX_TRANSFER_MINUTES * 60_000
+    connections = []
+    errors = []
+    
+    for i, transfer_id in enumerate(transfer_ids):
+        (first_groups, first_error), (second_groups, second_error) = results[i], results[len(transfer_ids) + i]
+        if first_error or second_error:
+            errors.append(first_error or second_error)
+            continue
+        if not first_groups or not second_groups:
+            continue
+        
+        first_trains = collect_matching_trains(first_groups, None, cabin_filter, min_seats)
+        second_trains = sorted(collect_matching_trains(second_groups, None, cabin_filter, min_seats),
+                               key=lambda train: train["departure_ms"])
+        second_departures = [train["departure_ms"] for train in second_trains]
+        
+        for first in first_trains:
+            if not first["arrival_ms"]:
+                continue
+            lo = bisect.bisect_left(second_departures, first["arrival_ms"] + min_wait_ms)
+            hi = bisect.bisect_right(second_departures, first["arrival_ms"] + max_wait_ms)
+            for second in second_trains[lo:hi]:
+                arrival_ms = second["arrival_ms"] or second["departure_ms"]
+                connections.append({
+                    "transfer_id": transfer_id,
+                    "first": first,
+                    "second": second,
+                    "duration_ms": arrival_ms - first["departure_ms"],
+                })
+    
+    if not connections and errors and len(errors) == len(transfer_ids):
+        return ([], errors[0])
+    
+    connections.sort(key=lambda c: (c["duration_ms"], c["first"]["departure_ms"]))
+    return (connections[:MAX_CONNECTION_RESULTS], None)
 
-    headers = {
-        'Accept': 'application/json, text/plain, */*',
-        'Accept-Language': 'tr',
-        'Authorization': dynamic_token,
-        'Connection': 'keep-alive',
-        'Content-Type': 'application/json',
-        'Origin': 'https://ebilet.tcddtasimacilik.gov.tr',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-        'unit-id': '3895',
-    }
+def render_connection(connection: dict) -> str:
+    first, second = connection["first"], connection["second"]
+    transfer_name = get_station_by_id(connection["transfer_id"])['name']
+    wait_minutes = (second["departure_ms"] - first["arrival_ms"]) // 60_000
+    total_minutes = connection["duration_ms"] // 60_000
+    
+    def cabins_summary(train):
+        return ", ".join(f"{c['name']} {c['seats']} (min {c['price']} TRY)" for c in train["cabins"])
+    
+    return (
+        f"\n<b>{first['time']} ➡ {transfer_name} ➡ {second['time']}</b> "
+        f"({total_minutes // 60} sa {total_minutes % 60} dk, {wait_minutes} dk aktarma)\n"
+        f"   1️⃣ {first['name']}: {cabins_summary(first)}\n"
+        f"   2️⃣ {second['name']}: {cabins_summary(second)}\n"
+    )
 
+def run_connection_search(chat_id: str, from_id: int, to_id: int, target_date: datetime):
     from_station = get_station_by_id(from_id)
     to_station = get_station_by_id(to_id)
     
-    if not from_station or not to_station:
-        return (False, "❌ HATA: İstasyon bilgisi bulunamadı.")
+    print(f"Aktarmalı arama: {chat_id} | {from_station['name']} -> {to_station['name']}")
+    
+    date_tr_str = target_date.strftime("%d %B %Y")
+    route_str = f"<b>{from_station['name']} ➡ {to_station['name']}</b> | <b>{date_tr_str}</b>"
+    connections, error = find_connections(from_id, to_id, target_date)
+    
+    if error:
+        message = error
+    elif not connections:
+        message = f"ℹ️ {route_str} için uygun aktarmalı sefer bulunamadı."
+    else:
+        message = f"🔁 {route_str}\n\nAktarmalı seferler:\n"
+        message += "".join(render_connection(connection) for connection in connections)
+    
+    send_telegram_message(message, chat_id)
+    print(f"Aktarmalı arama tamamlandı ({chat_id}).")
 
-    api_search_date = target_date - timedelta(days=1)
-    date_str = api_search_date.strftime("%d-%m-%Y") + " 21:00:00"
+def run_route_stats(chat_id: str, from_id: int, to_id: int):
+    from_station = get_station_by_id(from_id)
+    to_station = get_station_by_id(to_id)
+    
+    print(f"Geçmiş istatistikleri: {chat_id} | {from_station['name']} -> {to_station['name']}")
+    
+    route_str = f"<b>{from_station['name']} ➡ {to_station['name']}</b>"
+    row_count = poll_history.row_count(from_id, to_id)
+    
+    if not row_count:
+        send_telegram_message(f"ℹ️ {route_str} için henüz geçmiş kaydı yok. "
+                              "Güzergah sorgulandıkça veriler birikecektir.", chat_id)
+        return
+    
+    histogram = poll_history.release_hour_histogram(from_id, to_id)
+    probabilities = poll_history.seat_probability_by_lead(from_id, to_id)
+    
+    message = f"📊 {route_str}\n<i>{row_count} ölçüm</i>\n\n"
+    
+    total_releases = sum(histogram)
+    if total_releases:
+        message += "🔓 <b>Yer açılan saatler</b> (en sık):\n"
+        top_hours = sorted(range(24), key=lambda hour: histogram[hour], reverse=True)[:5]
+        for hour in top_hours:
+            if histogram[hour]:
+                message += f"• {hour:02d}:00-{hour:02d}:59 → %{histogram[hour] * 100 // total_releases}\n"
+    else:
+        message += "🔓 Henüz yer açılması gözlemlenmedi.\n"
+    
+    message += "\n🎯 <b>Kalkıştan önce boş yer bulunma oranı:</b>\n"
+    for hours, (ratio, samples) in probabilities.items():
+        if ratio is not None:
+            message += f"• {hours} saat önce: %{ratio * 100:.0f} <i>({samples} ölçüm)</i>\n"
+    
+    send_telegram_message(message, chat_id)
+    print(f"Geçmiş istatistikleri tamamlandı ({chat_id}).")
 
-    json_data = {
-        'searchRoutes': [
-            {
-                'departureStationId': from_id,
-                'departureStationName': from_station['name'],
-                'arrivalStationId': to_id,
-                'arrivalStationName': to_station['name'],
-                'departureDate': date_str,
-            },
-        ],
-        'passengerTypeCounts': [{'id': 0, 'count': 1}],
-        'searchReservation': False,
-        'searchType': 'DOMESTIC',
-        'blTrainTypes': ['TURISTIK_TREN'],
-    }
+def fetch_sales_calendar(routes: list, days: list) -> list:
+    """
+    Günlerin ve güzergahların tümünü havuzdaki thread'lerle eşzamanlı sorgular.
+    Token bir kez alınıp paylaşılır, bağlantılar havuzdan gelir; son
+    ROUTE_CACHE_TTL_SECONDS içindeki sonuçlar (izleme işlerininki dahil) önbellekten kullanılır.
+    Returns: days ile aynı sırada [[(sefer grupları, hata mesajı), ...güzergah başına], ...]
+    """
+    get_cached_token()
+    futures = [[fetch_executor.submit(fetch_train_availability_cached, from_id, to_id, day,
+                                      ROUTE_CACHE_TTL_SECONDS, None, False)
+                for from_id, to_id in routes]
+               for day in days]
+    return [[future.result() for future in day_futures] for day_futures in futures]
 
-    try:
-        response = requests.post(
-            'https://web-api-prod-ytp.tcddtasimacilik.gov.tr/tms/train/train-availability',
-            params=params,
-            headers=headers,
-            json=json_data,
-            timeout=15
+def summarize_calendar_day(results: list, cabin_filter: CabinFilter) -> str:
+    """Günün tüm güzergahlarındaki boş koltuk toplamı ve en düşük fiyatı, vagon türü başına tek satır"""
+    kinds = {}  # {tür kodu: [koltuk, en düşük fiyat]}
+    any_train = False
+    failed = 0
+    for sefer_gruplari, error in results:
+        if error:
+            failed += 1
+            continue
+        any_train = any_train or any(sefer_grubu.get("trains") for sefer_grubu in sefer_gruplari)
+        for train in collect_matching_trains(sefer_gruplari, cabin_filter=cabin_filter):
+            for cabin in train["cabins"]:
+                entry = kinds.setdefault(classify_cabin_class(cabin["class_id"], cabin["name"]), [0, None])
+                entry[0] += cabin["seats"]
+                if cabin["price"] and (entry[1] is None or cabin["price"] < entry[1]):
+                    entry[1] = cabin["price"]
+    
+    if kinds:
+        return "  ".join(
+            f"{CABIN_KINDS[kind].split(' ', 1)[0]} {kinds[kind][0]}"
+            + (f" · {kinds[kind][1]:g} TRY" if kinds[kind][1] is not None else "")
+            for kind in CABIN_KINDS if kind in kinds
         )
+    if failed == len(results):
+        return "⚠️ Sorgulanamadı"
+    return "❌ Yer yok" if any_train else "— Sefer yok"
 
-        if response.status_code == 401:
-            return (False, "❌ HATA: API Token'ı geçersiz.")
-        elif response.status_code != 200:
-            return (False, f"❌ HATA: API yanıtı beklenmedik. Durum: {response.status_code}")
-
-        data = response.json()
-        sefer_gruplari_listesi = data["trainLegs"][0]["trainAvailabilities"]
-        
-        date_tr_str = target_date.strftime("%d %B %Y")
-        route_str = f"<b>{from_station['name']} ➡ {to_station['name']}</b> | <b>{date_tr_str}</b>"
-
-        if not sefer_gruplari_listesi:
-            return (False, f"ℹ️ {route_str} yönüne uygun sefer bulunamadı.")
-
-        result_message = f"✅ <b>{route_str}</b>\n\nBulunan seferler:\n"
-        
-        toplam_tren_sayaci = 0
-        bulunan_koltuk = False
-        
-        for sefer_grubu in sefer_gruplari_listesi:
-            trenler_listesi = sefer_grubu.get("trains")
-            if not trenler_listesi:
-                continue
-                
-            for tren in trenler_listesi:
-                toplam_tren_sayaci += 1
-                tren_mesaj_taslagi = ""
-                vagon_bulundu_bu_trende = False
-                
-                try:
-                    timestamp_ms = tren["segments"][0]["departureTime"]
-                    timestamp_sn = timestamp_ms / 1000
-                    kalkis_saati_str = datetime.fromtimestamp(timestamp_sn).strftime("%H:%M")
-                    tren_adi = tren.get("trainName", f"Tren {toplam_tren_sayaci}")
-                    tren_tipi = tren.get("type", "")
-                    
-                    # Saat filtresi: Seçilen saatler varsa ve bu saat listede yoksa atla
-                    if selected_times and kalkis_saati_str not in selected_times:
-                        continue
-                    
-                    # Tren tipi varsa parantez içinde göster (örn: "Kalkış: 08:00 - YHT")
-                    tren_tipi_gosterim = get_train_type_display(tren_tipi) if tren_tipi else ""
-                    tip_bilgisi = f" - {tren_tipi_gosterim}" if tren_tipi_gosterim else ""
-                    tren_mesaj_taslagi += f"\n<b>{tren_adi} (Kalkış: {kalkis_saati_str}{tip_bilgisi})</b>:\n"
-                    
-                    vagon_bilgisi_sozlugu = tren["availableFareInfo"][0]
-                    vagon_siniflari_listesi = vagon_bilgisi_sozlugu["cabinClasses"]
-                    
-                    if not vagon_siniflari_listesi:
-                        continue
-
-                    for vagon in vagon_siniflari_listesi:
-                        sinif_adi = vagon["cabinClass"]["name"]
-                        uygun_koltuk = vagon["availabilityCount"]
-                        
-                        # İstenmeyen vagon tipleri
-                        unwanted_types = ["TEKERLEKLİ SANDALYE", "YATAKLI", "LOCA"]
-                        
-                        # Business filtresi
-                        if not include_business and "BUS" in sinif_adi.upper():
-                            continue
-                        
-                        if sinif_adi.upper() in unwanted_types:
-                            continue
-                        
-                        # Minimum koltuk filtresi
-                        if uygun_koltuk >= min_seats:
-                            bulunan_koltuk = True
-                            vagon_bulundu_bu_trende = True
-                            minimum_fiyat = vagon["minPrice"]
-                            tren_mesaj_taslagi += f"   ✅ <b>{sinif_adi}: {uygun_koltuk} adet</b> (min {minimum_fiyat} TRY)\n"
-
-                    if vagon_bulundu_bu_trende:
-                         result_message += tren_mesaj_taslagi
-                         
-                except (KeyError, IndexError, TypeError) as e:
-                    print(f"Parsing error: {e}")
-
-        if not bulunan_koltuk:
-            return (False, f"ℹ️ {route_str} yönüne sefer bulundu, ancak <b>kriterlere uygun yer bulunamadı</b>.")
-        else:
-            return (True, result_message)
-
-    except Exception as e:
-        return (False, f"❌ HATA: {e}")
+def run_sales_calendar(chat_id: str, routes: list):
+    from_label = station_names(dict.fromkeys(from_id for from_id, _ in routes))
+    to_label = station_names(dict.fromkeys(to_id for _, to_id in routes))
+    print(f"Takvim: {chat_id} | {from_label} -> {to_label}")
+    
+    started = time.monotonic()
+    today = get_now().date()
+    days = [datetime.combine(today + timedelta(days=i), datetime.min.time()) for i in range(SALES_HORIZON_DAYS)]
+    results = fetch_sales_calendar(routes, days)
+    
+    cabin_filter = CabinFilter(CABIN_KINDS)
+    lines = [f"📆 <b>{from_label} ➡ {to_label}</b>",
+             "<i>Vagon türü başına boş koltuk · en düşük fiyat</i>\n"]
+    for day, day_results in zip(days, results):
+        lines.append(f"<b>{day.strftime('%a %d.%m')}</b>: {summarize_calendar_day(day_results, cabin_filter)}")
+    
+    send_telegram_message("\n".join(lines), chat_id)
+    print(f"Takvim tamamlandı ({chat_id}, {time.monotonic() - started:.2f} sn).")
 
 def run_one_time_check(chat_id: str, from_id: int, to_id: int, target_date: datetime):
     from_station = get_station_by_id(from_id)
@@ -593,50 +2342,145 @@ def run_one_time_check(chat_id: str, from_id: int, to_id: int, target_date: date
     
     print(f"Tek seferlik kontrol: {chat_id} | {from_station['name']} -> {to_station['name']}")
     
-    found, message = check_api_and_parse(from_id, to_id, target_date)
+    found, message, _ = check_api_and_parse(from_id, to_id, target_date)
     send_telegram_message(message, chat_id)
     print(f"Tek seferlik kontrol tamamlandı ({chat_id}).")
 
+def run_multi_route_check(chat_id: str, routes: list, target_date: datetime):
+    print(f"Çoklu güzergah kontrolü: {chat_id} | {len(routes)} güzergah")
+    
+    found, message, _ = check_multiple_routes(routes, target_date)
+    send_telegram_message(message, chat_id)
+    print(f"Çoklu güzergah kontrolü tamamlandı ({chat_id}).")
+
 def monitoring_loop(chat_id: str, job_id: int, stop_event: threading.Event, from_id: int, to_id: int, 
                      target_date: datetime, interval_seconds: int,
-                     selected_times: list = None, include_business: bool = True, min_seats: int = 1):
+                     selected_times: list = None, include_business: bool = True, min_seats: int = 1,
+                     routes: list = None, mode: str = "seats", price_threshold: float = None,
+                     cabin_classes: list = None, passengers: list = None, time_ranges: list = None,
+                     live_board: bool = False, checkpoint: dict = None, wait_for_sale: bool = False):
     """
     Sürekli izleme döngüsü.
     
     Args:
         job_id: Bu izleme işinin benzersiz ID'si
         selected_times: Sadece bu saatlerdeki trenleri izle (None = hepsi)
-        include_business: Business sınıfını dahil et
+        time_ranges: Ek olarak izlenecek 'HH:MM-HH:MM' kalkış aralıkları
+        include_business: Business sınıfını dahil et (cabin_classes yoksa kullanılır)
         min_seats: Minimum koltuk sayısı filtresi
+        routes: Şehir/çoklu seçimde birlikte izlenen (kalkış, varış) çiftleri (None = tek güzergah)
+        mode: "seats" boş yer açılmasını, "price" fiyat düşüşlerini izler
+        price_threshold: Fiyat modunda bildirim eşiği (None = her düşüş)
+        cabin_classes: İzlenecek vagon türü kodları (CABIN_KINDS)
+        passengers: [(yolcu tipi, adet), ...] - sorgu bu dağılımla yapılır
+        live_board: Durum tek mesajda yerinde güncellenir, yer açılınca kısa bildirim gider
+        checkpoint: Her tur sonunda son görülen durumun yazıldığı sözlük (JSON'a uygun).
+            Dolu verilirse izleme kaldığı yerden, başlangıç mesajları tekrarlanmadan sürer.
+        wait_for_sale: Tarih henüz satışta değil; kontrol, ortak satış penceresi yoklaması
+            açılışı görünce başlar ve SALES_FAST_POLL_WINDOW_SECONDS boyunca sık yapılır.
     """
-    from_station = get_station_by_id(from_id)
-    to_station = get_station_by_id(to_id)
+    # Vagon filtresi iş başında bir kez derlenir
+    if cabin_classes:
+        cabin_filter = CabinFilter(cabin_classes)
+    else:
+        cabin_filter = CabinFilter.from_business_flag(include_business)
+
+    if routes:
+        from_label = station_names(dict.fromkeys(route[0] for route in routes))
+        to_label = station_names(dict.fromkeys(route[1] for route in routes))
+    else:
+        from_label = get_station_by_id(from_id)['name']
+        to_label = get_station_by_id(to_id)['name']
+    
+    # Saat filtresi ve izlemenin bitiş anı iş başında bir kez hesaplanır
+    time_windows = TimeWindows.compile(target_date, selected_times, time_ranges)
+    if time_windows is not None:
+        expires_at = time_windows.expires_at
+    else:
+        expires_at = istanbul_day_start(target_date) + 86400
     
     # Filtre özeti oluştur
     filter_info = []
-    if selected_times:
-        times_str = ", ".join(selected_times)
-        filter_info.append(f"⏰ Saatler: {times_str}")
-    else:
-        filter_info.append("⏰ Saatler: Tümü")
+    filter_info.append(f"⏰ Saatler: {describe_times(selected_times, time_ranges)}")
     
-    filter_info.append(f"💼 Business: {'Dahil' if include_business else 'Hariç'}")
-    filter_info.append(f"👥 Min. Koltuk: {min_seats}")
+    filter_info.append(f"🎫 Sınıflar: {cabin_filter.describe()}")
+    if passengers:
+        passengers = normalize_passengers(passengers)
+        filter_info.append(f"👥 Yolcular: {describe_passengers(passengers)}")
+    else:
+        filter_info.append(f"👥 Min. Koltuk: {min_seats}")
+    if mode == "price":
+        filter_info.append(f"💸 Fiyat: {format_price_threshold(price_threshold)}")
     
     filter_summary = "\n".join(filter_info)
     
-    print(f"API İzleme başladı: {chat_id} | {from_station['name']} -> {to_station['name']}")
-    send_telegram_message(
-        f"🚂 *Takip başladı!*\n\n"
-        f"*{from_station['name']} ➡ {to_station['name']}*\n"
-        f"📅 {target_date.strftime('%d %B %Y')}\n\n"
-        f"*Filtreler:*\n{filter_summary}\n\n"
-        f"🔄 {interval_seconds} saniyede bir kontrol edilecek.",
-        chat_id
-    )
+    if checkpoint is None:
+        checkpoint = {}
+    checkpoint.pop("handoff", None)
+    resumed = bool(checkpoint)
+    previous_state = dict(checkpoint.get("previous_state", {}))
+    first_check = checkpoint.get("first_check", True)
+    board_text = checkpoint.get("board_text")  # Canlı panonun son içeriği (değişmediyse düzenleme yapılmaz)
+    # Fiyat modu: {(kalkış sn, vagon sınıfı, güzergah): kuruş}
+    last_prices = {tuple(key): value for key, value in checkpoint.get("last_prices", [])}
+    awaiting_sale = wait_for_sale and checkpoint.get("awaiting_sale", True)
+    fast_until = 0  # Satış bu çalışmada açıldıysa sık kontrolün bittiği an
+    
+    def save_checkpoint():
+        checkpoint.update(
+            previous_state=dict(previous_state),
+            first_check=first_check,
+            board_text=board_text,
+            last_prices=[[list(key), value] for key, value in last_prices.items()],
+            awaiting_sale=awaiting_sale
+        )
+    
+    # Turun başarılı sayılması için bu anahtarlardan en az biri için taze API yanıtı gerekir
+    poll_keys = [route_key(route[0], route[1], target_date) + passengers_key(passengers)
+                 for route in (routes or [(from_id, to_id)])]
+    publish_heartbeat(job_id, chat_id, interval_seconds, stop_event, checkpoint)
+    poll_scheduler.subscribe(job_id, poll_keys)
+    
+    if resumed:
+        print(f"API İzleme kaldığı yerden devam ediyor: {chat_id} | {from_label} -> {to_label}")
+    else:
+        print(f"API İzleme başladı: {chat_id} | {from_label} -> {to_label}")
+        if awaiting_sale:
+            opening = datetime.fromtimestamp(projected_sales_opening(target_date), TZ_ISTANBUL)
+            schedule_note = (f"⏳ Bu tarih henüz satışa açılmadı (tahmini açılış: {opening.strftime('%d %B %Y')}).\n"
+                             f"Açıldığı anda kontrol başlayacak ve ilk {SALES_FAST_POLL_WINDOW_SECONDS // 60} dakika "
+                             f"{SALES_FAST_POLL_SECONDS} saniyede bir, sonra {interval_seconds} saniyede bir yapılacak.")
+        else:
+            schedule_note = f"🔄 {interval_seconds} saniyede bir kontrol edilecek."
+        send_telegram_message(
+            f"🚂 *Takip başladı!*\n\n"
+            f"*{from_label} ➡ {to_label}*\n"
+            f"📅 {target_date.strftime('%d %B %Y')}\n\n"
+            f"*Filtreler:*\n{filter_summary}\n\n"
+            f"{schedule_note}",
+            chat_id
+        )
+    # Başlangıç mesajı gitti: iş bundan sonra devralınırsa/yeniden başlatılırsa kaldığı yerden sürer
+    save_checkpoint()
     
-    previous_state = {}
-    first_check = True
+    if awaiting_sale:
+        # Yoklamayı ortak izleyici yapar; iş sadece nabız verip açılışı bekler
+        sale_opened = sales_watcher.watch(job_id, routes or [(from_id, to_id)], target_date)
+        last_beat = time.monotonic()
+        while not sale_opened.wait(1) and not stop_event.is_set():
+            # Tarih hiç satışa açılmadan geçtiyse bekleme biter; aşağıdaki döngü
+            # ilk turda işi "Takip Otomatik Durduruldu" mesajıyla sonlandırır
+            if time.time() > expires_at:
+                break
+            if time.monotonic() - last_beat >= interval_seconds:
+                publish_heartbeat(job_id, chat_id, interval_seconds, stop_event, checkpoint)
+                last_beat = time.monotonic()
+        sales_watcher.unwatch(job_id, sale_opened)
+        if sale_opened.is_set():
+            print(f"Tarih satışa açıldı, hızlı kontrole geçiliyor ({chat_id}, Job #{job_id}).")
+            awaiting_sale = False
+            fast_until = time.time() + SALES_FAST_POLL_WINDOW_SECONDS
+            save_checkpoint()
     
     now_init = get_now()
     last_daily_message_date = now_init.date() if now_init.hour >= 9 else (now_init.date() - timedelta(days=1))
@@ -645,26 +2489,10 @@ def monitoring_loop(chat_id: str, job_id: int, stop_event: threading.Event, from
         now = get_now()
         
         # Sefer saati geçti mi kontrolü
-        is_past = False
-        if selected_times:
-            try:
-                max_time_str = max(selected_times)
-                max_time = datetime.strptime(max_time_str, "%H:%M").time()
-                latest_departure = datetime.combine(target_date.date(), max_time, tzinfo=TZ_ISTANBUL)
-                if now > latest_departure:
-                    is_past = True
-            except Exception as e:
-                print(f"Time parse error: {e}")
-                if now.date() > target_date.date():
-                    is_past = True
-        else:
-            if now.date() > target_date.date():
-                is_past = True
-                
-        if is_past:
+        if time.time() > expires_at:
             send_telegram_message(
                 f"🛑 *Takip Otomatik Durduruldu*\n\n"
-                f"*{from_station['name']} ➡ {to_station['name']}*\n"
+                f"*{from_label} ➡ {to_label}*\n"
                 f"📅 {target_date.strftime('%d %B %Y')}\n\n"
                 f"Sefer tarihi ve saati geçtiği için bu izleme görevi otomatik olarak sonlandırıldı.",
                 chat_id
@@ -678,7 +2506,7 @@ def monitoring_loop(chat_id: str, job_id: int, stop_event: threading.Event, from
                 f"👋 Merhaba, biletini satın aldın mı?\n"
                 f"Eğer satın aldıysan, sürekli izlemeyi durdurmayı düşünebilirsin.\n\n"
                 f"📌 *Mevcut İzleme:*\n"
-                f"*{from_station['name']} ➡ {to_station['name']}*\n"
+                f"*{from_label} ➡ {to_label}*\n"
                 f"📅 {target_date.strftime('%d %B %Y')}\n"
                 f"{filter_summary}"
             )
@@ -686,45 +2514,55 @@ def monitoring_loop(chat_id: str, job_id: int, stop_event: threading.Event, from
             last_daily_message_date = now.date()
 
         print(f"API Kontrol ediliyor ({chat_id})...")
+        round_started = time.monotonic()
+        wait_seconds = SALES_FAST_POLL_SECONDS if time.time() < fast_until else interval_seconds
+        # Aynı güzergah/tarihi izleyen işler tek sorguyu paylaşır
+        fetch_max_age = wait_seconds / 2
         
-        found, message = check_api_and_parse(from_id, to_id, target_date, 
-                                              selected_times, include_business, min_seats)
+        if mode == "price":
+            check_price_changes(chat_id, routes or [(from_id, to_id)], target_date, time_windows,
+                                cabin_filter, min_seats, price_threshold, last_prices,
+                                first_check, fetch_max_age, passengers)
+            first_check = False
+            save_checkpoint()
+            publish_heartbeat(job_id, chat_id, interval_seconds, stop_event, checkpoint,
+                              poll_succeeded(poll_keys, round_started - fetch_max_age))
+            if stop_event.wait(wait_seconds):
+                break
+            continue
         
-        current_state = {}
+        if routes:
+            # Tüm güzergahlar aynı turda eşzamanlı sorgulanır
+            found, message, trains = check_multiple_routes(routes, target_date, cabin_filter,
+                                                           min_seats, time_windows, fetch_max_age, passengers)
+        else:
+            found, message, trains = check_api_and_parse(from_id, to_id, target_date, 
+                                                          time_windows, cabin_filter, min_seats,
+                                                          fetch_max_age, passengers)
         
-        if found:
-            lines = message.split('\n')
-            current_train = None
-            current_train_total = 0
-            
-            for line in lines:
-                if line.strip().startswith('<b>') and 'Kalkış:' in line:
-                    if current_train:
-                        current_state[current_train] = current_train_total
-                    
-                    train_info = line.split('(Kalkış:')[0].strip()
-                    train_info = train_info.replace('<b>', '').replace('</b>', '')
-                    current_train = train_info
-                    current_train_total = 0
-                
-                elif '✅' in line and 'adet' in line:
-                    try:
-                        seat_count = int(line.split(':')[1].split('adet')[0].strip())
-                        current_train_total += seat_count
-                    except:
-                        pass
-            
-            if current_train:
-                current_state[current_train] = current_train_total
+        # Değişiklik tespiti yapısal tren verisinden; mesaj metni sadece çıktı içindir
+        current_state = seat_state(trains)
+        
+        if live_board:
+            new_board_text = message if found else f"ℹ️ Şu anda kriterlere uygun yer bulunmuyor.\n\n{filter_summary}"
+            if new_board_text != board_text:
+                board_text = new_board_text
+                update_live_board(
+                    chat_id, job_id,
+                    f"📌 <b>Canlı Durum #{job_id}</b>\n\n{board_text}\n\n🕒 Son değişiklik: {get_now().strftime('%H:%M')}"
+                )
         
         if first_check:
+            opened_note = "🔔 Tarih satışa açıldı!\n\n" if fast_until else ""
             if found:
                 print(f"İLK KONTROL - BOŞ YER BULUNDU! ({chat_id})")
-                send_telegram_message("🎫 İLK KONTROL - BİLET DURUMU:\n\n" + message, chat_id)
+                if not live_board:
+                    send_telegram_message(opened_note + "🎫 İLK KONTROL - BİLET DURUMU:\n\n" + message, chat_id)
                 previous_state = current_state.copy()
             else:
                 print(f"İLK KONTROL - BOŞ YER YOK ({chat_id})")
-                send_telegram_message("ℹ️ İlk kontrol tamamlandı. Şu anda kriterlere uygun yer bulunmuyor. Yer açıldığında bildirim alacaksınız.", chat_id)
+                if not live_board:
+                    send_telegram_message(opened_note + "ℹ️ İlk kontrol tamamlandı. Şu anda kriterlere uygun yer bulunmuyor. Yer açıldığında bildirim alacaksınız.", chat_id)
             first_check = False
         
         else:
@@ -744,38 +2582,758 @@ def monitoring_loop(chat_id: str, job_id: int, stop_event: threading.Event, from
                 
                 if changes_detected:
                     print(f"DEĞİŞİKLİK TESPİT EDİLDİ! ({chat_id})")
-                    change_message += "\n" + message
+                    if live_board:
+                        # Ayrıntılar panoda; burada sadece kısa bildirim
+                        change_message += f"\n📌 Güncel durum #{job_id} canlı durum mesajında."
+                    else:
+                        change_message += "\n" + message
                     send_telegram_message(change_message, chat_id)
                     previous_state = current_state.copy()
                 else:
                     print(f"Değişiklik yok, mesaj atılmadı ({chat_id})")
             
-            elif previous_state:
-                print(f"TÜM YERLER DOLDU! ({chat_id})")
-                send_telegram_message("❌ Daha önce uygun olan yerler doldu. Yeni yer açılmasını bekliyorum...", chat_id)
-                previous_state = {}
-        
-        print(f"{interval_seconds} saniye bekleniyor...")
-        if stop_event.wait(interval_seconds):
-            break
+            elif previous_state:
+                print(f"TÜM YERLER DOLDU! ({chat_id})")
+                if not live_board:
+                    send_telegram_message("❌ Daha önce uygun olan yerler doldu. Yeni yer açılmasını bekliyorum...", chat_id)
+                previous_state = {}
+        
+        save_checkpoint()
+        publish_heartbeat(job_id, chat_id, interval_seconds, stop_event, checkpoint,
+                          poll_succeeded(poll_keys, round_started - fetch_max_age))
+        print(f"{wait_seconds} saniye bekleniyor...")
+        if stop_event.wait(wait_seconds):
+            break
+            
+    print(f"API İzleme durdu ({chat_id}, Job #{job_id}).")
+    # Kapanışta veya başka worker'a devredilirken pano açık kalır
+    if live_board and board_text is not None and not shutdown_event.is_set() and not checkpoint.get("handoff"):
+        update_live_board(chat_id, job_id, f"📌 <b>Canlı Durum #{job_id}</b>\n\n{board_text}\n\n🛑 İzleme sona erdi.")
+    owned = retire_heartbeat(job_id)
+    if owned:
+        poll_scheduler.unsubscribe(job_id)
+    # Watchdog işi yeniden başlattıysa pano mesajı yeni thread'indir; ikinci pano açılmasın
+    if owned or job_id not in chat_jobs(chat_id):
+        live_boards.pop(job_id, None)
+    # Watchdog işi yeniden başlattıysa kayıt artık yeni thread'indir
+    if remove_monitor_job(chat_id, job_id, stop_event):
+        print(f"İzleme işi listeden kaldırıldı ({chat_id}, Job #{job_id}).")
+
+def route_key(from_id: int, to_id: int, target_date: datetime) -> str:
+    return f"{from_id}:{to_id}:{target_date.strftime('%Y-%m-%d')}"
+
+def poll_succeeded(keys: list, since: float) -> bool:
+    """Anahtarlardan biri için `since` (monotonic) sonrasında alınmış başarılı API yanıtı var mı"""
+    for key in keys:
+        cached = route_cache.get(key)
+        if cached is not None and cached[0] >= since:
+            return True
+    return False
+
+job_heartbeats = {}  # {job_id: {...}} - izleme thread'lerinin paylaşılan nabız tablosu
+_heartbeat_lock = threading.Lock()
+watchdog_state = {"last_tick": None, "restarts": 0}
+
+def publish_heartbeat(job_id: int, chat_id: str, interval_seconds: int, stop_event, checkpoint: dict,
+                      ok: bool = None):
+    """
+    İzleme turunun nabzını yazar. ok=None sadece canlılık bildirir;
+    True/False son başarılı sorgu zamanını veya art arda hata sayısını günceller.
+    """
+    now = time.monotonic()
+    with _heartbeat_lock:
+        beat = job_heartbeats.get(job_id)
+        if beat is None or beat["thread"] is not threading.current_thread():
+            beat = job_heartbeats[job_id] = {
+                "chat_id": chat_id,
+                "interval": interval_seconds,
+                "thread": threading.current_thread(),
+                "stop_event": stop_event,
+                "checkpoint": checkpoint,
+                "last_success": None,
+                "failures": 0,
+            }
+        beat["last_beat"] = now
+        if ok is True:
+            beat["last_success"] = time.time()
+            beat["failures"] = 0
+            checkpoint.pop("watchdog_restarts", None)
+        elif ok is False:
+            beat["failures"] += 1
+            if beat["failures"] == WATCHDOG_MAX_FAILURES:
+                print(f"⚠️ Watchdog: Job #{job_id} art arda {beat['failures']} turdur sorgulanamıyor.")
+
+def retire_heartbeat(job_id: int):
+    """
+    Düzgün biten işin nabzını siler; tabloda kalan ölü thread'ler çökmüş sayılır.
+    Returns: iş hâlâ bu thread'e aitse True (watchdog yenisini başlattıysa False)
+    """
+    with _heartbeat_lock:
+        beat = job_heartbeats.get(job_id)
+        if beat is not None and beat["thread"] is threading.current_thread():
+            del job_heartbeats[job_id]
+            return True
+        return False
+
+def watchdog_loop(restart_job):
+    """
+    Nabzı N x aralıktan eski (takılmış) veya beklenmedik şekilde ölmüş işleri bulur
+    ve restart_job(job_id, beat, give_up) ile yeniden başlatır. Takılan thread öldürülemez;
+    durdurulur ve uyandığında sessizce çıkar. Başarılı tur görmeden
+    WATCHDOG_MAX_RESTARTS kez yeniden başlatılan iş kalıcı olarak durdurulur.
+    """
+    while not shutdown_event.wait(WATCHDOG_INTERVAL_SECONDS):
+        now = time.monotonic()
+        watchdog_state["last_tick"] = now
+        with _heartbeat_lock:
+            beats = list(job_heartbeats.items())
+        
+        for job_id, beat in beats:
+            silent_for = now - beat["last_beat"]
+            if not beat["thread"].is_alive():
+                reason = "thread beklenmedik şekilde sonlandı"
+            elif silent_for > WATCHDOG_STALE_FACTOR * beat["interval"] + WATCHDOG_INTERVAL_SECONDS:
+                reason = f"{silent_for:.0f} sn'dir nabız yok"
+            else:
+                continue
+            
+            with _heartbeat_lock:
+                if job_heartbeats.get(job_id) is not beat:
+                    continue
+                del job_heartbeats[job_id]
+            restarts = beat["checkpoint"].get("watchdog_restarts", 0) + 1
+            beat["checkpoint"]["watchdog_restarts"] = restarts
+            give_up = restarts > WATCHDOG_MAX_RESTARTS
+            print(f"🐕 Watchdog: Job #{job_id} {'durduruluyor' if give_up else 'yeniden başlatılıyor'} ({reason}).")
+            # Eski thread uyanırsa bitiş bildirimi göndermeden çıksın
+            beat["checkpoint"]["handoff"] = True
+            beat["stop_event"].set()
+            try:
+                restart_job(job_id, beat, give_up)
+                if give_up:
+                    poll_scheduler.unsubscribe(job_id)
+                    send_telegram_message(
+                        f"⚠️ #{job_id} numaralı izleme tekrarlayan hatalar nedeniyle durduruldu. "
+                        f"Lütfen /monitor ile yeniden başlatın.",
+                        beat["chat_id"]
+                    )
+                else:
+                    watchdog_state["restarts"] += 1
+            except Exception as e:
+                print(f"Watchdog yeniden başlatma hatası (Job #{job_id}): {e}")
+
+def restart_local_job(job_id: int, beat: dict, give_up: bool = False):
+    entry = chat_jobs(beat["chat_id"]).get(job_id)
+    if entry is None or entry.get("spec") is None:
+        return
+    if give_up:
+        remove_monitor_job(beat["chat_id"], job_id)
+        return
+    checkpoint = {key: value for key, value in beat["checkpoint"].items() if key != "handoff"}
+    start_monitor_job(beat["chat_id"], entry["spec"], entry["info"], job_id=job_id, checkpoint=checkpoint)
+
+def health_report() -> dict:
+    """/healthz ve /readyz için süreç, TCDD API, token ve izleme gecikmesi özeti"""
+    now = time.monotonic()
+    with _heartbeat_lock:
+        beats = list(job_heartbeats.values())
+    lag = max((max(0.0, now - beat["last_beat"] - beat["interval"]) for beat in beats), default=0.0)
+    
+    token_age = now - _token_cache["fetched_at"] if _token_cache["token"] else None
+    # Token ilk sorguda alınır ve süresi dolunca yenilenir; sadece son yenileme başarısızsa sorun vardır
+    token_fresh = upstream_status["token_ok"] is not False
+    # Hata serisi, sonrasında hiç sorgu yapılmadıysa 5 dakika sonra hükmünü yitirir
+    upstream_ok = (upstream_status["consecutive_errors"] < WATCHDOG_MAX_FAILURES
+                   or time.time() - upstream_status["last_error"] > 300)
+    last_tick = watchdog_state["last_tick"]
+    
+    return {
+        "alive": last_tick is None or now - last_tick <= 3 * WATCHDOG_INTERVAL_SECONDS,
+        "ready": bool(STATIONS_DATA) and upstream_ok and token_fresh and lag <= READY_MAX_LAG_SECONDS,
+        "stations_loaded": bool(STATIONS_DATA),
+        "upstream": dict(upstream_status, ok=upstream_ok),
+        "token_age_seconds": round(token_age) if token_age is not None else None,
+        "token_ttl_seconds": TOKEN_TTL_SECONDS,
+        "token_fresh": token_fresh,
+        "jobs": len(beats),
+        "failing_jobs": sum(1 for beat in beats if beat["failures"] >= WATCHDOG_MAX_FAILURES),
+        "scheduler_lag_seconds": round(lag, 1),
+        "empty_routes_backing_off": len(negative_routes),
+        "empty_route_polls_skipped": negative_routes.skipped,
+        "sales_windows_watched": len(sales_watcher),
+        "sales_window_probes": sales_watcher.probes,
+        "watchdog_restarts": watchdog_state["restarts"],
+    }
+
+def start_health_server(port: int):
+    """Orkestrasyon için /healthz (canlılık) ve /readyz (hazır olma) uç noktaları"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class HealthHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/healthz", "/readyz"):
+                self.send_error(404)
+                return
+            report = health_report()
+            healthy = report["alive"] if self.path == "/healthz" else report["ready"]
+            body = json.dumps(report, ensure_ascii=False).encode()
+            self.send_response(200 if healthy else 503)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Sondalar her birkaç saniyede gelir; loglara yazılmaz
+
+    try:
+        server = ThreadingHTTPServer(("0.0.0.0", port), HealthHandler)
+    except OSError as e:
+        # Aynı makinede portu başka süreç tutuyor olabilir; izleme sağlık ucu olmadan sürer
+        print(f"⚠️ Sağlık uç noktaları başlatılamadı (port {port}): {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="health", daemon=True).start()
+    print(f"🩺 Sağlık uç noktaları: http://0.0.0.0:{port}/healthz, /readyz")
+    return server
+
+def start_watchdog(restart_job):
+    threading.Thread(target=watchdog_loop, args=(restart_job,), name="watchdog", daemon=True).start()
+    port = WORKER_HEALTH_PORT if RUN_MODE == "worker" else HEALTH_PORT
+    if port:
+        start_health_server(port)
+
+def _ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+def build_hash_ring(node_ids: list, replicas: int = 64) -> tuple:
+    """
+    Worker ID'leri için consistent hashing halkası oluşturur.
+    Returns: (sıralı hash listesi, aynı sırada node listesi)
+    """
+    ring = sorted((_ring_hash(f"{node}#{i}"), node) for node in node_ids for i in range(replicas))
+    return [h for h, _ in ring], [node for _, node in ring]
+
+def shard_owner(ring: tuple, key: str):
+    """Verilen güzergah anahtarının (route, date) hangi worker'a düştüğünü bulur."""
+    hashes, nodes = ring
+    if not hashes:
+        return None
+    idx = bisect.bisect(hashes, _ring_hash(key)) % len(hashes)
+    return nodes[idx]
+
+def encode_job_spec(spec: dict) -> str:
+    data = dict(spec)
+    data["target_date"] = spec["target_date"].strftime("%Y-%m-%d")
+    return json.dumps(data)
+
+def decode_job_spec(raw: str) -> dict:
+    spec = json.loads(raw)
+    spec["target_date"] = datetime.strptime(spec["target_date"], "%Y-%m-%d")
+    if spec.get("routes"):
+        spec["routes"] = [tuple(route) for route in spec["routes"]]
+    return spec
+
+class JobBroker:
+    """
+    SQLite tabanlı yerel broker.
+    Ön yüz izleme işlerini buraya yazar, worker'lar işleri alır ve
+    bildirimleri outbox tablosu üzerinden ön yüze geri gönderir.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT NOT NULL,
+            route_key TEXT NOT NULL,
+            spec TEXT NOT NULL,
+            info TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'active',
+            created REAL NOT NULL,
+            checkpoint TEXT,
+            owner TEXT
+        );
+        CREATE TABLE IF NOT EXISTS workers (
+            worker_id TEXT PRIMARY KEY,
+            last_seen REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT NOT NULL,
+            text TEXT NOT NULL,
+            created REAL NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'message',
+            job_id INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS boards (
+            job_id INTEGER PRIMARY KEY,
+            chat_id TEXT NOT NULL,
+            message_id INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+        
+        # Eski broker dosyalarında outbox'a canlı pano kolonlarını ekle
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(outbox)")}
+        if "kind" not in columns:
+            conn.execute("ALTER TABLE outbox ADD COLUMN kind TEXT NOT NULL DEFAULT 'message'")
+        if "job_id" not in columns:
+            conn.execute("ALTER TABLE outbox ADD COLUMN job_id INTEGER")
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if "checkpoint" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN checkpoint TEXT")
+        if "owner" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 bağlantıları thread'ler arasında paylaşılamaz
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def submit_job(self, chat_id: str, spec: dict, info: dict) -> int:
+        key = route_key(spec["from_id"], spec["to_id"], spec["target_date"])
+        cursor = self._conn().execute(
+            "INSERT INTO jobs (chat_id, route_key, spec, info, created) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, key, encode_job_spec(spec), json.dumps(info), time.time())
+        )
+        return cursor.lastrowid
+
+    def cancel_job(self, job_id: int):
+        self._conn().execute("UPDATE jobs SET status = 'cancelled' WHERE job_id = ? AND status = 'active'", (job_id,))
+
+    def finish_job(self, job_id: int):
+        self._conn().execute("UPDATE jobs SET status = 'done' WHERE job_id = ? AND status = 'active'", (job_id,))
+
+    def save_checkpoint(self, job_id: int, checkpoint: dict):
+        """İşi devralan worker'ın kaldığı yerden sürdürebilmesi için son görülen durumu yazar."""
+        self._conn().execute(
+            "UPDATE jobs SET checkpoint = ? WHERE job_id = ? AND status = 'active'",
+            (json.dumps(checkpoint, ensure_ascii=False), job_id)
+        )
+
+    def claim_job(self, job_id: int, worker_id: str, max_age: float):
+        """
+        İşi worker'a kiralar. İş sahipsizse, zaten bu worker'ınsa ya da sahibi artık
+        canlı değilse alınır; önceki sahip checkpoint'i yazıp bırakana kadar alınamaz.
+        Returns: Güncel iş satırı veya None
+        """
+        cursor = self._conn().execute(
+            "UPDATE jobs SET owner = ? WHERE job_id = ? AND status = 'active' AND "
+            "(owner IS NULL OR owner = ? OR owner NOT IN (SELECT worker_id FROM workers WHERE last_seen >= ?))",
+            (worker_id, job_id, worker_id, time.time() - max_age)
+        )
+        if not cursor.rowcount:
+            return None
+        row = self._conn().execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def release_job(self, job_id: int, worker_id: str, checkpoint: dict = None):
+        """Son durumu yazıp kirayı bırakır; iş yeni sahibinde kaldığı yerden sürer."""
+        self._conn().execute(
+            "UPDATE jobs SET owner = NULL, checkpoint = COALESCE(?, checkpoint) WHERE job_id = ? AND owner = ?",
+            (json.dumps(checkpoint, ensure_ascii=False) if checkpoint else None, job_id, worker_id)
+        )
+
+    def job_status(self, job_id: int):
+        row = self._conn().execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row["status"] if row else None
+
+    def active_jobs(self) -> list:
+        rows = self._conn().execute("SELECT * FROM jobs WHERE status = 'active' ORDER BY job_id").fetchall()
+        return [dict(row) for row in rows]
+
+    def heartbeat(self, worker_id: str):
+        self._conn().execute(
+            "INSERT INTO workers (worker_id, last_seen) VALUES (?, ?) "
+            "ON CONFLICT(worker_id) DO UPDATE SET last_seen = excluded.last_seen",
+            (worker_id, time.time())
+        )
+
+    def retire_worker(self, worker_id: str):
+        """Kapanan worker halkadan hemen çıkar; işleri TTL beklenmeden devredilir."""
+        self._conn().execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+
+    def live_workers(self, max_age: float) -> list:
+        rows = self._conn().execute(
+            "SELECT worker_id FROM workers WHERE last_seen >= ? ORDER BY worker_id",
+            (time.time() - max_age,)
+        ).fetchall()
+        return [row["worker_id"] for row in rows]
+
+    def push_notification(self, chat_id: str, text: str):
+        self._conn().execute(
+            "INSERT INTO outbox (chat_id, text, created) VALUES (?, ?, ?)",
+            (chat_id, text, time.time())
+        )
+
+    def push_board(self, chat_id: str, job_id: int, text: str):
+        self._conn().execute(
+            "INSERT INTO outbox (chat_id, text, created, kind, job_id) VALUES (?, ?, ?, 'board', ?)",
+            (chat_id, text, time.time(), job_id)
+        )
+
+    def board_message(self, job_id: int):
+        row = self._conn().execute("SELECT message_id FROM boards WHERE job_id = ?", (job_id,)).fetchone()
+        return row["message_id"] if row else None
+
+    def set_board_message(self, job_id: int, chat_id: str, message_id: int):
+        self._conn().execute(
+            "INSERT INTO boards (job_id, chat_id, message_id) VALUES (?, ?, ?) "
+            "ON CONFLICT(job_id) DO UPDATE SET message_id = excluded.message_id",
+            (job_id, chat_id, message_id)
+        )
+
+    def clear_boards(self, active_job_ids: set):
+        rows = self._conn().execute("SELECT job_id FROM boards").fetchall()
+        for row in rows:
+            if row["job_id"] not in active_job_ids:
+                self._conn().execute("DELETE FROM boards WHERE job_id = ?", (row["job_id"],))
+
+    def pop_notifications(self, limit: int = 50) -> list:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute("SELECT * FROM outbox ORDER BY id LIMIT ?", (limit,)).fetchall()
+            if rows:
+                conn.execute("DELETE FROM outbox WHERE id <= ?", (rows[-1]["id"],))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [dict(row) for row in rows]
+
+class BrokerStopEvent:
+    """threading.Event arayüzünü taklit eder; set() işi broker'da iptal eder."""
+
+    def __init__(self, broker: JobBroker, job_id: int):
+        self.broker = broker
+        self.job_id = job_id
+
+    def set(self):
+        self.broker.cancel_job(self.job_id)
+
+    def is_set(self) -> bool:
+        return self.broker.job_status(self.job_id) != 'active'
+
+def chat_quota(chat_id: str) -> tuple:
+    """Returns: (en fazla izleme sayısı, en kısa kontrol aralığı sn)"""
+    override = CHAT_QUOTAS.get(str(chat_id), {})
+    return (int(override.get("max_jobs", MAX_JOBS_PER_CHAT)),
+            int(override.get("min_interval", MIN_INTERVAL_SECONDS)))
+
+def chat_jobs(chat_id: str) -> dict:
+    """Sohbetin izleme işlerinin anlık kopyası (thread'ler değiştirirken güvenle gezilebilir)"""
+    with monitor_jobs_lock:
+        return dict(monitor_jobs.get(chat_id, {}))
+
+def remove_monitor_job(chat_id: str, job_id: int, stop_event=None) -> bool:
+    """
+    İşi kayıttan siler; sohbetin başka işi kalmadıysa sohbeti de.
+    stop_event verilirse kayıt yalnızca hâlâ o thread'e aitse silinir.
+    """
+    with monitor_jobs_lock:
+        entry = monitor_jobs.get(chat_id, {}).get(job_id)
+        if entry is None or (stop_event is not None and entry["stop_event"] is not stop_event):
+            return False
+        del monitor_jobs[chat_id][job_id]
+        if not monitor_jobs[chat_id]:  # Kullanıcının başka izlemesi kalmadıysa
+            del monitor_jobs[chat_id]
+        return True
+
+def quota_exceeded_message(chat_id: str):
+    """Sohbet izleme kotasını doldurduysa kullanıcıya gösterilecek mesaj, yoksa None."""
+    max_jobs, _ = chat_quota(chat_id)
+    if len(chat_jobs(chat_id)) >= max_jobs:
+        return (f"⚠️ En fazla {max_jobs} aktif izlemeniz olabilir.\n"
+                f"Yeni izleme için /stop ile birini durdurun.")
+    return None
+
+def start_monitor_job(chat_id: str, spec: dict, info: dict, job_id: int = None, checkpoint: dict = None) -> int:
+    """
+    İzleme işini başlatır.
+    Tek süreç modunda yerel thread açar, frontend modunda işi broker'a yazar.
+    job_id/checkpoint yalnızca yeniden başlatmada kaydedilen işi geri yüklerken verilir.
+    """
+    global job_id_counter
+
+    if job_broker is not None:
+        job_id = job_broker.submit_job(chat_id, spec, info)
+        stop_event = BrokerStopEvent(job_broker, job_id)
+        monitor_thread = None
+    else:
+        with monitor_jobs_lock:
+            if job_id is None:
+                job_id_counter += 1
+                job_id = job_id_counter
+            else:
+                job_id_counter = max(job_id_counter, job_id)
+        if checkpoint is None:
+            checkpoint = {}
+        stop_event = threading.Event()
+        # Kapanışta shutdown_monitors() thread'leri durdurup bekler; süreyi aşanlar süreci tutmasın
+        monitor_thread = threading.Thread(
+            target=monitoring_loop,
+            args=(chat_id, job_id, stop_event),
+            kwargs=dict(spec, checkpoint=checkpoint),
+            daemon=True
+        )
+
+    with monitor_jobs_lock:
+        if chat_id not in monitor_jobs:
+            monitor_jobs[chat_id] = {}
+
+        monitor_jobs[chat_id][job_id] = {
+            "thread": monitor_thread,
+            "stop_event": stop_event,
+            "info": info
+        }
+        if monitor_thread:
+            monitor_jobs[chat_id][job_id].update(spec=spec, checkpoint=checkpoint)
+
+    if monitor_thread:
+        monitor_thread.start()
+    return job_id
+
+def restore_broker_jobs():
+    """Frontend yeniden başladığında broker'daki aktif işleri monitor_jobs'a geri yükler."""
+    for job in job_broker.active_jobs():
+        with monitor_jobs_lock:
+            monitor_jobs.setdefault(job["chat_id"], {})[job["job_id"]] = {
+                "thread": None,
+                "stop_event": BrokerStopEvent(job_broker, job["job_id"]),
+                "info": json.loads(job["info"])
+            }
+
+def shutdown_monitors():
+    """
+    Yerel izleme thread'lerini durdurur, süren sorgu ve bildirimlerin bitmesini
+    SHUTDOWN_GRACE_SECONDS boyunca bekler ve işlerin son durumunu CHECKPOINT_PATH'e yazar.
+    """
+    shutdown_event.set()
+    with monitor_jobs_lock:
+        jobs = [
+            (chat_id, job_id, entry, live_boards.get(job_id))
+            for chat_id, jobs_by_id in monitor_jobs.items()
+            for job_id, entry in jobs_by_id.items()
+            if entry["thread"] is not None
+        ]
+    if not jobs:
+        return
+    
+    print(f"🛑 Kapanıyor: {len(jobs)} izleme durduruluyor...")
+    for _, _, entry, _ in jobs:
+        entry["stop_event"].set()
+    
+    deadline = time.monotonic() + SHUTDOWN_GRACE_SECONDS
+    for _, job_id, entry, _ in jobs:
+        entry["thread"].join(max(0, deadline - time.monotonic()))
+        if entry["thread"].is_alive():
+            print(f"⚠️ Job #{job_id} süre içinde bitmedi, son kaydedilen durumu kullanılacak.")
+    
+    saved = [
+        {
+            "chat_id": chat_id,
+            "job_id": job_id,
+            "spec": encode_job_spec(entry["spec"]),
+            "info": entry["info"],
+            "checkpoint": entry["checkpoint"],
+            "board_message_id": board_message_id
+        }
+        for chat_id, job_id, entry, board_message_id in jobs
+    ]
+    tmp_path = CHECKPOINT_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"saved_at": time.time(), "jobs": saved}, f, ensure_ascii=False)
+    os.replace(tmp_path, CHECKPOINT_PATH)
+    print(f"💾 {len(saved)} izlemenin durumu kaydedildi: {CHECKPOINT_PATH}")
+
+def restore_checkpoint():
+    """Tek süreç modunda, kapanışta kaydedilen izlemeleri kaldıkları yerden başlatır."""
+    try:
+        with open(CHECKPOINT_PATH, encoding="utf-8") as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        print(f"⚠️ İzleme durumu okunamadı: {e}")
+        return
+    # Dosya bir kez kullanılır; çökme sonrası eski (durdurulmuş) işler geri gelmesin
+    os.remove(CHECKPOINT_PATH)
+    
+    for job in saved.get("jobs", []):
+        if job.get("board_message_id") is not None:
+            live_boards[job["job_id"]] = job["board_message_id"]
+        start_monitor_job(job["chat_id"], decode_job_spec(job["spec"]), job["info"],
+                          job_id=job["job_id"], checkpoint=job["checkpoint"])
+    print(f"♻️ {len(saved.get('jobs', []))} izleme kaldığı yerden devam ediyor.")
+
+async def deliver_live_board(application, item: dict):
+    """Worker'dan gelen canlı pano içeriğini işin mesajında düzenler (yoksa gönderir)."""
+    message_id = await asyncio.to_thread(job_broker.board_message, item["job_id"])
+    if message_id is not None:
+        try:
+            await application.bot.edit_message_text(
+                chat_id=item["chat_id"], message_id=message_id, text=item["text"], parse_mode='HTML'
+            )
+            return
+        except BadRequest as e:
+            if "not modified" in str(e):
+                return
+            print(f"Canlı durum mesajı düzenlenemedi, yenisi gönderiliyor: {e}")
+    
+    msg = await application.bot.send_message(chat_id=item["chat_id"], text=item["text"], parse_mode='HTML')
+    await asyncio.to_thread(job_broker.set_board_message, item["job_id"], item["chat_id"], msg.message_id)
+
+async def broker_outbox_pump(application):
+    """Worker'lardan gelen bildirimleri Telegram'a iletir ve biten işleri listeden düşer."""
+    while not shutdown_event.is_set():
+        try:
+            notifications = await asyncio.to_thread(job_broker.pop_notifications)
+            
+            # Aynı panonun bu turdaki güncellemelerinden yalnız sonuncusu gönderilir
+            latest_boards = {item["job_id"]: item["id"] for item in notifications if item["kind"] == "board"}
             
-    print(f"API İzleme durdu ({chat_id}, Job #{job_id}).")
-    if chat_id in monitor_jobs and job_id in monitor_jobs[chat_id]:
-        del monitor_jobs[chat_id][job_id]
-        if not monitor_jobs[chat_id]:  # Kullanıcının başka izlemesi kalmadıysa
-            del monitor_jobs[chat_id]
-        print(f"İzleme işi listeden kaldırıldı ({chat_id}, Job #{job_id}).")
+            for item in notifications:
+                if item["kind"] == "board":
+                    if latest_boards[item["job_id"]] == item["id"]:
+                        try:
+                            await deliver_live_board(application, item)
+                        except Exception as e:
+                            print(f"Canlı durum mesajı gönderilemedi: {e}")
+                    continue
+                try:
+                    await application.bot.send_message(chat_id=item["chat_id"], text=item["text"], parse_mode='HTML')
+                except Exception as e:
+                    print(f"HTML formatı hatası, düz metin olarak tekrar deneniyor: {e}")
+                    try:
+                        await application.bot.send_message(chat_id=item["chat_id"], text=item["text"])
+                    except Exception as e:
+                        print(f"Mesaj kurtarılamadı: {e}")
+
+            active_ids = {job["job_id"] for job in await asyncio.to_thread(job_broker.active_jobs)}
+            await asyncio.to_thread(job_broker.clear_boards, active_ids)
+            with monitor_jobs_lock:
+                known = [(chat_id, job_id) for chat_id, jobs_by_id in monitor_jobs.items() for job_id in jobs_by_id]
+            for chat_id, job_id in known:
+                if job_id not in active_ids:
+                    remove_monitor_job(chat_id, job_id)
+        except Exception as e:
+            print(f"Broker outbox hatası: {e}")
+
+        await asyncio.sleep(1)
+
+def run_worker():
+    """
+    Worker süreci: consistent hashing ile kendisine düşen (route, date)
+    işlerini izler, bildirimleri broker outbox'ına yazar.
+    """
+    global notification_sink, board_sink
+
+    broker = JobBroker(BROKER_PATH)
+    notification_sink = broker.push_notification
+    board_sink = broker.push_board
+    running = {}  # {job_id: (thread, stop_event, checkpoint)}
+
+    def request_shutdown(signum, frame):
+        print(f"🛑 Sinyal alındı ({signum}), worker kapanıyor...")
+        shutdown_event.set()
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
+    def restart_job(job_id, beat, give_up):
+        running.pop(job_id, None)
+        if give_up:
+            broker.finish_job(job_id)
+            return
+        # Son durum broker'a yazılır; iş bir sonraki turda yeniden alınır
+        broker.save_checkpoint(job_id, {key: value for key, value in beat["checkpoint"].items() if key != "handoff"})
+
+    print(f"🛠 Worker başlatıldı: {WORKER_ID} (broker: {BROKER_PATH})")
+    if not load_stations():
+        print("⚠️ İstasyonlar yüklenemedi, worker yine de başlatılıyor...")
+    start_watchdog(restart_job)
+
+    while not shutdown_event.is_set():
+        try:
+            broker.heartbeat(WORKER_ID)
+            ring = build_hash_ring(broker.live_workers(WORKER_TTL_SECONDS))
+
+            wanted = {
+                job["job_id"]: job for job in broker.active_jobs()
+                if shard_owner(ring, job["route_key"]) == WORKER_ID
+            }
+
+            for job_id, (thread, stop_event, checkpoint) in list(running.items()):
+                if not thread.is_alive():
+                    if job_id in job_heartbeats and not stop_event.is_set():
+                        continue  # Çöktü; watchdog yeniden başlatacak
+                    # Durdurulmadan bittiyse sefer saati geçmiştir
+                    if not stop_event.is_set():
+                        broker.finish_job(job_id)
+                    # Thread bitti: son durum yazılır ve kira bırakılır; yeni sahibi ancak şimdi alabilir
+                    broker.release_job(job_id, WORKER_ID,
+                                       {key: value for key, value in checkpoint.items() if key != "handoff"})
+                    del running[job_id]
+                elif job_id not in wanted:
+                    # İptal edildi ya da başka worker'a devredildi
+                    if broker.job_status(job_id) == 'active':
+                        checkpoint["handoff"] = True
+                    stop_event.set()
+
+            for job_id in wanted:
+                if job_id in running:
+                    continue
+                # Önceki sahip hâlâ izliyorsa iş bir sonraki turda yeniden denenir
+                job = broker.claim_job(job_id, WORKER_ID, WORKER_TTL_SECONDS)
+                if job is None:
+                    continue
+                stop_event = threading.Event()
+                checkpoint = json.loads(job["checkpoint"]) if job["checkpoint"] else {}
+                thread = threading.Thread(
+                    target=monitoring_loop,
+                    args=(job["chat_id"], job_id, stop_event),
+                    kwargs=dict(decode_job_spec(job["spec"]), checkpoint=checkpoint),
+                    daemon=True
+                )
+                running[job_id] = (thread, stop_event, checkpoint)
+                thread.start()
+                print(f"İş alındı: Job #{job_id} ({job['route_key']})")
+        except Exception as e:
+            print(f"Worker döngü hatası: {e}")
+
+        shutdown_event.wait(WORKER_POLL_SECONDS)
 
-def create_date_keyboard(action: str, from_station_id: int, to_station_id: int) -> InlineKeyboardMarkup:
+    # Kapanış: işleri durdur, süren turları bekle, durumları broker'a yaz ve halkadan çık
+    for thread, stop_event, _ in running.values():
+        stop_event.set()
+    deadline = time.monotonic() + SHUTDOWN_GRACE_SECONDS
+    for job_id, (thread, stop_event, checkpoint) in running.items():
+        thread.join(max(0, deadline - time.monotonic()))
+        broker.release_job(job_id, WORKER_ID, {key: value for key, value in checkpoint.items() if key != "handoff"})
+    broker.retire_worker(WORKER_ID)
+    print(f"🛠 Worker kapandı: {WORKER_ID} ({len(running)} iş devredildi)")
+
+def create_date_keyboard(action: str) -> InlineKeyboardMarkup:
+    # Gün değişince anahtar da değişir; eski günün klavyesi LRU'dan düşer
+    return _date_keyboard(get_now().date(), action)
+
+@functools.lru_cache(maxsize=16)
+def _date_keyboard(today, action: str) -> InlineKeyboardMarkup:
     keyboard = []
-    today = get_now()
     
     row = []
-    for i in range(0, 13):
+    for i in range(0, SALES_HORIZON_DAYS):
         day = today + timedelta(days=i)
-        date_str_iso = day.strftime("%Y-%m-%d")
-        
-        callback_data = f"date_{action}_{from_station_id}_{to_station_id}_{date_str_iso}"
+        callback_data = encode_callback("d", day.strftime("%Y%m%d"))
         
         if i == 0:
             day_name = "Bugün"
@@ -793,9 +3351,56 @@ def create_date_keyboard(action: str, from_station_id: int, to_station_id: int)
     
     if row: 
         keyboard.append(row)
+    
+    if action in ("monitor", "price"):
+        keyboard.append([InlineKeyboardButton("📆 Daha ileri bir tarih (satışa açılınca)",
+                                              callback_data=encode_callback("fd"))])
         
     return InlineKeyboardMarkup(keyboard)
 
+def get_memory_gauges() -> dict:
+    """Süreç belleği ve uzun ömürlü yapıların boyutları."""
+    rss_kb = None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss_kb = int(line.split()[1])
+                    break
+    except OSError:
+        pass
+    
+    return {
+        "rss_kb": rss_kb,
+        "user_states": len(user_states),
+        "user_states_evicted": user_states.evicted_count,
+        "callback_payloads": len(callback_payloads),
+        "monitor_jobs": sum(len(jobs) for jobs in list(monitor_jobs.values())),
+        "stale_wizard_messages": len(stale_wizard_messages),
+    }
+
+async def user_state_sweeper(application):
+    """
+    Süresi dolan sihirbaz durumlarını temizler ve geride kalan
+    ara mesajları siler. Belirli aralıklarla bellek göstergelerini yazar.
+    """
+    last_gauge_log = 0
+    while True:
+        await asyncio.sleep(USER_STATE_SWEEP_SECONDS)
+        try:
+            user_states.expire()
+            callback_payloads.expire()
+            
+            while stale_wizard_messages:
+                chat_id, message_ids = stale_wizard_messages.popleft()
+                await delete_messages(application, chat_id, message_ids)
+            
+            if time.monotonic() - last_gauge_log >= MEMORY_GAUGE_LOG_SECONDS:
+                print(f"📊 Bellek: {get_memory_gauges()}")
+                last_gauge_log = time.monotonic()
+        except Exception as e:
+            print(f"Durum temizleme hatası: {e}")
+
 async def start(update: Update, context: CallbackContext):
     message = """
 👋 Merhaba! Ben TCDD API Bilet Takip Botuyum.
@@ -803,6 +3408,10 @@ async def start(update: Update, context: CallbackContext):
 *KOMUTLAR:*
 • `/check` - Tek seferlik bilet kontrolü
 • `/monitor` - Sürekli bilet takibi (birden fazla olabilir)
+• `/price` - Fiyat düşüşü takibi
+• `/connect` - Aktarmalı sefer arama
+• `/stats` - Güzergah geçmişi istatistikleri
+• `/calendar` - Satıştaki tüm günlerin yer/fiyat özeti
 • `/status` - Aktif izlemeleri görüntüle
 • `/stop` - Aktif izlemeleri durdur
 
@@ -810,69 +3419,67 @@ async def start(update: Update, context: CallbackContext):
     """
     await update.message.reply_text(message, parse_mode='Markdown')
 
-async def check_command(update: Update, context: CallbackContext):
+async def start_wizard(update: Update, context: CallbackContext, action: str):
     chat_id = str(update.message.chat_id)
-    cleanup_ids = [update.message.message_id]
     
-    if not STATIONS_DATA:
-        loading_msg = await update.message.reply_text("⏳ İstasyonlar yükleniyor, lütfen bekleyin...")
-        cleanup_ids.append(loading_msg.message_id)
-        if not load_stations():
-            await update.message.reply_text("❌ İstasyonlar yüklenemedi. Lütfen daha sonra tekrar deneyin.")
+    if action in ("monitor", "price"):
+        quota_message = quota_exceeded_message(chat_id)
+        if quota_message:
+            await update.message.reply_text(quota_message)
             return
-    
-    # Kullanıcı durumunu kaydet
-    user_states[chat_id] = {
-        "state": "waiting_from",
-        "action": "check",
-        "from_station_id": None,
-        "cleanup_ids": cleanup_ids
-    }
-    
-    msg = await update.message.reply_text(
-        "🔍 *Kalkış İstasyonu Araması*\n\n"
-        "Lütfen kalkış istasyonu adını yazın (en az 3 karakter).\n"
-        "Örnek: `Ankara`, `İstanbul`, `İzmir`",
-        parse_mode='Markdown'
-    )
-    user_states[chat_id]["cleanup_ids"].append(msg.message_id)
-
-async def monitor_command(update: Update, context: CallbackContext):
-    chat_id = str(update.message.chat_id)
     cleanup_ids = [update.message.message_id]
+    anchor_id = None
     
     if not STATIONS_DATA:
         loading_msg = await update.message.reply_text("⏳ İstasyonlar yükleniyor, lütfen bekleyin...")
         cleanup_ids.append(loading_msg.message_id)
-        if not load_stations():
+        anchor_id = loading_msg.message_id
+        if not await asyncio.to_thread(load_stations):
             await update.message.reply_text("❌ İstasyonlar yüklenemedi. Lütfen daha sonra tekrar deneyin.")
             return
     
     # Kullanıcı durumunu kaydet
     user_states[chat_id] = {
         "state": "waiting_from",
-        "action": "monitor",
+        "action": action,
         "from_station_id": None,
+        "anchor_id": anchor_id,  # Sihirbaz adımlarının yerinde düzenlendiği mesaj
         "cleanup_ids": cleanup_ids
     }
     
-    msg = await update.message.reply_text(
+    await show_wizard_message(
+        update, context, user_states[chat_id],
         "🔍 *Kalkış İstasyonu Araması*\n\n"
         "Lütfen kalkış istasyonu adını yazın (en az 3 karakter).\n"
-        "Örnek: `Ankara`, `İstanbul`, `İzmir`",
-        parse_mode='Markdown'
+        "Örnek: `Ankara`, `İstanbul`, `İzmir`"
     )
-    user_states[chat_id]["cleanup_ids"].append(msg.message_id)
+
+async def check_command(update: Update, context: CallbackContext):
+    await start_wizard(update, context, "check")
+
+async def monitor_command(update: Update, context: CallbackContext):
+    await start_wizard(update, context, "monitor")
+
+async def price_command(update: Update, context: CallbackContext):
+    await start_wizard(update, context, "price")
+
+async def connect_command(update: Update, context: CallbackContext):
+    await start_wizard(update, context, "connect")
+
+async def stats_command(update: Update, context: CallbackContext):
+    await start_wizard(update, context, "stats")
+
+async def calendar_command(update: Update, context: CallbackContext):
+    await start_wizard(update, context, "calendar")
 
 async def stop_command(update: Update, context: CallbackContext):
     chat_id = str(update.message.chat_id)
     
-    if chat_id not in monitor_jobs or not monitor_jobs[chat_id]:
+    user_jobs = chat_jobs(chat_id)
+    if not user_jobs:
         await update.message.reply_text("Aktif bir izlemeniz bulunmuyor.")
         return
     
-    user_jobs = monitor_jobs[chat_id]
-    
     if len(user_jobs) == 1:
         # Tek izleme varsa direkt durdur
         job_id = list(user_jobs.keys())[0]
@@ -894,385 +3501,707 @@ async def stop_command(update: Update, context: CallbackContext):
         msg_text += f"🔵 *#{job_id}* | {info['from']} ➡ {info['to']}\n"
         msg_text += f"   📅 {info['date']} | 🔄 {info['interval']}sn\n\n"
         
-        keyboard.append([InlineKeyboardButton(
-            f"🛑 #{job_id} - {info['from']} ➡ {info['to']}", 
-            callback_data=f"stop_job_{job_id}"
-        )])
+        keyboard.append([InlineKeyboardButton(
+            f"🛑 #{job_id} - {info['from']} ➡ {info['to']}", 
+            callback_data=encode_callback("sj", job_id)
+        )])
+    
+    keyboard.append([InlineKeyboardButton("⛔ Tümünü Durdur", callback_data=encode_callback("sa"))])
+    
+    await update.message.reply_text(
+        msg_text,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
+
+async def status_command(update: Update, context: CallbackContext):
+    chat_id = str(update.message.chat_id)
+    
+    user_jobs = chat_jobs(chat_id)
+    if not user_jobs:
+        await update.message.reply_text("ℹ️ Aktif bir izlemeniz bulunmuyor.")
+        return
+    max_jobs, min_interval = chat_quota(chat_id)
+    msg_text = f"📝 *Aktif İzlemeleriniz ({len(user_jobs)} adet):*\n"
+    msg_text += f"📊 Kota: {len(user_jobs)}/{max_jobs} izleme, en kısa kontrol aralığı {min_interval}sn\n"
+    queued = poll_scheduler.queue_length()
+    if queued:
+        msg_text += f"⏳ Sorgu sırasında bekleyen güzergah: {queued}\n"
+    msg_text += "\n"
+    
+    for job_id, job in user_jobs.items():
+        info = job["info"]
+        times_str = ", ".join(info.get("times", [])) if info.get("times") else "Tümü"
+        msg_text += f"🔵 *#{job_id}* | {info['from']} ➡ {info['to']}\n"
+        msg_text += f"   📅 {info['date']}\n"
+        msg_text += f"   ⏰ Saatler: {times_str}\n"
+        if info.get("mode") == "price":
+            msg_text += f"   💸 Fiyat takibi: {format_price_threshold(info.get('price_threshold'))}\n"
+        if info.get("live_board"):
+            msg_text += "   📌 Canlı durum mesajı\n"
+        if info.get("sale_watch") and sales_watcher.waiting(job_id):
+            msg_text += "   ⏳ Satışa açılması bekleniyor\n"
+        beat = job_heartbeats.get(job_id)
+        if beat and beat["failures"] >= WATCHDOG_MAX_FAILURES:
+            msg_text += f"   ⚠️ Son {beat['failures']} kontrolde TCDD'ye ulaşılamadı\n"
+        msg_text += f"   🔄 Kontrol sıklığı: {info['interval']}sn\n\n"
+    
+    msg_text += "Durdurmak için /stop yazın."
+    
+    await update.message.reply_text(msg_text, parse_mode='Markdown')
+
+def wizard_routes(state: dict) -> list:
+    """
+    Sihirbazda seçilen kalkış/varış istasyonlarını (veya şehir gruplarını),
+    istasyonların 'pairs' listesine göre gerçekten sefer olan en küçük
+    (kalkış, varış) çifti kümesine açar.
+    """
+    from_ids = list(dict.fromkeys(state.get("from_station_ids") or [state["from_station_id"]]))
+    to_ids = list(dict.fromkeys(state.get("to_station_ids") or [state["to_station_id"]]))
+    routes = []
+    for from_id in from_ids:
+        pairs = set(get_station_by_id(from_id).get('pairs') or [])
+        routes.extend((from_id, to_id) for to_id in to_ids if to_id in pairs and to_id != from_id)
+    return routes
+
+async def session_expired(query, context: CallbackContext, chat_id: str, command: str = "/monitor"):
+    try: await query.message.delete()
+    except: pass
+    await context.bot.send_message(chat_id=chat_id, text=f"❌ Oturum süresi doldu. Lütfen {command} ile tekrar başlayın.")
+
+def get_wizard_state(chat_id: str, expected_state: str):
+    state = user_states.get(chat_id)
+    if state is None or state.get("state") != expected_state:
+        return None
+    return state
+
+async def handle_cancel_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    if chat_id in user_states:
+        cleanup_ids = user_states[chat_id].get("cleanup_ids", [])
+        cleanup_ids.append(query.message.message_id)
+        await delete_messages(context, chat_id, cleanup_ids)
+        del user_states[chat_id]
+    else:
+        await query.edit_message_text("❌ İşlem iptal edildi.")
+
+async def handle_stop_all_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    user_jobs = chat_jobs(chat_id)
+    if user_jobs:
+        stopped_count = 0
+        for job_id, job in user_jobs.items():
+            job["stop_event"].set()
+            stopped_count += 1
+        await query.edit_message_text(f"⛔ Tüm izlemeler durduruluyor... ({stopped_count} adet) 🛑")
+    else:
+        await query.edit_message_text("Aktif bir izlemeniz bulunmuyor.")
+
+async def handle_stop_job_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    job_id = int(args[0])
+    job = chat_jobs(chat_id).get(job_id)
+    if job is not None:
+        info = job["info"]
+        job["stop_event"].set()
+        await query.edit_message_text(
+            f"🛑 İzleme durduruluyor...\n"
+            f"#{job_id} | {info['from']} ➡ {info['to']} | {info['date']}"
+        )
+    else:
+        await query.edit_message_text("❌ Bu izleme zaten durdurulmuş.")
+
+async def handle_from_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    state = get_wizard_state(chat_id, "waiting_from")
+    if state is None:
+        await session_expired(query, context, chat_id, "/check veya /monitor")
+        return
+    
+    from_station_id = int(args[0])
+    from_station = get_station_by_id(from_station_id)
+    
+    state["state"] = "waiting_to"
+    state["from_station_id"] = from_station_id
+    
+    await query.edit_message_text(
+        text=f"✅ Kalkış: *{from_station['name']}*\n\n"
+             f"🔍 *Varış İstasyonu Araması*\n\n"
+             f"Lütfen varış istasyonu adını yazın (en az 3 karakter).",
+        parse_mode='Markdown'
+    )
+
+async def handle_from_all_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    state = get_wizard_state(chat_id, "waiting_from")
+    if state is None:
+        await session_expired(query, context, chat_id, "/check")
+        return
+    
+    from_station_ids = [int(arg) for arg in args]
+    state["state"] = "waiting_to"
+    state["from_station_id"] = from_station_ids[0]
+    state["from_station_ids"] = from_station_ids
+    
+    await query.edit_message_text(
+        text=f"✅ Kalkış: *{station_names(from_station_ids)}*\n\n"
+             f"🔍 *Varış İstasyonu Araması*\n\n"
+             f"Lütfen varış istasyonu adını yazın (en az 3 karakter).",
+        parse_mode='Markdown'
+    )
+
+async def handle_to_all_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    state = get_wizard_state(chat_id, "waiting_to")
+    if state is None:
+        await session_expired(query, context, chat_id, "/check")
+        return
+    
+    to_station_ids = [int(arg) for arg in args]
+    state["state"] = "waiting_date"
+    state["to_station_id"] = to_station_ids[0]
+    state["to_station_ids"] = to_station_ids
+    
+    if state["action"] == "calendar":
+        await start_sales_calendar(query, context, chat_id, state)
+        return
+    
+    from_station_ids = state.get("from_station_ids") or [state["from_station_id"]]
+    keyboard = create_date_keyboard(action=state["action"])
+    await query.edit_message_text(
+        text=f"Kalkış: *{station_names(from_station_ids)}*\nVarış: *{station_names(to_station_ids)}*\n\n"
+             f"🔀 {len(wizard_routes(state))} güzergah birlikte sorgulanacak.\n\nLütfen bir *tarih* seçin:",
+        reply_markup=keyboard,
+        parse_mode='Markdown'
+    )
+
+async def handle_to_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    state = get_wizard_state(chat_id, "waiting_to")
+    if state is None:
+        await session_expired(query, context, chat_id, "/check veya /monitor")
+        return
+    
+    to_station_id = int(args[0])
+    state["state"] = "waiting_date"
+    state["to_station_id"] = to_station_id
+    
+    if state["action"] == "stats":
+        await start_route_stats(query, context, chat_id, state)
+        return
+    if state["action"] == "calendar":
+        await start_sales_calendar(query, context, chat_id, state)
+        return
+    
+    from_station_ids = state.get("from_station_ids") or [state["from_station_id"]]
+    to_station = get_station_by_id(to_station_id)
+    
+    keyboard = create_date_keyboard(action=state["action"])
+    await query.edit_message_text(
+        text=f"Kalkış: *{station_names(from_station_ids)}*\nVarış: *{to_station['name']}*\n\nLütfen bir *tarih* seçin:",
+        reply_markup=keyboard,
+        parse_mode='Markdown'
+    )
+
+async def start_route_stats(query, context: CallbackContext, chat_id: str, state: dict):
+    # İstatistikler tarih seçmeden, güzergah geçmişinden hesaplanır
+    cleanup_ids = state.get("cleanup_ids", [])
+    if query is not None:
+        cleanup_ids.append(query.message.message_id)
+    await delete_messages(context, chat_id, cleanup_ids)
+    
+    threading.Thread(
+        target=run_route_stats,
+        args=(chat_id, state["from_station_id"], state["to_station_id"])
+    ).start()
+    
+    user_states.pop(chat_id, None)
+
+async def start_sales_calendar(query, context: CallbackContext, chat_id: str, state: dict):
+    # Takvim tarih seçmeden, satıştaki tüm günler için hazırlanır
+    cleanup_ids = state.get("cleanup_ids", [])
+    if query is not None:
+        cleanup_ids.append(query.message.message_id)
+    await delete_messages(context, chat_id, cleanup_ids)
+    
+    routes = wizard_routes(state)
+    if not routes:
+        await context.bot.send_message(chat_id=chat_id, text="❌ Seçilen istasyonlar arasında doğrudan sefer bulunmuyor.")
+    else:
+        await context.bot.send_message(chat_id=chat_id, text=f"⏳ {SALES_HORIZON_DAYS} günlük takvim hazırlanıyor...")
+        threading.Thread(target=run_sales_calendar, args=(chat_id, routes)).start()
+    
+    user_states.pop(chat_id, None)
+
+async def handle_date_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    state = get_wizard_state(chat_id, "waiting_date")
+    if state is None:
+        await session_expired(query, context, chat_id, "/check veya /monitor")
+        return
+    
+    action = state["action"]
+    from_station_id = state["from_station_id"]
+    to_station_id = state["to_station_id"]
+    target_date = datetime.strptime(args[0], "%Y%m%d")
+    
+    routes = wizard_routes(state)
+    from_label = station_names(dict.fromkeys(from_id for from_id, _ in routes))
+    to_label = station_names(dict.fromkeys(to_id for _, to_id in routes))
+    
+    date_tr_str = target_date.strftime("%d %B %Y")
+    
+    cleanup_ids = state.get("cleanup_ids", [])
+
+    if action == "connect":
+        cleanup_ids.append(query.message.message_id)
+        await delete_messages(context, chat_id, cleanup_ids)
+        
+        threading.Thread(
+            target=run_connection_search,
+            args=(chat_id, from_station_id, to_station_id, target_date)
+        ).start()
+        
+        user_states.pop(chat_id, None)
+        return
+
+    if not routes:
+        cleanup_ids.append(query.message.message_id)
+        await delete_messages(context, chat_id, cleanup_ids)
+        await context.bot.send_message(chat_id=chat_id, text="❌ Seçilen istasyonlar arasında doğrudan sefer bulunmuyor.")
+        user_states.pop(chat_id, None)
+        return
+
+    if action == "check" and len(routes) > 1:
+        cleanup_ids.append(query.message.message_id)
+        await delete_messages(context, chat_id, cleanup_ids)
+        
+        threading.Thread(
+            target=run_multi_route_check,
+            args=(chat_id, routes, target_date)
+        ).start()
+        
+        user_states.pop(chat_id, None)
+        return
+    
+    if action == "check":
+        cleanup_ids.append(query.message.message_id)
+        await delete_messages(context, chat_id, cleanup_ids)
+        
+        print(f"Check başlatıldı: {from_label} -> {to_label}")
+        # Çoklu seçimden tek geçerli çift kalmış olabilir; ilk seçilen ID'ler değil o çift sorgulanır
+        threading.Thread(
+            target=run_one_time_check,
+            args=(chat_id, *routes[0], target_date)
+        ).start()
+        
+        user_states.pop(chat_id, None)
+        return
+    
+    elif action in ("monitor", "price"):
+        
+        await query.edit_message_text(
+            text=f"🚆 *{from_label}* ➡ *{to_label}*\n🗓 *{date_tr_str}*\n\n⏳ Sefer saatleri alınıyor...", 
+            parse_mode='Markdown'
+        )
+        
+        # Sefer saatlerini al
+        available_times = await asyncio.to_thread(get_available_train_times_for_routes, routes, target_date)
+        
+        if not available_times:
+            cleanup_ids.append(query.message.message_id)
+            await delete_messages(context, chat_id, cleanup_ids)
+            
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=f"❌ *{from_label}* ➡ *{to_label}*\n🗓 *{date_tr_str}*\n\nBu tarihte sefer bulunamadı.", 
+                parse_mode='Markdown'
+            )
+            
+            user_states.pop(chat_id, None)
+            return
+        
+        text, keyboard = begin_time_selection(state, routes, from_label, to_label, target_date, available_times)
+        await query.edit_message_text(text=text, reply_markup=keyboard, parse_mode='Markdown')
+
+def begin_time_selection(state: dict, routes: list, from_label: str, to_label: str, target_date: datetime,
+                         available_times: list, wait_for_sale: bool = False, schedule_date: datetime = None):
+    """Sihirbazı saat seçimi adımına geçirir; adım metni ve klavyesini döner."""
+    state.update({
+        "state": "selecting_times",
+        "routes": routes,
+        "from_label": from_label,
+        "to_label": to_label,
+        "target_date": target_date,
+        "wait_for_sale": wait_for_sale,
+        "available_times": available_times,
+        "selected_times": [t["time"] for t in available_times],  # Başta hepsi seçili
+        "time_ranges": [],
+        "cabin_classes": list(DEFAULT_CABIN_KINDS),
+        "passengers": dict(DEFAULT_PASSENGERS),
+        "min_seats": 1
+    })
+    
+    # Saatleri göster
+    times_info = "\n".join([f"• {t['time']}{' (' + t['type'] + ')' if t.get('type') else ''} - {t['train_name']}" for t in available_times])
+    if schedule_date is not None:
+        times_title = f"*{schedule_date.strftime('%d %B')} tarifesine göre tahmini seferler:*"
+    else:
+        times_title = "*Mevcut Seferler:*"
+    state["time_keyboard"] = []
+    keyboard = create_time_selection_keyboard(
+        available_times, 
+        state["selected_times"],
+        state["time_keyboard"]
+    )
+    text = (f"🚆 *{from_label}* ➡ *{to_label}*\n🗓 *{target_date.strftime('%d %B %Y')}*\n\n"
+            f"{times_title}\n{times_info}\n\n"
+            f"⏰ *İzlemek istediğiniz saatleri seçin:*\n(Seçili olanlar ✅ ile gösterilir)\n"
+            f"Saat aralığı için yazabilirsiniz, örn. `07:00-10:00`")
+    return text, keyboard
+
+async def handle_future_date_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    state = get_wizard_state(chat_id, "waiting_date")
+    if state is None:
+        await session_expired(query, context, chat_id, "/monitor")
+        return
+    
+    first_day = get_now().date() + timedelta(days=SALES_HORIZON_DAYS)
+    state["state"] = "waiting_future_date"
+    # Yazılan tarih bu mesajı düzenleyerek ilerler
+    state["anchor_id"] = query.message.message_id
+    if query.message.message_id not in state["cleanup_ids"]:
+        state["cleanup_ids"].append(query.message.message_id)
+    await query.edit_message_text(
+        text=f"📆 *Satışa henüz açılmamış tarih*\n\n"
+             f"Biletler kalkıştan {SALES_HORIZON_DAYS} gün önce satışa açılır. Tarihi `GG.AA.YYYY` "
+             f"biçiminde yazın; satışa açıldığı anda kontrol etmeye başlarım.\n"
+             f"Örnek: `{first_day.strftime('%d.%m.%Y')}`",
+        parse_mode='Markdown'
+    )
+
+def parse_future_date(text: str):
+    """'GG.AA.YYYY' (veya / ile) tarihini okur; geçersizse None"""
+    for date_format in ("%d.%m.%Y", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(text.strip(), date_format)
+        except ValueError:
+            continue
+    return None
+
+def schedule_template_date(target_date: datetime) -> datetime:
+    """Satıştaki son günlerden hedefle aynı haftanın gününe denk gelen tarih (tarifesi örnek alınır)"""
+    last_on_sale = get_now().date() + timedelta(days=SALES_HORIZON_DAYS - 1)
+    weeks_back = -(-(target_date.date() - last_on_sale).days // 7)
+    return target_date - timedelta(weeks=max(0, weeks_back))
+
+async def handle_time_toggle_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    state = get_wizard_state(chat_id, "selecting_times")
+    if state is None:
+        await session_expired(query, context, chat_id)
+        return
+    
+    index = int(args[0])
+    time_str = state["available_times"][index]["time"]
+    if time_str in state["selected_times"]:
+        state["selected_times"].remove(time_str)
+    else:
+        state["selected_times"].append(time_str)
+    
+    # Klavyeyi güncelle (yalnız basılan buton değişir)
+    keyboard = create_time_selection_keyboard(
+        state["available_times"],
+        state["selected_times"],
+        state.get("time_keyboard"),
+        index
+    )
+    await query.edit_message_reply_markup(reply_markup=keyboard)
+
+async def handle_time_all_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    state = get_wizard_state(chat_id, "selecting_times")
+    if state is None:
+        await session_expired(query, context, chat_id)
+        return
+    
+    # Tümünü seç/temizle
+    if len(state["selected_times"]) < len(state["available_times"]):
+        state["selected_times"] = [t["time"] for t in state["available_times"]]
+    else:
+        state["selected_times"] = []
+    
+    keyboard = create_time_selection_keyboard(
+        state["available_times"],
+        state["selected_times"],
+        state.get("time_keyboard")
+    )
+    await query.edit_message_reply_markup(reply_markup=keyboard)
+
+async def handle_time_done_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    state = get_wizard_state(chat_id, "selecting_times")
+    if state is None:
+        await session_expired(query, context, chat_id)
+        return
+    
+    if not state["selected_times"]:
+        return "⚠️ En az bir saat seçmelisiniz!"
+    
+    # Vagon sınıfı seçimine geç
+    state["state"] = "selecting_cabins"
+    await query.edit_message_text(
+        text=cabin_step_text(state),
+        reply_markup=create_cabin_class_keyboard(state["cabin_classes"]),
+        parse_mode='Markdown'
+    )
+
+def cabin_step_text(state: dict) -> str:
+    date_tr_str = state["target_date"].strftime("%d %B %Y")
+    times_str = describe_times(state["selected_times"], state["time_ranges"])
+    return (f"🚆 *{state['from_label']}* ➡ *{state['to_label']}*\n🗓 *{date_tr_str}*\n"
+            f"⏰ Saatler: {times_str}\n\n"
+            f"🎫 *Hangi vagon sınıflarını izlemek istersiniz?*\n(Seçili olanlar ✅ ile gösterilir)")
+
+async def handle_cabin_toggle_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    state = get_wizard_state(chat_id, "selecting_cabins")
+    if state is None:
+        await session_expired(query, context, chat_id)
+        return
+    
+    kind = args[0]
+    if kind not in CABIN_KINDS:
+        return
+    if kind in state["cabin_classes"]:
+        state["cabin_classes"].remove(kind)
+    else:
+        state["cabin_classes"].append(kind)
+    
+    await query.edit_message_reply_markup(reply_markup=create_cabin_class_keyboard(state["cabin_classes"]))
+
+async def handle_cabin_done_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    state = get_wizard_state(chat_id, "selecting_cabins")
+    if state is None:
+        await session_expired(query, context, chat_id)
+        return
+    
+    if not state["cabin_classes"]:
+        return "⚠️ En az bir vagon sınıfı seçmelisiniz!"
+    
+    # Yolcu seçimine geç
+    state["state"] = "selecting_count"
+    keyboard = create_passenger_keyboard(state["passengers"])
+    
+    from_label, to_label = state["from_label"], state["to_label"]
+    date_tr_str = state["target_date"].strftime("%d %B %Y")
+    times_str = describe_times(state["selected_times"], state["time_ranges"])
+    cabins_str = CabinFilter(state["cabin_classes"]).describe()
+    
+    await query.edit_message_text(
+        text=f"🚆 *{from_label}* ➡ *{to_label}*\n🗓 *{date_tr_str}*\n"
+             f"⏰ Saatler: {times_str}\n🎫 Sınıflar: {cabins_str}\n\n"
+             f"👥 *Kaç yolcu için yer arıyorsunuz?*\n(Müsaitlik ve fiyatlar bu yolcularla sorgulanır)",
+        reply_markup=keyboard,
+        parse_mode='Markdown'
+    )
+
+async def handle_passenger_change_callback(query, context: CallbackContext, chat_id: str, args: tuple, delta: int):
+    state = get_wizard_state(chat_id, "selecting_count")
+    if state is None:
+        await session_expired(query, context, chat_id)
+        return
+    
+    type_id = int(args[0])
+    passengers = state["passengers"]
+    new_count = passengers.get(type_id, 0) + delta
+    if type_id not in PASSENGER_TYPES or new_count < 0:
+        return
+    if sum(passengers.values()) + delta > MAX_PASSENGERS:
+        return f"⚠️ En fazla {MAX_PASSENGERS} yolcu seçebilirsiniz."
+    
+    passengers[type_id] = new_count
+    await query.edit_message_reply_markup(reply_markup=create_passenger_keyboard(passengers))
+
+async def handle_passenger_add_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    return await handle_passenger_change_callback(query, context, chat_id, args, 1)
+
+async def handle_passenger_remove_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    return await handle_passenger_change_callback(query, context, chat_id, args, -1)
+
+async def handle_count_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    state = get_wizard_state(chat_id, "selecting_count")
+    if state is None:
+        await session_expired(query, context, chat_id)
+        return
+    
+    min_seats = sum(state["passengers"].values())
+    if not min_seats:
+        return "⚠️ En az bir yolcu seçmelisiniz!"
+    state["min_seats"] = min_seats
+    
+    if state["action"] == "price":
+        # Fiyat eşiği seçimine geç
+        state["state"] = "selecting_price"
+        current_price = await asyncio.to_thread(
+            cheapest_price, state["routes"], state["target_date"],
+            TimeWindows.compile(state["target_date"], state["selected_times"], state["time_ranges"]),
+            CabinFilter(state["cabin_classes"]), min_seats, state["passengers"]
+        )
+        keyboard = create_price_threshold_keyboard("mp", current_price)
+        current_info = f"Şu anki en düşük fiyat: *{current_price:g} TRY*" if current_price else "Şu anda uygun yer bulunmuyor."
+        
+        await query.edit_message_text(
+            text=f"{price_wizard_summary(state)}\n\n{current_info}\n\n"
+                 f"💸 *Hangi fiyatın altına inince bildirim alalım?*\n(İsterseniz tutarı yazabilirsiniz, örn. `450`)",
+            reply_markup=keyboard,
+            parse_mode='Markdown'
+        )
+        return
     
-    keyboard.append([InlineKeyboardButton("⛔ Tümünü Durdur", callback_data="stop_all")])
+    # İzleme sıklığı seçimine geç
+    state["state"] = "selecting_interval"
+    state["live_board"] = False
+    keyboard = create_interval_selection_keyboard("mi", state["live_board"], chat_quota(chat_id)[1])
     
-    await update.message.reply_text(
-        msg_text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
+    from_label, to_label = state["from_label"], state["to_label"]
+    date_tr_str = state["target_date"].strftime("%d %B %Y")
+    times_str = describe_times(state["selected_times"], state["time_ranges"])
+    cabins_str = CabinFilter(state["cabin_classes"]).describe()
+    
+    await query.edit_message_text(
+        text=f"🚆 *{from_label}* ➡ *{to_label}*\n🗓 *{date_tr_str}*\n"
+             f"⏰ Saatler: {times_str}\n🎫 Sınıflar: {cabins_str}\n👥 Yolcular: {describe_passengers(state['passengers'])}\n\n"
+             f"🔄 *Hangi sıklıkla kontrol edilsin?*",
+        reply_markup=keyboard,
         parse_mode='Markdown'
     )
 
-async def status_command(update: Update, context: CallbackContext):
-    chat_id = str(update.message.chat_id)
+def price_wizard_summary(state: dict) -> str:
+    date_tr_str = state["target_date"].strftime("%d %B %Y")
+    times_str = describe_times(state["selected_times"], state["time_ranges"])
+    cabins_str = CabinFilter(state["cabin_classes"]).describe()
+    return (f"🚆 *{state['from_label']}* ➡ *{state['to_label']}*\n🗓 *{date_tr_str}*\n"
+            f"⏰ Saatler: {times_str}\n🎫 Sınıflar: {cabins_str}\n👥 Yolcular: {describe_passengers(state['passengers'])}")
+
+async def handle_price_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    state = get_wizard_state(chat_id, "selecting_price")
+    if state is None:
+        await session_expired(query, context, chat_id, "/price")
+        return
     
-    if chat_id not in monitor_jobs or not monitor_jobs[chat_id]:
-        await update.message.reply_text("ℹ️ Aktif bir izlemeniz bulunmuyor.")
+    state["price_threshold"] = float(args[0]) or None
+    state["state"] = "selecting_interval"
+    
+    await query.edit_message_text(
+        text=f"{price_wizard_summary(state)}\n💸 Fiyat: {format_price_threshold(state['price_threshold'])}\n\n"
+             f"🔄 *Hangi sıklıkla kontrol edilsin?*",
+        reply_markup=create_interval_selection_keyboard("mi", None, chat_quota(chat_id)[1]),
+        parse_mode='Markdown'
+    )
+
+async def handle_live_board_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    state = get_wizard_state(chat_id, "selecting_interval")
+    if state is None:
+        await session_expired(query, context, chat_id)
         return
     
-    user_jobs = monitor_jobs[chat_id]
-    msg_text = f"📝 *Aktif İzlemeleriniz ({len(user_jobs)} adet):*\n\n"
+    state["live_board"] = not state.get("live_board")
+    await query.edit_message_reply_markup(
+        reply_markup=create_interval_selection_keyboard("mi", state["live_board"], chat_quota(chat_id)[1])
+    )
+
+async def handle_interval_callback(query, context: CallbackContext, chat_id: str, args: tuple):
+    state = get_wizard_state(chat_id, "selecting_interval")
+    if state is None:
+        await session_expired(query, context, chat_id)
+        return
     
-    for job_id, job in user_jobs.items():
-        info = job["info"]
-        times_str = ", ".join(info.get("times", [])) if info.get("times") else "Tümü"
-        msg_text += f"🔵 *#{job_id}* | {info['from']} ➡ {info['to']}\n"
-        msg_text += f"   📅 {info['date']}\n"
-        msg_text += f"   ⏰ Saatler: {times_str}\n"
-        msg_text += f"   🔄 Kontrol sıklığı: {info['interval']}sn\n\n"
+    # Kota sihirbaz açıkken başka bir izleme başlatılarak dolmuş olabilir
+    check_interval = max(int(args[0]), chat_quota(chat_id)[1])
+    quota_message = quota_exceeded_message(chat_id)
     
-    msg_text += "Durdurmak için /stop yazın."
+    # İzlemeyi başlat
+    from_label, to_label = state["from_label"], state["to_label"]
+    date_tr_str = state["target_date"].strftime("%d %B %Y")
     
-    await update.message.reply_text(msg_text, parse_mode='Markdown')
+    # Önceki tüm ara mesajları temizle
+    cleanup_ids = state.get("cleanup_ids", [])
+    # Şu anki butonlu mesajın ID'sini de ekle
+    cleanup_ids.append(query.message.message_id)
+    await delete_messages(context, chat_id, cleanup_ids)
+    
+    if quota_message:
+        # Butonlu mesaj silindi; uyarı mesaj olarak gider ve sihirbaz kapanır
+        user_states.pop(chat_id, None)
+        await context.bot.send_message(chat_id=chat_id, text=quota_message)
+        return
+    
+    # İzleme işini başlat (yerel thread veya broker)
+    # Tek güzergah kaldıysa ilk seçilen ID'ler değil geçerli çift izlenir
+    from_id, to_id = state["routes"][0]
+    start_monitor_job(
+        chat_id,
+        {
+            "from_id": from_id,
+            "to_id": to_id,
+            "target_date": state["target_date"],
+            "interval_seconds": check_interval,
+            "selected_times": state["selected_times"],
+            "time_ranges": state["time_ranges"],
+            "cabin_classes": state["cabin_classes"],
+            "passengers": list(normalize_passengers(state["passengers"])),
+            "min_seats": state["min_seats"],
+            "routes": state["routes"] if len(state["routes"]) > 1 else None,
+            "mode": "price" if state["action"] == "price" else "seats",
+            "price_threshold": state.get("price_threshold"),
+            "live_board": bool(state.get("live_board")),
+            "wait_for_sale": bool(state.get("wait_for_sale"))
+        },
+        {
+            "from": from_label,
+            "to": to_label,
+            "date": date_tr_str,
+            "interval": check_interval,
+            "times": state["time_ranges"] + state["selected_times"],
+            "mode": "price" if state["action"] == "price" else "seats",
+            "price_threshold": state.get("price_threshold"),
+            "live_board": bool(state.get("live_board")),
+            "sale_watch": bool(state.get("wait_for_sale"))
+        }
+    )
+    
+    # Kullanıcı durumunu temizle
+    user_states.pop(chat_id, None)
+
+# Callback opcode -> handler. Her buton basışı tek sözlük aramasıyla yönlendirilir.
+# Handler bir metin döndürürse buton basışı o uyarıyla cevaplanır.
+CALLBACK_HANDLERS = {
+    "x": handle_cancel_callback,
+    "sa": handle_stop_all_callback,
+    "sj": handle_stop_job_callback,
+    "f": handle_from_callback,
+    "fa": handle_from_all_callback,
+    "t": handle_to_callback,
+    "ta": handle_to_all_callback,
+    "d": handle_date_callback,
+    "fd": handle_future_date_callback,
+    "mt": handle_time_toggle_callback,
+    "ma": handle_time_all_callback,
+    "md": handle_time_done_callback,
+    "mb": handle_cabin_toggle_callback,
+    "mbd": handle_cabin_done_callback,
+    "pa": handle_passenger_add_callback,
+    "pr": handle_passenger_remove_callback,
+    "mc": handle_count_callback,
+    "mp": handle_price_callback,
+    "lb": handle_live_board_callback,
+    "mi": handle_interval_callback,
+}
 
 async def button_callback(update: Update, context: CallbackContext):
     query = update.callback_query
-    await query.answer()
-    
     chat_id = str(query.message.chat_id)
+    # Sorgu yalnız bir kez cevaplanabilir; handler'ın uyarısı için sona bırakılır
+    alert = None
     
     try:
-        if query.data == "cancel_search":
-            if chat_id in user_states:
-                cleanup_ids = user_states[chat_id].get("cleanup_ids", [])
-                cleanup_ids.append(query.message.message_id)
-                await delete_messages(context, chat_id, cleanup_ids)
-                del user_states[chat_id]
-            else:
-                await query.edit_message_text("❌ İşlem iptal edildi.")
-            return
-        
-        # Stop job callbacks
-        if query.data == "stop_all":
-            if chat_id in monitor_jobs:
-                stopped_count = 0
-                for job_id, job in list(monitor_jobs[chat_id].items()):
-                    job["stop_event"].set()
-                    stopped_count += 1
-                await query.edit_message_text(f"⛔ Tüm izlemeler durduruluyor... ({stopped_count} adet) 🛑")
-            else:
-                await query.edit_message_text("Aktif bir izlemeniz bulunmuyor.")
-            return
+        op, args = decode_callback(query.data)
+        handler = CALLBACK_HANDLERS.get(op)
         
-        if query.data.startswith("stop_job_"):
-            job_id = int(query.data.split("_")[2])
-            if chat_id in monitor_jobs and job_id in monitor_jobs[chat_id]:
-                job = monitor_jobs[chat_id][job_id]
-                info = job["info"]
-                job["stop_event"].set()
-                await query.edit_message_text(
-                    f"🛑 İzleme durduruluyor...\n"
-                    f"#{job_id} | {info['from']} ➡ {info['to']} | {info['date']}"
-                )
-            else:
-                await query.edit_message_text("❌ Bu izleme zaten durdurulmuş.")
+        if handler is None or args is None:
+            await session_expired(query, context, chat_id, "/check veya /monitor")
             return
         
-        parts = query.data.split('_')
-        prefix = parts[0]
-
-        if prefix == 'from':
-            action = parts[1]
-            from_station_id = int(parts[2])
-            from_station = get_station_by_id(from_station_id)
-            
-            cleanup_ids = user_states[chat_id].get("cleanup_ids", []) if chat_id in user_states else []
-            user_states[chat_id] = {
-                "state": "waiting_to",
-                "action": action,
-                "from_station_id": from_station_id,
-                "cleanup_ids": cleanup_ids
-            }
-            
-            await query.edit_message_text(
-                text=f"✅ Kalkış: *{from_station['name']}*\n\n"
-                     f"🔍 *Varış İstasyonu Araması*\n\n"
-                     f"Lütfen varış istasyonu adını yazın (en az 3 karakter).",
-                parse_mode='Markdown'
-            )
-        
-        elif prefix == 'to':
-            action = parts[1]
-            from_station_id = int(parts[2])
-            to_station_id = int(parts[3])
-            
-            cleanup_ids = user_states[chat_id].get("cleanup_ids", []) if chat_id in user_states else []
-            
-            user_states[chat_id] = {
-                "state": "waiting_date",
-                "action": action,
-                "from_station_id": from_station_id,
-                "to_station_id": to_station_id,
-                "cleanup_ids": cleanup_ids
-            }
-            
-            from_station = get_station_by_id(from_station_id)
-            to_station = get_station_by_id(to_station_id)
-            
-            keyboard = create_date_keyboard(action=action, from_station_id=from_station_id, to_station_id=to_station_id)
-            await query.edit_message_text(
-                text=f"Kalkış: *{from_station['name']}*\nVarış: *{to_station['name']}*\n\nLütfen bir *tarih* seçin:",
-                reply_markup=keyboard,
-                parse_mode='Markdown'
-            )
-            
-        elif prefix == 'date':
-            action = parts[1]
-            from_station_id = int(parts[2])
-            to_station_id = int(parts[3])
-            date_iso_str = parts[4]
-            target_date = datetime.strptime(date_iso_str, "%Y-%m-%d")
-            
-            from_station = get_station_by_id(from_station_id)
-            to_station = get_station_by_id(to_station_id)
-            
-            date_tr_str = target_date.strftime("%d %B %Y")
-            
-            cleanup_ids = user_states[chat_id].get("cleanup_ids", []) if chat_id in user_states else []
-
-            if action == "check":
-                cleanup_ids.append(query.message.message_id)
-                await delete_messages(context, chat_id, cleanup_ids)
-                
-                print(f"Check başlatıldı: {from_station['name']} -> {to_station['name']}")
-                threading.Thread(
-                    target=run_one_time_check,
-                    args=(chat_id, from_station_id, to_station_id, target_date)
-                ).start()
-                
-                if chat_id in user_states:
-                    del user_states[chat_id]
-                return
-            
-            elif action == "monitor":
-                
-                await query.edit_message_text(
-                    text=f"🚆 *{from_station['name']}* ➡ *{to_station['name']}*\n🗓 *{date_tr_str}*\n\n⏳ Sefer saatleri alınıyor...", 
-                    parse_mode='Markdown'
-                )
-                
-                # Sefer saatlerini al
-                available_times = get_available_train_times(from_station_id, to_station_id, target_date)
-                
-                if not available_times:
-                    cleanup_ids = user_states[chat_id].get("cleanup_ids", []) if chat_id in user_states else []
-                    cleanup_ids.append(query.message.message_id)
-                    await delete_messages(context, chat_id, cleanup_ids)
-                    
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text=f"❌ *{from_station['name']}* ➡ *{to_station['name']}*\n🗓 *{date_tr_str}*\n\nBu tarihte sefer bulunamadı.", 
-                        parse_mode='Markdown'
-                    )
-                    
-                    if chat_id in user_states:
-                        del user_states[chat_id]
-                    return
-                
-                user_states[chat_id] = {
-                    "state": "selecting_times",
-                    "action": "monitor",
-                    "from_station_id": from_station_id,
-                    "to_station_id": to_station_id,
-                    "target_date": target_date,
-                    "available_times": available_times,
-                    "selected_times": [t["time"] for t in available_times],  # Başta hepsi seçili
-                    "include_business": False,
-                    "min_seats": 1,
-                    "cleanup_ids": cleanup_ids
-                }
-                
-                # Saatleri göster
-                times_info = "\n".join([f"• {t['time']}{' (' + t['type'] + ')' if t.get('type') else ''} - {t['train_name']}" for t in available_times])
-                keyboard = create_time_selection_keyboard(
-                    available_times, 
-                    user_states[chat_id]["selected_times"],
-                    "mtime"
-                )
-                await query.edit_message_text(
-                    text=f"🚆 *{from_station['name']}* ➡ *{to_station['name']}*\n🗓 *{date_tr_str}*\n\n"
-                         f"*Mevcut Seferler:*\n{times_info}\n\n"
-                         f"⏰ *İzlemek istediğiniz saatleri seçin:*\n(Seçili olanlar ✅ ile gösterilir)",
-                    reply_markup=keyboard,
-                    parse_mode='Markdown'
-                )
-        
-        elif prefix == 'mtime':
-            if chat_id not in user_states or user_states[chat_id].get("state") != "selecting_times":
-                try: await query.message.delete()
-                except: pass
-                await context.bot.send_message(chat_id=chat_id, text="❌ Oturum süresi doldu. Lütfen /monitor ile tekrar başlayın.")
-                return
-            
-            state = user_states[chat_id]
-            sub_action = parts[1]
-            
-            if sub_action == "toggle":
-                time_str = parts[2]
-                if time_str in state["selected_times"]:
-                    state["selected_times"].remove(time_str)
-                else:
-                    state["selected_times"].append(time_str)
-                
-                # Klavyeyi güncelle
-                keyboard = create_time_selection_keyboard(
-                    state["available_times"],
-                    state["selected_times"],
-                    "mtime"
-                )
-                await query.edit_message_reply_markup(reply_markup=keyboard)
-            
-            elif sub_action == "all":
-                # Tümünü seç/temizle
-                if len(state["selected_times"]) < len(state["available_times"]):
-                    state["selected_times"] = [t["time"] for t in state["available_times"]]
-                else:
-                    state["selected_times"] = []
-                
-                keyboard = create_time_selection_keyboard(
-                    state["available_times"],
-                    state["selected_times"],
-                    "mtime"
-                )
-                await query.edit_message_reply_markup(reply_markup=keyboard)
-            
-            elif sub_action == "done":
-                if not state["selected_times"]:
-                    await query.answer("⚠️ En az bir saat seçmelisiniz!", show_alert=True)
-                    return
-                
-                # Business seçimine geç
-                state["state"] = "selecting_business"
-                keyboard = create_business_keyboard("mbiz")
-                
-                from_station = get_station_by_id(state["from_station_id"])
-                to_station = get_station_by_id(state["to_station_id"])
-                date_tr_str = state["target_date"].strftime("%d %B %Y")
-                times_str = ", ".join(sorted(state["selected_times"]))
-                
-                await query.edit_message_text(
-                    text=f"🚆 *{from_station['name']}* ➡ *{to_station['name']}*\n🗓 *{date_tr_str}*\n"
-                         f"⏰ Saatler: {times_str}\n\n"
-                         f"💼 *Business sınıfını dahil etmek ister misiniz?*",
-                    reply_markup=keyboard,
-                    parse_mode='Markdown'
-                )
-        
-        elif prefix == 'mbiz':
-            if chat_id not in user_states or user_states[chat_id].get("state") != "selecting_business":
-                try: await query.message.delete()
-                except: pass
-                await context.bot.send_message(chat_id=chat_id, text="❌ Oturum süresi doldu. Lütfen /monitor ile tekrar başlayın.")
-                return
-            
-            state = user_states[chat_id]
-            include_business = parts[1] == "yes"
-            state["include_business"] = include_business
-            
-            # Kişi sayısı seçimine geç
-            state["state"] = "selecting_count"
-            keyboard = create_passenger_count_keyboard("mcount")
-            
-            from_station = get_station_by_id(state["from_station_id"])
-            to_station = get_station_by_id(state["to_station_id"])
-            date_tr_str = state["target_date"].strftime("%d %B %Y")
-            times_str = ", ".join(sorted(state["selected_times"]))
-            biz_str = "Dahil" if include_business else "Hariç"
-            
-            await query.edit_message_text(
-                text=f"🚆 *{from_station['name']}* ➡ *{to_station['name']}*\n🗓 *{date_tr_str}*\n"
-                     f"⏰ Saatler: {times_str}\n💼 Business: {biz_str}\n\n"
-                     f"👥 *Kaç kişilik yer arıyorsunuz?*\n(En az bu kadar boş yer olunca bildirim alacaksınız)",
-                reply_markup=keyboard,
-                parse_mode='Markdown'
-            )
-        
-        elif prefix == 'mcount':
-            if chat_id not in user_states or user_states[chat_id].get("state") != "selecting_count":
-                try: await query.message.delete()
-                except: pass
-                await context.bot.send_message(chat_id=chat_id, text="❌ Oturum süresi doldu. Lütfen /monitor ile tekrar başlayın.")
-                return
-            
-            state = user_states[chat_id]
-            min_seats = int(parts[1])
-            state["min_seats"] = min_seats
-            
-            # İzleme sıklığı seçimine geç
-            state["state"] = "selecting_interval"
-            keyboard = create_interval_selection_keyboard("minterval")
-            
-            from_station = get_station_by_id(state["from_station_id"])
-            to_station = get_station_by_id(state["to_station_id"])
-            date_tr_str = state["target_date"].strftime("%d %B %Y")
-            times_str = ", ".join(sorted(state["selected_times"]))
-            biz_str = "Dahil" if state["include_business"] else "Hariç"
-            
-            await query.edit_message_text(
-                text=f"🚆 *{from_station['name']}* ➡ *{to_station['name']}*\n🗓 *{date_tr_str}*\n"
-                     f"⏰ Saatler: {times_str}\n💼 Business: {biz_str}\n👥 Min. Yer: {min_seats}\n\n"
-                     f"🔄 *Hangi sıklıkla kontrol edilsin?*",
-                reply_markup=keyboard,
-                parse_mode='Markdown'
-            )
-
-        elif prefix == 'minterval':
-            if chat_id not in user_states or user_states[chat_id].get("state") != "selecting_interval":
-                try: await query.message.delete()
-                except: pass
-                await context.bot.send_message(chat_id=chat_id, text="❌ Oturum süresi doldu. Lütfen /monitor ile tekrar başlayın.")
-                return
-            
-            state = user_states[chat_id]
-            check_interval = int(parts[1])
-            
-            # İzlemeyi başlat
-            from_station = get_station_by_id(state["from_station_id"])
-            to_station = get_station_by_id(state["to_station_id"])
-            date_tr_str = state["target_date"].strftime("%d %B %Y")
-            
-            # Önceki tüm ara mesajları temizle
-            cleanup_ids = state.get("cleanup_ids", [])
-            # Şu anki butonlu mesajın ID'sini de ekle
-            cleanup_ids.append(query.message.message_id)
-            await delete_messages(context, chat_id, cleanup_ids)
-            
-            # Monitor thread'i başlat
-            global job_id_counter
-            job_id_counter += 1
-            current_job_id = job_id_counter
-            
-            stop_event = threading.Event()
-            monitor_thread = threading.Thread(
-                target=monitoring_loop,
-                args=(chat_id, current_job_id, stop_event, state["from_station_id"], state["to_station_id"], 
-                      state["target_date"], check_interval, 
-                      state["selected_times"], state["include_business"], state["min_seats"])
-            )
-            
-            if chat_id not in monitor_jobs:
-                monitor_jobs[chat_id] = {}
-            
-            monitor_jobs[chat_id][current_job_id] = {
-                "thread": monitor_thread,
-                "stop_event": stop_event,
-                "info": {
-                    "from": from_station['name'],
-                    "to": to_station['name'],
-                    "date": date_tr_str,
-                    "interval": check_interval,
-                    "times": state["selected_times"]
-                }
-            }
-            
-            monitor_thread.start()
-            
-            # Kullanıcı durumunu temizle
-            del user_states[chat_id]
+        alert = await handler(query, context, chat_id, args)
 
     except Exception as e:
         print(f"Callback hatası: {e}")
@@ -1284,9 +4213,15 @@ async def button_callback(update: Update, context: CallbackContext):
             cleanup_ids = user_states[chat_id].get("cleanup_ids", [])
             cleanup_ids.append(query.message.message_id)
             await delete_messages(context, chat_id, cleanup_ids)
-            del user_states[chat_id]
+            user_states.pop(chat_id, None)
         
         await context.bot.send_message(chat_id=chat_id, text=f"❌ Bir hata oluştu ve işlem iptal edildi: {e}")
+    
+    try:
+        await query.answer(alert, show_alert=bool(alert))
+    except BadRequest as e:
+        # Uzun süren işlemlerde sorgunun cevap süresi dolmuş olabilir
+        print(f"Callback cevaplanamadı: {e}")
 
 async def text_message_handler(update: Update, context: CallbackContext):
     chat_id = str(update.message.chat_id)
@@ -1300,14 +4235,100 @@ async def text_message_handler(update: Update, context: CallbackContext):
     try:
         search_query = update.message.text.strip()
         
+        if user_state["state"] == "selecting_times":
+            # Saat aralığı elle yazılabilir: seçimi aralıklarla değiştirip devam eder
+            try:
+                time_ranges = parse_time_ranges(search_query)
+            except ValueError as e:
+                segment = str(e).replace("`", "'")
+                await show_wizard_message(update, context, user_state,
+                                          f"⚠️ Anlaşılamayan saat aralığı: `{segment}`\n"
+                                          f"Saat aralığını `07:00-10:00` veya `18.30-21` biçiminde yazın.")
+                return
+            if not time_ranges:
+                await show_wizard_message(update, context, user_state,
+                                          "⚠️ Saat aralığını `07:00-10:00` biçiminde yazın.")
+                return
+            
+            user_state["time_ranges"] = time_ranges
+            user_state["selected_times"] = []
+            user_state["state"] = "selecting_cabins"
+            await show_wizard_message(update, context, user_state, cabin_step_text(user_state),
+                                      create_cabin_class_keyboard(user_state["cabin_classes"]))
+            return
+        
+        if user_state["state"] == "waiting_future_date":
+            target_date = parse_future_date(search_query)
+            today = get_now().date()
+            if target_date is None:
+                await show_wizard_message(update, context, user_state,
+                                          "⚠️ Tarihi `GG.AA.YYYY` biçiminde yazın. Örnek: "
+                                          f"`{(today + timedelta(days=SALES_HORIZON_DAYS)).strftime('%d.%m.%Y')}`")
+                return
+            if target_date.date() < today + timedelta(days=SALES_HORIZON_DAYS):
+                await show_wizard_message(update, context, user_state,
+                                          "ℹ️ Bu tarih zaten satışta. Lütfen /monitor ile tarih listesinden seçin.")
+                return
+            if target_date.date() > today + timedelta(days=SALES_MAX_LEAD_DAYS):
+                await show_wizard_message(update, context, user_state,
+                                          f"⚠️ En fazla {SALES_MAX_LEAD_DAYS} gün sonrası beklenebilir.")
+                return
+            
+            routes = wizard_routes(user_state)
+            if not routes:
+                await delete_messages(context, chat_id, user_state.get("cleanup_ids", []))
+                await context.bot.send_message(chat_id=chat_id, text="❌ Seçilen istasyonlar arasında doğrudan sefer bulunmuyor.")
+                user_states.pop(chat_id, None)
+                return
+            from_label = station_names(dict.fromkeys(from_id for from_id, _ in routes))
+            to_label = station_names(dict.fromkeys(to_id for _, to_id in routes))
+            
+            # Seferler henüz listelenmez; aynı haftanın gününe denk gelen satıştaki tarihin saatleri önerilir
+            schedule_date = schedule_template_date(target_date)
+            available_times = await asyncio.to_thread(get_available_train_times_for_routes, routes, schedule_date)
+            if not available_times:
+                await delete_messages(context, chat_id, user_state.get("cleanup_ids", []))
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text=f"❌ *{from_label}* ➡ *{to_label}*\n\n"
+                         f"{schedule_date.strftime('%d %B')} tarifesinde sefer bulunamadığı için saatler önerilemiyor.",
+                    parse_mode='Markdown'
+                )
+                user_states.pop(chat_id, None)
+                return
+            
+            text, keyboard = begin_time_selection(user_state, routes, from_label, to_label, target_date,
+                                                  available_times, wait_for_sale=True, schedule_date=schedule_date)
+            await show_wizard_message(update, context, user_state, text, keyboard)
+            return
+        
+        if user_state["state"] == "selecting_price":
+            # Fiyat eşiği elle yazılabilir
+            try:
+                price_threshold = float(search_query.replace(",", ".").upper().replace("TRY", "").replace("TL", "").strip())
+            except ValueError:
+                price_threshold = -1
+            if price_threshold <= 0:
+                await show_wizard_message(update, context, user_state, "⚠️ Lütfen geçerli bir tutar yazın. Örnek: `450`")
+                return
+            
+            user_state["price_threshold"] = price_threshold
+            user_state["state"] = "selecting_interval"
+            await show_wizard_message(
+                update, context, user_state,
+                f"{price_wizard_summary(user_state)}\n💸 Fiyat: {format_price_threshold(price_threshold)}\n\n"
+                f"🔄 *Hangi sıklıkla kontrol edilsin?*",
+                create_interval_selection_keyboard("mi", None, chat_quota(chat_id)[1])
+            )
+            return
+        
         # Minimum 3 karakter kontrolü
         if len(search_query) < 3:
-            msg = await update.message.reply_text(
+            await show_wizard_message(
+                update, context, user_state,
                 "⚠️ Lütfen en az 3 karakter girin.\n"
-                "Örnek: `Ank`, `İst`, `İzm`",
-                parse_mode='Markdown'
+                "Örnek: `Ank`, `İst`, `İzm`"
             )
-            user_state["cleanup_ids"].append(msg.message_id)
             return
         
         action = user_state["action"]
@@ -1317,94 +4338,92 @@ async def text_message_handler(update: Update, context: CallbackContext):
             results = search_stations(search_query)
             
             if not results:
-                msg = await update.message.reply_text(
+                await show_wizard_message(
+                    update, context, user_state,
                     f"❌ *'{search_query}'* için istasyon bulunamadı.\n\n"
-                    "Lütfen farklı bir arama terimi deneyin.",
-                    parse_mode='Markdown'
+                    "Lütfen farklı bir arama terimi deneyin."
                 )
-                user_state["cleanup_ids"].append(msg.message_id)
                 return
             
             # Tek sonuç varsa otomatik seç
             if len(results) == 1:
                 from_station = results[0]
-                from_station_id = from_station['id']
-                
-                cleanup_ids = user_state.get("cleanup_ids", [])
-                user_states[chat_id] = {
-                    "state": "waiting_to",
-                    "action": action,
-                    "from_station_id": from_station_id,
-                    "cleanup_ids": cleanup_ids
-                }
+                user_state["state"] = "waiting_to"
+                user_state["from_station_id"] = from_station['id']
                 
-                msg = await update.message.reply_text(
+                await show_wizard_message(
+                    update, context, user_state,
                     f"✅ Kalkış: *{from_station['name']}* (otomatik seçildi)\n\n"
                     f"🔍 *Varış İstasyonu Araması*\n\n"
-                    f"Lütfen varış istasyonu adını yazın (en az 3 karakter).",
-                    parse_mode='Markdown'
+                    f"Lütfen varış istasyonu adını yazın (en az 3 karakter)."
                 )
-                user_states[chat_id]["cleanup_ids"].append(msg.message_id)
                 return
             
-            keyboard = create_search_result_keyboard(results, action)
-            msg = await update.message.reply_text(
+            # Aktarmalı arama ve istatistiklerde tek kalkış/varış çifti kullanılır
+            allow_multi = action not in ("connect", "stats")
+            groups = search_station_groups(search_query, [station['id'] for station in get_active_stations()]) if allow_multi else None
+            keyboard = create_search_result_keyboard(results, allow_multi=allow_multi, groups=groups)
+            await show_wizard_message(
+                update, context, user_state,
                 f"🔍 *'{search_query}'* için {len(results)} sonuç bulundu:\n\n"
                 "Lütfen kalkış istasyonunu seçin:",
-                reply_markup=keyboard,
-                parse_mode='Markdown'
+                keyboard
             )
-            user_state["cleanup_ids"].append(msg.message_id)
         
         elif state == "waiting_to":
             from_station_id = user_state["from_station_id"]
-            from_station = get_station_by_id(from_station_id)
+            from_station_ids = user_state.get("from_station_ids")
+            from_label = station_names(from_station_ids or [from_station_id])
             
-            results = search_stations(search_query, from_station_id)
+            if action == "connect":
+                results = search_stations(search_query, stations=get_two_hop_destinations(from_station_id))
+            else:
+                results = search_stations(search_query, from_station_id, from_station_ids)
             
             if not results:
-                msg = await update.message.reply_text(
+                await show_wizard_message(
+                    update, context, user_state,
                     f"❌ *'{search_query}'* için varış istasyonu bulunamadı.\n\n"
-                    f"*{from_station['name']}* istasyonundan gidilebilecek farklı bir istasyon arayın.",
-                    parse_mode='Markdown'
+                    f"*{from_label}* istasyonundan gidilebilecek farklı bir istasyon arayın."
                 )
-                user_state["cleanup_ids"].append(msg.message_id)
                 return
             
             # Tek sonuç varsa otomatik seç ve tarih seçimine geç
             if len(results) == 1:
                 to_station = results[0]
-                to_station_id = to_station['id']
+                user_state["state"] = "waiting_date"
+                user_state["to_station_id"] = to_station['id']
                 
-                cleanup_ids = user_state.get("cleanup_ids", [])
-                user_states[chat_id] = {
-                    "state": "waiting_date",
-                    "action": action,
-                    "from_station_id": from_station_id,
-                    "to_station_id": to_station_id,
-                    "cleanup_ids": cleanup_ids
-                }
+                if action == "stats":
+                    await start_route_stats(None, context, chat_id, user_state)
+                    return
+                if action == "calendar":
+                    await start_sales_calendar(None, context, chat_id, user_state)
+                    return
                 
-                keyboard = create_date_keyboard(action=action, from_station_id=from_station_id, to_station_id=to_station_id)
-                msg = await update.message.reply_text(
-                    f"✅ Kalkış: *{from_station['name']}*\n"
+                keyboard = create_date_keyboard(action=action)
+                await show_wizard_message(
+                    update, context, user_state,
+                    f"✅ Kalkış: *{from_label}*\n"
                     f"✅ Varış: *{to_station['name']}* (otomatik seçildi)\n\n"
                     f"Lütfen bir *tarih* seçin:",
-                    reply_markup=keyboard,
-                    parse_mode='Markdown'
+                    keyboard
                 )
-                user_states[chat_id]["cleanup_ids"].append(msg.message_id)
                 return
             
-            keyboard = create_search_result_keyboard(results, action, from_station_id)
-            msg = await update.message.reply_text(
-                f"✅ Kalkış: *{from_station['name']}*\n\n"
+            allow_multi = action not in ("connect", "stats")
+            groups = None
+            if allow_multi:
+                destination_ids = [station['id'] for station in get_available_destinations_for(from_station_ids or [from_station_id])]
+                groups = search_station_groups(search_query, destination_ids)
+            keyboard = create_search_result_keyboard(results, is_destination=True, allow_multi=allow_multi, groups=groups)
+            await show_wizard_message(
+                update, context, user_state,
+                f"✅ Kalkış: *{from_label}*\n\n"
                 f"🔍 *'{search_query}'* için {len(results)} sonuç bulundu:\n\n"
                 "Lütfen varış istasyonunu seçin:",
-                reply_markup=keyboard,
-                parse_mode='Markdown'
+                keyboard
             )
-            user_state["cleanup_ids"].append(msg.message_id)
             
     except Exception as e:
         print(f"Metin mesajı işleme hatası: {e}")
@@ -1413,25 +4432,263 @@ async def text_message_handler(update: Update, context: CallbackContext):
         if chat_id in user_states:
             cleanup_ids = user_states[chat_id].get("cleanup_ids", [])
             await delete_messages(context, chat_id, cleanup_ids)
-            del user_states[chat_id]
+            user_states.pop(chat_id, None)
         await context.bot.send_message(chat_id=chat_id, text=f"❌ Bir hata oluştu ve işlem iptal edildi: {e}")
 
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Farklı sohbetlerin güncellemelerini eşzamanlı, aynı sohbetinkileri geliş sırasıyla
+    birbiri ardına işler; sihirbaz adımları ve user_states[chat_id] karışmaz.
+    Sohbet sırasında bekleyen güncelleme handler yuvası tutmaz: en fazla handler_limit
+    handler aynı anda çalışır, bekleyen + çalışan toplamı max_concurrent_updates ile sınırlıdır.
+    """
+
+    def __init__(self, max_concurrent_updates: int, handler_limit: int):
+        super().__init__(max_concurrent_updates)
+        self.handler_limit = handler_limit
+        self._handler_slots = None
+        self._chat_locks = {}  # {chat_id: [asyncio.Lock, bekleyen güncelleme sayısı]}
+
+    async def initialize(self):
+        self._handler_slots = asyncio.Semaphore(self.handler_limit)
+
+    async def shutdown(self):
+        self._chat_locks.clear()
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            async with self._handler_slots:
+                await coroutine
+            return
+        
+        entry = self._chat_locks.get(chat.id)
+        if entry is None:
+            entry = self._chat_locks[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._handler_slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat.id]
+
+def run_update_load_test(chats: int = 100, updates_per_chat: int = 3, slow_ratio: float = 0.1) -> int:
+    """
+    Simüle sohbetlerle güncelleme işleme yük testi: varsayılan sıralı işleme ile
+    ChatOrderedUpdateProcessor'ın cevap gecikmesini (p50/p95) karşılaştırır.
+    Handler'lar çoğunlukla 20 ms'lik Telegram çağrısı, slow_ratio oranında da
+    thread'de 300 ms'lik TCDD sorgusu yapar. Sohbet içi sıra bozulursa 1 döner.
+    """
+    import random
+    import types
+
+    async def fake_handler(chat_id: int, seq: int, slow: bool, finished: list):
+        if slow:
+            await asyncio.to_thread(time.sleep, 0.3)
+        await asyncio.sleep(0.02)
+        finished.append((chat_id, seq))
+
+    async def run(processor) -> tuple:
+        rng = random.Random(42)
+        arrivals = sorted((rng.uniform(0, 2.0), chat_id) for chat_id in range(chats) for _ in range(updates_per_chat))
+        latencies, finished, tasks, sequence = [], [], [], {}
+        
+        async def process(update, coroutine, arrived):
+            await processor.process_update(update, coroutine)
+            latencies.append(time.monotonic() - arrived)
+        
+        async with processor:
+            started = time.monotonic()
+            for offset, chat_id in arrivals:
+                await asyncio.sleep(max(0.0, started + offset - time.monotonic()))
+                seq = sequence[chat_id] = sequence.get(chat_id, -1) + 1
+                update = types.SimpleNamespace(effective_chat=types.SimpleNamespace(id=chat_id))
+                coroutine = fake_handler(chat_id, seq, rng.random() < slow_ratio, finished)
+                tasks.append(asyncio.create_task(process(update, coroutine, time.monotonic())))
+            await asyncio.gather(*tasks)
+        
+        ordered = all(seq == expected
+                      for chat_id in range(chats)
+                      for expected, seq in enumerate(s for c, s in finished if c == chat_id))
+        latencies.sort()
+        return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)], ordered
+
+    total = chats * updates_per_chat
+    print(f"🧪 {chats} sohbet, {total} güncelleme (%{slow_ratio * 100:.0f} yavaş handler)")
+    failed = False
+    for label, processor in (
+        ("Sıralı (varsayılan)", SimpleUpdateProcessor(1)),
+        (f"Sohbet sıralı, {UPDATE_CONCURRENCY} eşzamanlı", ChatOrderedUpdateProcessor(UPDATE_QUEUE_LIMIT, UPDATE_CONCURRENCY)),
+    ):
+        p50, p95, ordered = asyncio.run(run(processor))
+        print(f"   {label:32s} p50 {p50 * 1000:7.0f} ms   p95 {p95 * 1000:7.0f} ms   sohbet içi sıra {'✅' if ordered else '❌'}")
+        failed = failed or not ordered
+    return 1 if failed else 0
+
+def run_clock_benchmark(samples: int = 200000) -> int:
+    """
+    istanbul_clock'u eski yol (naive fromtimestamp + strftime) ve tz'li datetime ile
+    karşılaştırır. Sonuçlar tz veritabanıyla uyuşmazsa 1 döner.
+    """
+    import random
+
+    rng = random.Random(42)
+    # API dakika hassasiyetinde kalkış saatleri döner; 2014-2030 arası (2016 öncesi yavaş yol)
+    start, end = int(datetime(2014, 1, 1).timestamp()), int(datetime(2030, 1, 1).timestamp())
+    stamps = [rng.randrange(start, end) // 60 * 60000 for _ in range(samples)]
+
+    paths = (
+        ("Eski (naive fromtimestamp)", lambda ms: datetime.fromtimestamp(ms / 1000).strftime("%H:%M")),
+        ("tz'li datetime", lambda ms: datetime.fromtimestamp(ms / 1000, TZ_ISTANBUL).strftime("%H:%M")),
+        ("istanbul_clock", istanbul_clock),
+    )
+    print(f"🧪 {samples} zaman damgası, sunucu saat dilimi: {time.strftime('%Z')}")
+    results = {}
+    for label, convert in paths:
+        started = time.perf_counter()
+        results[label] = [convert(ms) for ms in stamps]
+        elapsed = time.perf_counter() - started
+        print(f"   {label:28s} {elapsed * 1000:8.1f} ms   {elapsed * 1e9 / samples:6.0f} ns/çağrı")
+
+    mismatches = sum(a != b for a, b in zip(results["tz'li datetime"], results["istanbul_clock"]))
+    print(f"   tz veritabanıyla uyuşmayan: {mismatches}")
+    return 1 if mismatches else 0
+
+def run_keyboard_benchmark(repeats: int = 2000, departures: int = 34) -> int:
+    """
+    Buton basışında kurulan klavyeleri ölçer: önbellekli ve her seferinde yeniden
+    kurulan tarih/aralık/vagon/yolcu klavyeleri, artımlı ve baştan kurulan saat
+    ızgarası. Artımlı ızgara baştan kurulanla aynı değilse 1 döner.
+    """
+    today = get_now().date()
+    available_times = [{"time": f"{6 + i * 16 // 60:02d}:{i * 16 % 60:02d}"} for i in range(departures)]
+    passengers = {type_id: int(type_id == 0) for type_id in PASSENGER_TYPES}
+
+    def timed(build) -> float:
+        build()  # Önbelleği ısıt
+        started = time.perf_counter()
+        for _ in range(repeats):
+            build()
+        return (time.perf_counter() - started) * 1e6 / repeats
+
+    cases = (
+        ("Tarih", lambda: create_date_keyboard("m"), lambda: _date_keyboard.__wrapped__(today, "m")),
+        ("Aralık", lambda: create_interval_selection_keyboard("mi", False),
+         lambda: create_interval_selection_keyboard.__wrapped__("mi", False)),
+        ("Vagon sınıfı", lambda: create_cabin_class_keyboard(["e"]),
+         lambda: _cabin_class_keyboard.__wrapped__(frozenset(["e"]))),
+        ("Yolcu", lambda: create_passenger_keyboard(passengers),
+         lambda: _passenger_keyboard.__wrapped__(tuple(passengers.get(t, 0) for t in PASSENGER_TYPES))),
+    )
+    print(f"🧪 Klavye kurulumu, {repeats} tekrar ({departures} seferlik saat ızgarası)")
+    print(f"   {'':24s} {'önbellekli':>12s} {'yeniden':>12s}")
+    for label, cached, rebuilt in cases:
+        cached_us, rebuilt_us = timed(cached), timed(rebuilt)
+        print(f"   {label:24s} {cached_us:9.1f} µs {rebuilt_us:9.1f} µs   x{rebuilt_us / cached_us:.0f}")
+
+    # Saat ızgarası: her basışta tek saat seçilir/bırakılır
+    rows, selected = [], []
+    create_time_selection_keyboard(available_times, selected, rows)
+    presses = [0]
+
+    def toggle(incremental: bool):
+        index = presses[0] % departures
+        presses[0] += 1
+        time_str = available_times[index]["time"]
+        if time_str in selected:
+            selected.remove(time_str)
+        else:
+            selected.append(time_str)
+        if incremental:
+            return create_time_selection_keyboard(available_times, selected, rows, index)
+        return create_time_selection_keyboard(available_times, selected)
+
+    incremental_us, full_us = timed(lambda: toggle(True)), timed(lambda: toggle(False))
+    print(f"   {'Saat seçimi (artımlı)':24s} {incremental_us:9.1f} µs {full_us:9.1f} µs   x{full_us / incremental_us:.0f}")
+
+    # Baştan kurulan basışlar rows'u güncellemez; karşılaştırma güncel ızgaradan başlar
+    create_time_selection_keyboard(available_times, selected, rows)
+    presses[0] = 0
+    same = toggle(True).to_dict() == create_time_selection_keyboard(available_times, selected).to_dict()
+    print(f"   Artımlı ızgara baştan kurulanla aynı: {'✅' if same else '❌'}")
+    return 0 if same else 1
+
+IMPORT_TIME_BUDGET_MS = int(os.getenv("IMPORT_TIME_BUDGET_MS", "600"))
+
+def check_import_budget() -> int:
+    """
+    Modülü `-X importtime` ile ayrı bir süreçte yükler, en pahalı importları listeler.
+    Returns: süreç çıkış kodu (bütçe aşıldıysa 1)
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import e_bilet"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        return result.returncode
+    
+    # Satır biçimi: "import time: self [us] | cumulative | paket" - girinti derinliği gösterir
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        timings.append((int(cumulative), name.rstrip()))
+    
+    total_us = next(us for us, name in timings if name.strip() == "e_bilet")
+    direct = sorted(((us, name.strip()) for us, name in timings if name.startswith("   ") and not name.startswith("    ")),
+                    reverse=True)
+    
+    print(f"⏱️ e_bilet import süresi: {total_us / 1000:.0f} ms (bütçe {IMPORT_TIME_BUDGET_MS} ms)")
+    for us, name in direct[:10]:
+        print(f"   {us / 1000:7.1f} ms  {name}")
+    
+    if total_us > IMPORT_TIME_BUDGET_MS * 1000:
+        print("❌ Import süresi bütçeyi aşıyor.")
+        return 1
+    return 0
+
 def main():
+    global job_broker
+
+    if RUN_MODE == "worker":
+        run_worker()
+        return
+
     print("🚂 TCDD Bilet Takip Botu başlatılıyor...")
     
+    if RUN_MODE == "frontend":
+        job_broker = JobBroker(BROKER_PATH)
+        restore_broker_jobs()
+        print(f"📮 Frontend modu: işler {BROKER_PATH} üzerinden worker'lara dağıtılacak.")
+    
     if not load_stations():
         print("⚠️ İstasyonlar yüklenemedi, bot yine de başlatılıyor...")
     
-    builder = Application.builder().token(TELEGRAM_API_TOKEN)
+    if job_broker is None:
+        restore_checkpoint()
+    start_watchdog(restart_local_job)
+    
+    builder = Application.builder().token(TELEGRAM_API_TOKEN).concurrent_updates(
+        ChatOrderedUpdateProcessor(UPDATE_QUEUE_LIMIT, UPDATE_CONCURRENCY)
+    )
     app = builder.build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("check", check_command))
     app.add_handler(CommandHandler("monitor", monitor_command))
+    app.add_handler(CommandHandler("price", price_command))
+    app.add_handler(CommandHandler("connect", connect_command))
+    app.add_handler(CommandHandler("stats", stats_command))
+    app.add_handler(CommandHandler("calendar", calendar_command))
     app.add_handler(CommandHandler("status", status_command))
     app.add_handler(CommandHandler("stop", stop_command))
     
-    app.add_handler(CallbackQueryHandler(button_callback, pattern='^(from_|to_|date_|mtime_|mbiz_|mcount_|minterval_|cancel_search|stop_)'))
+    app.add_handler(CallbackQueryHandler(button_callback))
     
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_message_handler))
 
@@ -1441,14 +4698,238 @@ def main():
             ("start", "Botu başlat ve yardım göster"),
             ("check", "Tek seferlik bilet kontrolü"),
             ("monitor", "Sürekli bilet takibi başlat"),
+            ("price", "Fiyat düşüşü takibi başlat"),
+            ("connect", "Aktarmalı sefer ara"),
+            ("stats", "Güzergah geçmişi istatistikleri"),
+            ("calendar", "Satıştaki günlerin yer/fiyat takvimi"),
             ("status", "Aktif izlemeleri görüntüle"),
             ("stop", "Aktif izlemeleri durdur"),
         ])
+        if job_broker is not None:
+            application.bot_data["outbox_pump"] = application.create_task(broker_outbox_pump(application))
+        if USER_STATE_SWEEP_SECONDS > 0:
+            application.create_task(user_state_sweeper(application))
+    
+    # SIGTERM/SIGINT'te PTB güncelleme almayı bırakır; outbox'ta bekleyen son bildirimler iletilir
+    async def post_stop(application):
+        shutdown_event.set()
+        pump = application.bot_data.get("outbox_pump")
+        if pump is not None:
+            try:
+                await asyncio.wait_for(pump, SHUTDOWN_GRACE_SECONDS)
+            except Exception as e:
+                print(f"Outbox kapanışta boşaltılamadı: {e}")
     
     app.post_init = post_init
+    app.post_stop = post_stop
+
+    if WEBHOOK_URL:
+        run_webhook(app)
+    else:
+        print("✅ Bot çalışıyor...")
+        app.run_polling()
+    
+    shutdown_monitors()
+
+def run_webhook(app):
+    """
+    Botu webhook modunda çalıştırır.
+    WEBHOOK_CERT/WEBHOOK_KEY verilirse TLS bot içinde sonlandırılır,
+    verilmezse önde bir reverse proxy olduğu varsayılır.
+    """
+    if bool(WEBHOOK_CERT) != bool(WEBHOOK_KEY):
+        raise ValueError("WEBHOOK_CERT ve WEBHOOK_KEY birlikte tanımlanmalı.")
+
+    if not WEBHOOK_SECRET:
+        print("⚠️ WEBHOOK_SECRET tanımlı değil, gelen istekler doğrulanmayacak.")
+
+    webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+    print(f"✅ Bot webhook modunda çalışıyor: {WEBHOOK_LISTEN}:{WEBHOOK_PORT} -> {webhook_url}")
+
+    app.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=webhook_url,
+        secret_token=WEBHOOK_SECRET,
+        cert=WEBHOOK_CERT,
+        key=WEBHOOK_KEY,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES
+    )
+
+def run_webhook_benchmark(bursts: int = 5, burst_size: int = 100, burst_gap: float = 0.5) -> int:
+    """
+    Polling ve webhook teslimatını yerel sahte Telegram sunucusuyla karşılaştırır.
+    Sahte sunucu Bot API'nin kullanılan uçlarını (getMe, getUpdates, setWebhook,
+    sendMessage...) taklit eder; her güncelleme ayrı bir sohbetten gelen /start'tır.
+    Polling'de güncellemeler getUpdates long-poll kuyruğuna, webhook'ta Telegram gibi
+    WEBHOOK_MAX_CONNECTIONS eşzamanlı POST ile bota gönderilir. Güncellemenin üretilmesinden
+    cevabın (sendMessage) sunucuya ulaşmasına kadar geçen süre ve botun olay döngüsü
+    thread'inin CPU süresi raporlanır. Tüm cevaplar gelmezse 1 döner.
+    """
+    import socket
+    import urllib.parse
+    import urllib.request
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    def free_port() -> int:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            return s.getsockname()[1]
+
+    class FakeTelegram:
+        def __init__(self):
+            self.cond = threading.Condition()
+            self.updates = []  # getUpdates kuyruğu
+            self.sent_at = {}  # {chat_id: güncelleme üretim zamanı}
+            self.replied_at = {}  # {chat_id: cevap zamanı}
+            self.message_id = 0
+
+        def make_update(self, update_id: int, chat_id: int) -> dict:
+            return {"update_id": update_id, "message": {
+                "message_id": update_id, "date": int(time.time()), "text": "/start",
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Yük"},
+                "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+            }}
+
+        def call(self, method: str, params: dict):
+            if method == "getMe":
+                return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+            if method == "getUpdates":
+                offset = int(params.get("offset") or 0)
+                deadline = time.monotonic() + min(float(params.get("timeout") or 0), 5)
+                with self.cond:
+                    while True:
+                        pending = [u for u in self.updates if u["update_id"] >= offset]
+                        remaining = deadline - time.monotonic()
+                        if pending or remaining <= 0:
+                            self.updates = pending
+                            return pending
+                        self.cond.wait(remaining)
+            if method == "sendMessage":
+                chat_id = int(params["chat_id"])
+                with self.cond:
+                    self.replied_at.setdefault(chat_id, time.monotonic())
+                    self.message_id += 1
+                    self.cond.notify_all()
+                    return {"message_id": self.message_id, "date": int(time.time()), "text": params.get("text", ""),
+                            "chat": {"id": chat_id, "type": "private"}}
+            return True  # setWebhook, deleteWebhook, ...
+
+    fake = FakeTelegram()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if "json" in (self.headers.get("Content-Type") or ""):
+                params = json.loads(body or b"{}")
+            else:
+                params = {key: values[0] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+            payload = json.dumps({"ok": True, "result": fake.call(self.path.rsplit("/", 1)[-1], params)}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            try:
+                self.wfile.write(payload)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # durdurulan getUpdates bağlantısı
+
+        def log_message(self, format, *args):
+            pass
+
+    class FakeTelegramServer(ThreadingHTTPServer):
+        # Varsayılan listen kuyruğu (5) patlamada bağlantı düşürür; ölçülen teslimat olmalı
+        request_queue_size = 128
+        daemon_threads = True
+
+    api_port = free_port()
+    server = FakeTelegramServer(("127.0.0.1", api_port), Handler)
+    threading.Thread(target=server.serve_forever, name="fake-telegram", daemon=True).start()
+    secret = "bench-secret"
+
+    async def run(mode: str) -> tuple:
+        with fake.cond:
+            fake.updates, fake.sent_at, fake.replied_at = [], {}, {}
+        app = (Application.builder().token("1:bench").base_url(f"http://127.0.0.1:{api_port}/bot")
+               .concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_QUEUE_LIMIT, UPDATE_CONCURRENCY))
+               .build())
+        app.add_handler(CommandHandler("start", start))
+        webhook_port = free_port()
+        await app.initialize()
+        await app.start()
+        if mode == "webhook":
+            await app.updater.start_webhook(listen="127.0.0.1", port=webhook_port, url_path="telegram",
+                                            secret_token=secret, max_connections=WEBHOOK_MAX_CONNECTIONS,
+                                            webhook_url=f"http://127.0.0.1:{webhook_port}/telegram")
+        else:
+            await app.updater.start_polling(poll_interval=0.0, timeout=5)
+        
+        def post_webhook(update: dict):
+            request = urllib.request.Request(
+                f"http://127.0.0.1:{webhook_port}/telegram", data=json.dumps(update).encode(),
+                headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret})
+            urllib.request.urlopen(request, timeout=10).read()
+        
+        def produce():
+            poster = ThreadPoolExecutor(max_workers=WEBHOOK_MAX_CONNECTIONS, thread_name_prefix="webhook-post")
+            for burst in range(bursts):
+                for index in range(burst_size):
+                    update_id = burst * burst_size + index + 1
+                    update = fake.make_update(update_id, 10000 + update_id)
+                    with fake.cond:
+                        fake.sent_at[10000 + update_id] = time.monotonic()
+                        if mode == "polling":
+                            fake.updates.append(update)
+                            fake.cond.notify_all()
+                    if mode == "webhook":
+                        poster.submit(post_webhook, update)
+                time.sleep(burst_gap)
+            poster.shutdown(wait=True)
+        
+        total = bursts * burst_size
+        cpu_started = time.thread_time()
+        await asyncio.to_thread(produce)
+        deadline = time.monotonic() + 30
+        while len(fake.replied_at) < total and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        cpu = time.thread_time() - cpu_started
+        
+        await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+        
+        latencies = sorted(fake.replied_at[chat_id] - fake.sent_at[chat_id] for chat_id in fake.replied_at)
+        if not latencies:
+            return 0, None, None, cpu
+        return len(latencies), latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)], cpu
 
-    print("✅ Bot çalışıyor...")
-    app.run_polling()
+    total = bursts * burst_size
+    print(f"🧪 {bursts} x {burst_size} güncellemelik patlama ({burst_gap} sn arayla), sahte Telegram :{api_port}")
+    failed = False
+    for mode in ("polling", "webhook"):
+        replied, p50, p95, cpu = asyncio.run(run(mode))
+        if p50 is None:
+            print(f"   {mode:8s} cevap alınamadı")
+            failed = True
+            continue
+        print(f"   {mode:8s} {replied}/{total} cevap   p50 {p50 * 1000:6.0f} ms   p95 {p95 * 1000:6.0f} ms   "
+              f"CPU {cpu:5.2f} sn ({cpu * 1000 / replied:.1f} ms/güncelleme)")
+        failed = failed or replied < total
+    server.shutdown()
+    return 1 if failed else 0
 
 if __name__ == "__main__":
+    if "--import-budget" in sys.argv:
+        sys.exit(check_import_budget())
+    if "--load-test" in sys.argv:
+        sys.exit(run_update_load_test())
+    if "--webhook-bench" in sys.argv:
+        sys.exit(run_webhook_benchmark())
+    if "--bench-clock" in sys.argv:
+        sys.exit(run_clock_benchmark())
+    if "--bench-keyboards" in sys.argv:
+        sys.exit(run_keyboard_benchmark())
     main()